@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Benchmark piosk's hot paths against the fake hardware backend, so results can be compared between x86 CI and Pi runs.
+This only reports the numbers: there are no time budgets, and it exits with status 0 however slow a benchmark is.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from piosk.config import CONFIG, get_config
+
+CONFIG['hardware']['BACKEND'] = 'fake'
+
+from easing_functions import ExponentialEaseIn  # noqa: E402
+
+import piosk.brightness  # noqa: E402
+import piosk.control  # noqa: E402
+import piosk.gestures  # noqa: E402
+import piosk.logger  # noqa: E402
+import piosk.runtime  # noqa: E402
+import piosk.screensaver  # noqa: E402
+from piosk.led import BlinkSequenceEvent, compile_sequence, get_led  # noqa: E402
+from pioskctl import ControlClient  # noqa: E402
+
+
+def bench(name: str, func, iterations: int) -> dict:
+    func()  # Warm up caches before measuring.
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        func()
+        samples.append(time.perf_counter_ns() - start)
+    return {
+        'name': name,
+        'iterations': iterations,
+        'min_us': min(samples) / 1000,
+        'median_us': statistics.median(samples) / 1000,
+        'mean_us': statistics.fmean(samples) / 1000,
+        'max_us': max(samples) / 1000,
+    }
+
+
+def bench_fade_frame(iterations: int) -> dict:
+    backlight = piosk.brightness._get_backlight()
+    values = iter(range(1 << 62))
+
+    def frame():
+        backlight.brightness_value = 50 + next(values) % 200
+
+    return bench('fade frame write', frame, iterations)
+
+
+def bench_fade_build(iterations: int) -> dict:
+    backlight = piosk.brightness._get_backlight()
+    return bench('fade frame build', lambda: backlight._fade_frames(200, piosk.brightness.LinearInOut), iterations)
+
+
+def bench_led_sequence_build(iterations: int) -> dict:
+    # The button hold strobe, as built by piosk.button._hold_strobe().
+    events = (BlinkSequenceEvent(1, 0, 0.5, easing=ExponentialEaseIn),)
+    reset = BlinkSequenceEvent(0)
+    strobe = BlinkSequenceEvent(1, 0, 1, easing=ExponentialEaseIn)
+    events += (reset, strobe) * get_config().button.strobe_count
+    # Bypass the cache, so this measures a cold compile.
+    return bench('led sequence build', lambda: compile_sequence.__wrapped__(events, 0.0), iterations)
+
+
+def bench_led_pulse_build(iterations: int) -> dict:
+    # A pulse, as built by LedInstructionProvidingThread._led_pulse().
+    events = (BlinkSequenceEvent(1.0, 1, 1), BlinkSequenceEvent(0.0, 1, 1))
+    return bench('led pulse build', lambda: compile_sequence.__wrapped__(events, 0.0), iterations)
+
+
+def bench_led_sequence_switch(iterations: int) -> dict:
+    # Time spent on the caller's side handing a new sequence to the LED worker.
+    led = get_led()
+    events = (BlinkSequenceEvent(1.0, 1, 1), BlinkSequenceEvent(0.0, 1, 1))
+    return bench('led sequence switch', lambda: led.sequence(events, n=None), iterations)
+
+
+def bench_button_click(iterations: int) -> dict:
+    # Press and release edges through the gesture recognizer, up to the click's action being called.
+    recognized = []
+    recognizer = piosk.gestures.GestureRecognizer(get_config().button, lambda gesture, at: recognized.append(gesture))
+
+    def click():
+        now = time.monotonic()
+        recognizer.press(now)
+        recognizer.release(now + 0.01)
+
+    return bench('button click', click, iterations)
+
+
+def bench_poke(iterations: int) -> dict:
+    return bench('screensaver poke', piosk.screensaver.poke_screensaver, iterations)
+
+
+def bench_auto_brightness(iterations: int) -> dict:
+    thread = piosk.brightness.AutoBrightnessThread(piosk.runtime.LoopEvent(), piosk.runtime.LoopEvent())
+    thread._smooth = False
+
+    def poll():
+        thread._set_brightness(thread.get_auto_brightness())
+
+    return bench('auto brightness poll', poll, iterations)
+
+
+def bench_control(iterations: int) -> dict:
+    # Round trip of a control command through the Unix socket, including dispatch.
+    path = os.path.join(tempfile.mkdtemp(prefix='piosk-control-'), 'control.sock')
+    piosk.control.ControlServerThread(path).start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    client = ControlClient(path)
+    values = iter(range(1 << 62))
+
+    def command():
+        client.send({'cmd': 'set_brightness', 'value': 50 + next(values) % 200})
+
+    return bench('control round trip', command, iterations)
+
+
+def bench_log_debug(iterations: int) -> dict:
+    # The cost of a debug call on a hot path, e.g. in the motion sensor thread.
+    return bench('log debug', lambda: piosk.logger.debug('Motion wake took %.1f ms.', 1.5), iterations)
+
+
+BENCHMARKS = (
+    bench_fade_frame,
+    bench_fade_build,
+    bench_led_sequence_build,
+    bench_led_pulse_build,
+    bench_led_sequence_switch,
+    bench_button_click,
+    bench_poke,
+    bench_auto_brightness,
+    bench_log_debug,
+    bench_control,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--iterations', type=int, default=1000)
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to a JSON file.')
+    args = parser.parse_args()
+
+    results = [benchmark(args.iterations) for benchmark in BENCHMARKS]
+    print(f"{'benchmark':<24}{'min':>10}{'median':>10}{'mean':>10}{'max':>10}  (us)")
+    for result in results:
+        print(f"{result['name']:<24}{result['min_us']:>10.2f}{result['median_us']:>10.2f}"
+              f"{result['mean_us']:>10.2f}{result['max_us']:>10.2f}")
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'platform': sys.platform, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Check the browser supervisor and memory watchdog end to end against fake_browser.py, with the fake hardware backend
+and scripted screensaver events. Exits with status 1 if any check fails.
+"""
+import argparse
+import dataclasses
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from piosk.config import CONFIG
+
+CONFIG['hardware']['BACKEND'] = 'fake'
+
+import piosk.brightness  # noqa: E402
+import piosk.browser  # noqa: E402
+import piosk.config  # noqa: E402
+import piosk.screensaver  # noqa: E402
+import piosk.watchdog  # noqa: E402
+from piosk.screensaver import DisplayState  # noqa: E402
+from piosk.xscreensaver import ScreensaverEvent  # noqa: E402
+
+# Process names are cut to 15 characters, so this is short enough to be matched in full.
+PROCESS_NAME = 'fakebrowser'
+FAKE_BROWSER = Path(__file__).resolve().parent / 'fake_browser.py'
+# A quick fade, so the backlight goes off soon after each blank.
+XSCREENSAVER_FILE = 'fade:\tTrue\nunfade:\tFalse\nfadeSeconds:\t0:00:01\n'
+
+_FAILURES: list[str] = []
+
+
+def expect(condition: bool, what: str):
+    print(f"{'ok  ' if condition else 'FAIL'}  {what}")
+    if not condition:
+        _FAILURES.append(what)
+
+
+def wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def configure(**changes):
+    """
+    Swap in a config snapshot with `changes` to the [browser] section, and tell its subscribers, as a reload would.
+    """
+    snapshot = piosk.config.get_config()
+    browser = dataclasses.replace(snapshot.browser, **changes)
+    piosk.config._SNAPSHOT = dataclasses.replace(snapshot, browser=browser)
+    for callback in piosk.config._SUBSCRIBERS.get('browser', ()):
+        callback(browser)
+
+
+def push(event: ScreensaverEvent):
+    piosk.screensaver.get_backend().push(event)
+
+
+def browser_tree() -> list[int]:
+    return piosk.browser.ProcessTracker().refresh(PROCESS_NAME)
+
+
+def states(pids: list[int]) -> set[str]:
+    return {stat[1] for stat in map(piosk.browser._read_stat, pids) if stat is not None}
+
+
+def cpu_moves(pids: list[int]) -> bool:
+    ticks = piosk.browser._cpu_ticks(pids)
+    time.sleep(0.3)
+    return piosk.browser._cpu_ticks(pids) > ticks
+
+
+def kill_browsers():
+    for pid in browser_tree():
+        os.kill(pid, signal.SIGKILL)
+        # A stopped process only dies once it is continued.
+        os.kill(pid, signal.SIGCONT)
+
+    def reaped() -> bool:
+        # The fake browsers started here are this process's children, and linger as zombies until reaped.
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+        return not browser_tree()
+
+    wait_for(reaped, 2.0)
+
+
+class FakeBrowsers:
+    def __init__(self, bin_dir: str):
+        self._link = os.path.join(bin_dir, PROCESS_NAME)
+        # The link is named after the process, so it must point at the interpreter itself, not a wrapper script.
+        os.symlink(os.path.realpath(sys.executable), self._link)
+
+    def command(self, *args: str) -> list[str]:
+        return [self._link, str(FAKE_BROWSER), *args]
+
+    def start(self, *args: str, cgroup: Path | None = None) -> subprocess.Popen:
+        fd = None
+        if cgroup is not None:
+            fd = os.open(cgroup / 'cgroup.procs', os.O_WRONLY)
+        try:
+            # Join the cgroup before exec, so every child forked later starts inside it.
+            process = subprocess.Popen(self.command(*args),
+                                       preexec_fn=(lambda: os.write(fd, b'0')) if fd is not None else None)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        wait_for(lambda: len(browser_tree()) == 3, 5.0)
+        return process
+
+
+def make_cgroup() -> Path | None:
+    """
+    :return: A new cgroup v2 directory with a freezer, or None if one can't be made here.
+    """
+    root = Path('/sys/fs/cgroup')
+    if not (root / 'cgroup.controllers').exists():
+        root = root / 'unified'
+    path = root / f'piosk-check-{os.getpid()}'
+    try:
+        path.mkdir()
+    except OSError:
+        return None
+    if not (path / 'cgroup.freeze').exists():
+        path.rmdir()
+        return None
+    return path
+
+
+def check_freeze(browsers: FakeBrowsers, method: str, cgroup: Path | None):
+    print(f'Freezing with {method}:')
+    configure(freeze=True, freeze_method=method, freeze_delay_seconds=0.5, memory_limit_mb=0.0)
+    supervisor = piosk.browser.get_supervisor()
+    browsers.start(cgroup=cgroup)
+    pids = browser_tree()
+    expect(len(pids) == 3, 'the fake browser and its two children are found')
+
+    freezes = supervisor.freezes
+    push(ScreensaverEvent.ACTIVATED)
+    time.sleep(0.2)
+    push(ScreensaverEvent.DEACTIVATED)
+    time.sleep(0.6)
+    expect(supervisor.freezes == freezes and 'T' not in states(pids),
+           'a wake within FREEZE_DELAY_SECONDS leaves the browser running')
+
+    push(ScreensaverEvent.ACTIVATED)
+    expect(wait_for(lambda: supervisor.frozen, 2.0), 'the browser is frozen once FREEZE_DELAY_SECONDS pass')
+    if method == 'signal':
+        expect(wait_for(lambda: states(pids) == {'T'}, 1.0), 'every browser process is stopped')
+    else:
+        expect(wait_for(lambda: 'frozen 1' in (cgroup / 'cgroup.events').read_text(), 1.0),
+               "the browser's cgroup is frozen")
+    expect(not cpu_moves(pids), 'the frozen browser uses no CPU')
+    expect(wait_for(lambda: piosk.screensaver.get_display_state() is DisplayState.OFF, 3.0),
+           'the backlight goes off after the fade')
+
+    frozen_at_screen_on = []
+    turn_screen_on = piosk.brightness.turn_screen_on
+
+    def record_screen_on():
+        frozen_at_screen_on.append(supervisor.frozen or 'T' in states(pids))
+        turn_screen_on()
+
+    piosk.brightness.turn_screen_on = record_screen_on
+    try:
+        push(ScreensaverEvent.DEACTIVATED)
+        wait_for(lambda: frozen_at_screen_on, 2.0)
+    finally:
+        piosk.brightness.turn_screen_on = turn_screen_on
+    expect(frozen_at_screen_on == [False], 'the browser is thawed before the backlight comes on')
+    expect('T' not in states(pids) and cpu_moves(pids), 'the thawed browser runs again')
+    expect(wait_for(lambda: supervisor.last_paint_latency is not None, 2.0), 'the time to resume is measured')
+    kill_browsers()
+
+
+def check_memory(browsers: FakeBrowsers):
+    print('Restarting a leaking browser:')
+    # The first restart escalates to SIGKILL, so don't wait the full timeout for it.
+    piosk.browser._EXIT_TIMEOUT = 1.0
+    configure(freeze=True, freeze_method='signal', freeze_delay_seconds=0.5, memory_limit_mb=60.0,
+              memory_poll_seconds=0.2, restart_cmd=' '.join(browsers.command('--leak-mb', '100')),
+              restart_warm_seconds=1.0)
+    supervisor = piosk.browser.get_supervisor()
+    restarts = supervisor.restarts
+    old = browsers.start('--leak-mb', '100', '--ignore-term')
+    old_pids = browser_tree()
+
+    expect(wait_for(lambda: supervisor.restart_pending, 3.0), 'going over MEMORY_LIMIT_MB asks for a restart')
+    time.sleep(0.5)
+    expect(supervisor.restarts == restarts and old.poll() is None, 'the restart waits for the backlight to go off')
+
+    push(ScreensaverEvent.ACTIVATED)
+    expect(wait_for(lambda: supervisor.restarts == restarts + 1, 6.0), 'the browser restarts once the backlight is off')
+    wait_for(lambda: old.poll() is not None, 1.0)
+    expect(old.returncode == -signal.SIGKILL and not states(old_pids) - {'Z'},
+           'a browser ignoring SIGTERM is killed with SIGKILL')
+    expect(wait_for(lambda: supervisor.frozen, 3.0), 'the new browser is frozen after RESTART_WARM_SECONDS')
+    expect(supervisor.restart_pending and supervisor.restarts == restarts + 1,
+           'the new browser, also over the limit, is not restarted again while the backlight is off')
+
+    push(ScreensaverEvent.DEACTIVATED)
+    time.sleep(0.5)
+    expect(supervisor.restarts == restarts + 1, 'the held restart still waits while the screen is on')
+    push(ScreensaverEvent.ACTIVATED)
+    expect(wait_for(lambda: supervisor.restarts == restarts + 2, 6.0), 'it happens the next time the backlight is off')
+    push(ScreensaverEvent.DEACTIVATED)
+    kill_browsers()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='piosk-check-') as tmp:
+        xscreensaver_file = os.path.join(tmp, 'xscreensaver')
+        with open(xscreensaver_file, 'w') as f:
+            f.write(XSCREENSAVER_FILE)
+        snapshot = piosk.config.get_config()
+        piosk.config._SNAPSHOT = dataclasses.replace(
+            snapshot, screensaver=dataclasses.replace(snapshot.screensaver, xscreensaver_file=xscreensaver_file)
+        )
+        configure(process_name=PROCESS_NAME)
+        browsers = FakeBrowsers(tmp)
+        piosk.screensaver.start_screensaver_thread()
+        piosk.watchdog.start_memory_watchdog()
+        cgroup = make_cgroup()
+        try:
+            check_freeze(browsers, 'signal', None)
+            if cgroup is not None:
+                check_freeze(browsers, 'cgroup', cgroup)
+            else:
+                print('Skipped freezing with cgroup: no cgroup v2 freezer can be made here.')
+            check_memory(browsers)
+        finally:
+            kill_browsers()
+            if cgroup is not None:
+                wait_for(lambda: not (cgroup / 'cgroup.procs').read_text().strip(), 2.0)
+                cgroup.rmdir()
+    print(f'{len(_FAILURES)} checks failed.' if _FAILURES else 'All checks passed.')
+    sys.stdout.flush()
+    # The screensaver thread never exits on its own.
+    os._exit(1 if _FAILURES else 0)
+
+
+if __name__ == '__main__':
+    main()
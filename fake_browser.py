@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+A stand-in for the kiosk browser, for trying the browser supervisor and memory watchdog off-device. It keeps the CPU
+busy in a parent and two children, like a browser animating a dashboard, and can hold on to memory and ignore SIGTERM.
+Run it through a link with the name set in [browser] PROCESS_NAME, so its processes are found by that name.
+"""
+import argparse
+import signal
+import subprocess
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--leak-mb', type=int, default=0, help='Memory to hold on to once started, in MB.')
+    parser.add_argument('--ignore-term', action='store_true', help='Ignore SIGTERM, so only SIGKILL stops it.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.ignore_term:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if not args.child:
+        command = [sys.executable, __file__, '--child'] + (['--ignore-term'] if args.ignore_term else [])
+        children = [subprocess.Popen(command) for _ in range(2)]  # noqa: F841
+    # Filled in, so every page is resident.
+    hoard = b'\x01' * (args.leak_mb << 20)  # noqa: F841
+    while True:
+        pass
+
+
+if __name__ == '__main__':
+    main()
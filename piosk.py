@@ -2,36 +2,87 @@
 import os
 import sys
 
-from piosk.brightness import start_auto_brightness, turn_screen_on
-from piosk.button import start_button_thread, join_button_thread
-from piosk.config import CONFIG
-from piosk.led import GPIO_LED
-from piosk.motion import start_motion_sensor_thread, join_motion_sensor_thread
-from piosk.screensaver import start_screensaver_thread, join_screensaver_thread
+import piosk.logger
+from piosk.util import import_timed, log, log_startup_report
+
+# Import leaf modules first so the startup report shows each module's own import time.
+import_timed('piosk.config', 'piosk.metrics', 'piosk.runtime', 'piosk.state', 'piosk.sysfs', 'piosk.curves',
+             'piosk.frames', 'piosk.hardware', 'piosk.xscreensaver', 'piosk.led', 'piosk.browser', 'piosk.brightness',
+             'piosk.motion', 'piosk.screensaver', 'piosk.gestures', 'piosk.shutdown', 'piosk.button', 'piosk.control',
+             'piosk.reloader', 'piosk.watchdog')
+
+import piosk.runtime  # noqa: E402
+import piosk.state  # noqa: E402
+from piosk.brightness import (restore_state, start_auto_brightness, turn_screen_on,  # noqa: E402
+                              run_auto_brightness_async)
+from piosk.button import start_button_thread, join_button_thread, run_button_async  # noqa: E402
+from piosk.config import CONFIG, get_config  # noqa: E402
+from piosk.control import start_control_server, run_control_server_async  # noqa: E402
+from piosk.led import get_led  # noqa: E402
+from piosk.metrics import start_metrics_server, run_metrics_server_async  # noqa: E402
+from piosk.motion import start_motion_sensor_thread, join_motion_sensor_thread, run_motion_sensor_async  # noqa: E402
+from piosk.reloader import start_config_watcher, run_config_watcher_async  # noqa: E402
+from piosk.screensaver import start_screensaver_thread, join_screensaver_thread, run_screensaver_async  # noqa: E402
+from piosk.shutdown import start_shutdown_menu  # noqa: E402
+from piosk.watchdog import start_memory_watchdog, run_memory_watchdog_async  # noqa: E402
 
 
 def main():
+    piosk.logger.install_crash_handlers()
+    restore_state()
+    start_shutdown_menu()
     # TODO: LightSensor functionality is broken: https://github.com/gpiozero/gpiozero/issues/1135
     #  Automatic brightness is currently unsupported, untested, and not fully implemented.
+    if CONFIG['runtime']['MODE'] == 'asyncio':
+        main_async()
+        return
 
+    if CONFIG['metrics']['ENABLED'] is True:
+        start_metrics_server()
+    if CONFIG['control']['ENABLED'] is True:
+        start_control_server()
     start_screensaver_thread()
     start_button_thread()
     start_motion_sensor_thread()
-    if CONFIG['brightness']['AUTO_ENABLED'] is True:
+    start_config_watcher()
+    start_memory_watchdog()
+    if get_config().brightness.auto_enabled is True:
         start_auto_brightness()
+    log_startup_report()
 
     join_screensaver_thread()
     join_button_thread()
     join_motion_sensor_thread()
 
 
+def main_async():
+    # Run every subsystem as a coroutine on a single event loop instead of one OS thread each.
+    coroutines = [run_screensaver_async(), run_button_async(), run_motion_sensor_async(), run_config_watcher_async(),
+                  run_memory_watchdog_async()]
+    if get_config().brightness.auto_enabled is True:
+        coroutines.append(run_auto_brightness_async())
+    if CONFIG['metrics']['ENABLED'] is True:
+        coroutines.append(run_metrics_server_async())
+    if CONFIG['control']['ENABLED'] is True:
+        coroutines.append(run_control_server_async())
+    coroutines.append(report_startup_async())
+    piosk.runtime.run(*coroutines)
+
+
+async def report_startup_async():
+    # Runs after every other task has started, so device init times are included.
+    log_startup_report()
+
+
 if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
         turn_screen_on()
-        GPIO_LED.off()
-        print('Interrupted')
+        get_led().off()
+        log('Interrupted')
+        piosk.state.flush()
+        piosk.logger.flush()
         try:
             sys.exit(130)
         except SystemExit:
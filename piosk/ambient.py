@@ -0,0 +1,269 @@
+import json
+import math
+import os
+import statistics
+from array import array
+from bisect import bisect_right
+from collections import deque
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+from typing import Callable
+
+from piosk.config import CONFIG, BrightnessSettings, get_config
+from piosk.util import log, warning
+
+_PROJECT_PATH = Path(__file__).parent.parent
+
+
+class AmbientFilter:
+    """
+    Smooths raw light sensor readings with either an exponential moving average or a running median.
+    """
+
+    def __init__(self, mode: str, alpha: float, window: int):
+        self._mode = mode
+        self._alpha = alpha
+        self._window: deque[float] = deque(maxlen=max(1, window))
+        self._value: float | None = None
+
+    def update(self, reading: float) -> float:
+        if self._mode == 'median':
+            self._window.append(reading)
+            self._value = statistics.median(self._window)
+        elif self._value is None:
+            self._value = reading
+        else:
+            self._value += self._alpha * (reading - self._value)
+        return self._value
+
+
+class BrightnessController:
+    """
+    Decides when auto brightness should actually change the backlight. Readings are filtered, and the current target
+    is held until the filtered brightness leaves a hysteresis band around it and the minimum dwell time has passed.
+    The polling interval shrinks to the base interval while ambient light is changing and backs off exponentially while
+    it is steady.
+    """
+
+    def __init__(self, initial_brightness: int, settings: BrightnessSettings,
+                 to_brightness: Callable[[float], float]):
+        """
+        :param initial_brightness: The backlight's current brightness.
+        :param settings: The [brightness] settings to run with.
+        :param to_brightness: Maps a sensor reading to an unquantized brightness value.
+        """
+        self._to_brightness = to_brightness
+        self._target = initial_brightness
+        self._last_change: float = float('-inf')
+        self._last_filtered: float | None = None
+        self._settings: BrightnessSettings | None = None
+        self.last_reading: float | None = None
+        self.readings: int = 0
+        self.writes: int = 0
+        self.writes_avoided: int = 0
+        self.configure(settings)
+
+    def configure(self, settings: BrightnessSettings):
+        """
+        Apply new [brightness] settings. The filter is only reset if its own settings changed, and the current target
+        is kept.
+        """
+        previous = self._settings
+        if previous is None or (previous.auto_filter, previous.auto_filter_alpha, previous.auto_filter_window) != \
+                (settings.auto_filter, settings.auto_filter_alpha, settings.auto_filter_window):
+            self._filter = AmbientFilter(settings.auto_filter, settings.auto_filter_alpha, settings.auto_filter_window)
+        self._settings = settings
+        self._minimum = settings.auto_minimum
+        self._step = settings.auto_step
+        self._band = (0.5 + settings.auto_hysteresis_steps) * settings.auto_step
+        self._min_dwell = settings.auto_min_dwell_seconds
+        self._poll_min = settings.poll_time_seconds
+        self._poll_max = max(settings.poll_max_seconds, self._poll_min)
+        self._backoff = settings.poll_backoff
+        self.poll_interval: float = self._poll_min
+
+    def _quantize(self, brightness: float) -> int:
+        # Adjust value to the nearest multiple of `self._step` above the minimum.
+        return int(round(self._minimum + self._step * round((brightness - self._minimum) / self._step)))
+
+    def _adapt_poll_interval(self, filtered: float):
+        if self._last_filtered is not None and abs(filtered - self._last_filtered) < self._step / 2:
+            self.poll_interval = min(self.poll_interval * self._backoff, self._poll_max)
+        else:
+            self.poll_interval = self._poll_min
+        self._last_filtered = filtered
+
+    def update(self, reading: float, now: float) -> int | None:
+        """
+        Feed a sensor reading to the controller.
+
+        :param reading: Raw light sensor value.
+        :param now: Current time.monotonic() value.
+        :return: The new brightness to apply, or None to leave the backlight alone.
+        """
+        self.readings += 1
+        self.last_reading = self._filter.update(reading)
+        filtered = self._to_brightness(self.last_reading)
+        self._adapt_poll_interval(filtered)
+        if self._quantize(self._to_brightness(reading)) == self._target:
+            return None
+        # Without the controller, this reading would have triggered a fade.
+        if abs(filtered - self._target) <= self._band or now - self._last_change < self._min_dwell:
+            self.writes_avoided += 1
+            return None
+        target = self._quantize(filtered)
+        if target == self._target:
+            self.writes_avoided += 1
+            return None
+        self._target = target
+        self._last_change = now
+        self.writes += 1
+        return target
+
+    def override(self, brightness: int, now: float):
+        """
+        Adopt a brightness chosen by hand. It is held for at least the minimum dwell time.
+        """
+        self._target = brightness
+        self._last_change = now
+
+    def set_curve(self, to_brightness: Callable[[float], float]):
+        self._to_brightness = to_brightness
+
+
+def _interpolate(points: tuple[tuple[float, float], ...], x: float) -> float:
+    readings = [p[0] for p in points]
+    i = bisect_right(readings, x)
+    if i == 0:
+        return points[0][1]
+    if i == len(points):
+        return points[-1][1]
+    (x0, y0), (x1, y1) = points[i - 1], points[i]
+    return y0 if x1 == x0 else y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+
+@lru_cache(maxsize=4)
+def build_curve(kind: str, minimum: float, maximum: float, gamma: float, log_scale: float,
+                points: tuple[tuple[float, float], ...], resolution: int) -> array:
+    """
+    Build a lookup table from quantized sensor reading to unquantized backlight brightness. Tables are cached by their
+    parameters, so a table is only rebuilt when the curve configuration changes.
+
+    :param kind: 'linear', 'gamma', 'log' or 'points'.
+    :param minimum: Brightness at a sensor reading of 0.
+    :param maximum: Brightness at a sensor reading of 1.
+    :param gamma: Exponent for the 'gamma' curve. Values above 1 keep the panel dimmer in dim rooms.
+    :param log_scale: Steepness of the 'log' curve.
+    :param points: (sensor reading, brightness) pairs for the 'points' curve, sorted by reading.
+    :param resolution: Number of sensor reading steps in the table.
+    """
+    span = maximum - minimum
+    table = array('f')
+    for i in range(resolution + 1):
+        x = i / resolution
+        if kind == 'points' and len(points) > 0:
+            value = _interpolate(points, x)
+        elif kind == 'gamma':
+            value = minimum + span * x ** gamma
+        elif kind == 'log':
+            value = minimum + span * math.log1p(log_scale * x) / math.log1p(log_scale)
+        else:
+            value = minimum + span * x
+        table.append(min(max(value, minimum), maximum))
+    return table
+
+
+class BrightnessCurve:
+    """
+    Maps a light sensor reading to a backlight brightness through a precomputed lookup table.
+    """
+
+    def __init__(self, table: array):
+        self._table = table
+        self._resolution = len(table) - 1
+
+    def __call__(self, sensor_reading: float) -> float:
+        index = int(sensor_reading * self._resolution + 0.5)
+        return self._table[min(max(index, 0), self._resolution)]
+
+
+def get_brightness_curve(settings: BrightnessSettings | None = None) -> BrightnessCurve:
+    """
+    :param settings: The [brightness] settings to build the curve from, or None to use the current config.
+    :return: The brightness curve described by the [brightness] config section.
+    """
+    settings = settings if settings is not None else get_config().brightness
+    kind = settings.auto_curve
+    points = tuple((float(r), float(b)) for r, b in sorted(settings.auto_curve_points))
+    if kind == 'calibrated':
+        points = _CALIBRATION.fit()
+        kind = 'points' if len(points) > 0 else 'linear'
+    return BrightnessCurve(build_curve(
+        kind, float(settings.auto_minimum), float(settings.auto_maximum), settings.auto_curve_gamma,
+        settings.auto_curve_log_scale, points, settings.auto_curve_resolution
+    ))
+
+
+class Calibration:
+    """
+    Records (sensor reading, brightness) pairs whenever the brightness is set by hand, and fits a piecewise curve to
+    them. Pairs are persisted to a JSON file so calibration survives restarts.
+    """
+
+    def __init__(self, path: Path, bins: int):
+        self._path = path
+        self._bins = max(1, bins)
+        self._lock = Lock()
+        self._pairs: list[tuple[float, int]] | None = None
+
+    def _load(self) -> list[tuple[float, int]]:
+        if self._pairs is None:
+            try:
+                with self._path.open('r') as f:
+                    self._pairs = [(float(r), int(b)) for r, b in json.load(f)]
+            except FileNotFoundError:
+                self._pairs = []
+            except (ValueError, TypeError) as e:
+                warning('Ignoring unreadable calibration file %s: %s', self._path, e)
+                self._pairs = []
+        return self._pairs
+
+    def record(self, sensor_reading: float, brightness: int):
+        with self._lock:
+            pairs = self._load()
+            pairs.append((sensor_reading, brightness))
+            tmp_path = self._path.with_suffix('.tmp')
+            with tmp_path.open('w') as f:
+                json.dump(pairs, f)
+            os.replace(tmp_path, self._path)
+        log('Recorded calibration point: sensor %.3f -> brightness %d.', sensor_reading, brightness)
+
+    def fit(self) -> tuple[tuple[float, float], ...]:
+        """
+        :return: (sensor reading, brightness) points averaged per sensor bin and made non-decreasing, or an empty
+                tuple if nothing has been recorded.
+        """
+        with self._lock:
+            pairs = list(self._load())
+        bins: dict[int, list[tuple[float, int]]] = {}
+        for reading, brightness in pairs:
+            bins.setdefault(min(int(reading * self._bins), self._bins - 1), []).append((reading, brightness))
+        points = []
+        floor = float('-inf')
+        for index in sorted(bins):
+            members = bins[index]
+            # Brighter surroundings should never map to a dimmer panel.
+            floor = max(floor, statistics.fmean(b for _, b in members))
+            points.append((statistics.fmean(r for r, _ in members), floor))
+        return tuple(points)
+
+
+_CALIBRATION = Calibration(
+    _PROJECT_PATH / CONFIG['brightness']['AUTO_CALIBRATION_FILE'],
+    CONFIG['brightness']['AUTO_CALIBRATION_BINS']
+)
+
+
+def record_calibration(sensor_reading: float, brightness: int):
+    _CALIBRATION.record(sensor_reading, brightness)
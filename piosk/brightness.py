@@ -1,14 +1,30 @@
+import asyncio
+import concurrent.futures
 import time
 from enum import StrEnum, Enum
 from pathlib import Path
-from threading import Event, Lock
+from threading import Condition, Lock, Thread
 
 from easing_functions.easing import EasingBase, LinearInOut
 from gpiozero import LightSensor
 
+import piosk.hardware
+import piosk.metrics
 import piosk.motion
-from piosk.config import CONFIG
+import piosk.runtime
+import piosk.state
+import piosk.sysfs
+from piosk.ambient import BrightnessController, get_brightness_curve, record_calibration
+from piosk.config import CONFIG, BrightnessSettings, get_config, subscribe
+from piosk.curves import get_curve
+from piosk.frames import FrameScheduler, FrameStats
 from piosk.led import LedInstructionProvidingThread
+from piosk.runtime import LoopEvent
+from piosk.util import TimedLock, log, timed
+
+
+# The panel refreshes at 60 Hz, so a brightness written less than a frame after the last one would never be seen.
+_PANEL_FRAME_SECONDS = 1 / 60
 
 
 class Brightness(Enum):
@@ -16,17 +32,7 @@ class Brightness(Enum):
     OFF = 1
 
 
-def _read_value(path: Path):
-    with path.open('r') as f:
-        return f.read()
-
-
-def _write_value(path: Path, value):
-    with path.open('w') as f:
-        f.write(str(value))
-
-
-__current_brightness = -1
+_current_brightness = -1
 __power_state: Brightness = Brightness.ON
 
 
@@ -50,91 +56,267 @@ class Backlight(StrEnum):
 
     @property
     def path(self) -> Path:
-        return Path('/sys/class/backlight/', str(self.value))
+        return piosk.hardware.backlight_root() / str(self.value)
 
     @property
     def brightness(self) -> Path:
         return self.path / 'brightness'
 
+    @property
+    def brightness_file(self) -> piosk.sysfs.SysfsAttribute:
+        return piosk.sysfs.attribute(self.brightness, _PANEL_FRAME_SECONDS)
+
     @property
     def brightness_value(self) -> int:
-        global __current_brightness
-        __current_brightness = int(_read_value(self.brightness))
-        return __current_brightness
+        global _current_brightness
+        _current_brightness = int(self.brightness_file.read())
+        return _current_brightness
 
     @brightness_value.setter
     def brightness_value(self, value: int):
-        global __current_brightness
-        if isinstance(value, int) and 0 <= value <= 255 and value != __current_brightness:
-            _write_value(self.brightness, value)
-            __current_brightness = value
-
-    def set_brightness_smoothed(self, value: int, ease_cls: type[EasingBase]):
-        # TODO: Should this have a background option?
+        global _current_brightness
+        if isinstance(value, int) and 0 <= value <= 255 and value != _current_brightness:
+            self.brightness_file.write(value)
+            _BACKLIGHT_WRITES.inc('brightness')
+            _current_brightness = value
+            piosk.state.update(brightness=value)
+
+    def _fade_frames(self, value: int, ease_cls: type[EasingBase]) -> tuple[float, list[int]]:
+        """
+        :return: The delay between frames and the list of brightness values for a smoothed transition from the current
+                brightness to `value`.
+        """
         current_value = self.brightness_value
-        easing = ease_cls(current_value, value, CONFIG['brightness']['SMOOTH_FPS'])
-        delay = CONFIG['brightness']['SMOOTH_DURATION_SECONDS'] / CONFIG['brightness']['SMOOTH_FPS']
-        frame_count = CONFIG['brightness']['SMOOTH_DURATION_SECONDS'] * CONFIG['brightness']['SMOOTH_FPS']
-        global __current_brightness
-        for i in range(int(round(frame_count)) + 1):
-            val = easing(i)
-            if __current_brightness != val:
-                self.brightness_value = int(val)
-            time.sleep(delay)
+        settings = get_config().brightness
+        frames = get_curve(ease_cls, current_value, value, settings.smooth_frame_count, 'H')
+        return settings.smooth_delay, [*frames, value]
 
     @property
     def power(self) -> Path:
         return self.path / 'bl_power'
 
+    @property
+    def power_file(self) -> piosk.sysfs.SysfsAttribute:
+        return piosk.sysfs.attribute(self.power)
+
     @property
     def power_value(self) -> Brightness:
-        return Brightness.ON if int(_read_value(self.power)) == Brightness.ON else Brightness.OFF
+        return Brightness.ON if int(self.power_file.read()) == Brightness.ON.value else Brightness.OFF
 
     @power_value.setter
     def power_value(self, value):
-        _write_value(self.power, value)
+        self.power_file.write(value)
+        _BACKLIGHT_WRITES.inc('power')
+        piosk.state.update(power='on' if value == Brightness.ON.value else 'off')
         __power_state = value
 
 
-_BACKLIGHT = Backlight.detect_backlight()
-_BACKLIGHT_LOCK = Lock()
-GPIO_LIGHTSENSOR = LightSensor(CONFIG['PIN_LIGHTSENSOR'])
+_BACKLIGHT: Backlight | None = None
+_BACKLIGHT_LOCK = TimedLock()
+_INIT_LOCK = Lock()
+_BACKLIGHT_WRITES = piosk.metrics.counter('piosk_backlight_writes_total', 'Backlight sysfs writes.', ('attribute',))
+_FADE_DURATION = piosk.metrics.histogram(
+    'piosk_fade_duration_seconds', 'Duration of completed backlight fades.', (0.25, 0.5, 1.0, 1.5, 2.0, 5.0)
+)
+piosk.metrics.register_lock('backlight', _BACKLIGHT_LOCK)
+
+
+def _get_backlight() -> Backlight:
+    """
+    :return: The backlight device, detecting it on first use.
+    """
+    global _BACKLIGHT
+    if _BACKLIGHT is None:
+        with _INIT_LOCK:
+            if _BACKLIGHT is None:
+                with timed('init backlight'):
+                    _BACKLIGHT = Backlight.detect_backlight()
+    return _BACKLIGHT
+
+
+class FadeEngine(Thread):
+    """
+    The single owner of smoothed backlight fades. Callers hand over a target and return immediately. A new target
+    retargets a running fade from the current brightness, and the backlight lock is only held for each frame's write.
+    """
+
+    def __init__(self):
+        super(FadeEngine, self).__init__(daemon=True)
+        self._condition = Condition()
+        self._target: tuple[int, type[EasingBase], float] | None = None
+        self._task: concurrent.futures.Future | None = None
+        # Bumped by every new target or cancel. A frame is only written if its fade's generation is still current.
+        self._generation: int = 0
+        self._thread_started = False
+        self.fades_requested: int = 0
+        self.last_latency: float | None = None
+        self.max_latency: float = 0.0
+        self.last_frame_stats = FrameStats()
+
+    def fade_to(self, value: int, ease_cls: type[EasingBase] = LinearInOut):
+        """
+        Begin fading the backlight to `value`, replacing any fade already in progress.
+        """
+        requested = time.monotonic()
+        if piosk.runtime.is_active():
+            with self._condition:
+                self.fades_requested += 1
+                self._generation += 1
+                if self._task is not None:
+                    self._task.cancel()
+                self._task = piosk.runtime.submit(self._fade_async(value, ease_cls, requested, self._generation))
+            return
+        with self._condition:
+            self.fades_requested += 1
+            self._generation += 1
+            self._target = (value, ease_cls, requested)
+            self._condition.notify()
+            if self._thread_started is False:
+                self._thread_started = True
+                self.start()
+
+    def cancel(self):
+        """
+        Stop any fade in progress, leaving the backlight at its current value.
+        """
+        with self._condition:
+            self._generation += 1
+            if self._task is not None:
+                self._task.cancel()
+                self._task = None
+            self._target = (-1, LinearInOut, 0.0)
+            self._condition.notify()
+
+    def _record_latency(self, requested: float):
+        self.last_latency = time.monotonic() - requested
+        self.max_latency = max(self.max_latency, self.last_latency)
+
+    def _has_target(self) -> bool:
+        return self._target is not None
+
+    def _write_frame(self, value: int, generation: int) -> bool:
+        """
+        :return: False if the fade was replaced or cancelled, in which case nothing is written.
+        """
+        with _BACKLIGHT_LOCK:
+            # Checked under the backlight lock, so a frame can't land on top of a write made after a cancel.
+            if generation != self._generation:
+                return False
+            _get_backlight().brightness_value = value
+        return True
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(self._has_target)
+                value, ease_cls, requested = self._target
+                self._target = None
+                generation = self._generation
+            if value >= 0:
+                self._fade(value, ease_cls, requested, generation)
+
+    def _fade(self, value: int, ease_cls: type[EasingBase], requested: float, generation: int):
+        with _BACKLIGHT_LOCK:
+            delay, frames = _get_backlight()._fade_frames(value, ease_cls)
+        scheduler = FrameScheduler()
+        self.last_frame_stats = scheduler.stats
+        started = time.monotonic()
+        for index, wait in scheduler.frames(delay, len(frames)):
+            with self._condition:
+                if self._condition.wait_for(self._has_target, wait):
+                    # A new target arrived. Abandon this fade; the next one starts from the current value.
+                    return
+            if not self._write_frame(frames[index], generation):
+                return
+            if index == 0:
+                self._record_latency(requested)
+        _FADE_DURATION.observe(time.monotonic() - started)
+
+    async def _fade_async(self, value: int, ease_cls: type[EasingBase], requested: float, generation: int):
+        with _BACKLIGHT_LOCK:
+            delay, frames = _get_backlight()._fade_frames(value, ease_cls)
+        scheduler = FrameScheduler()
+        self.last_frame_stats = scheduler.stats
+        started = time.monotonic()
+        for index, wait in scheduler.frames(delay, len(frames)):
+            await asyncio.sleep(wait)
+            if not self._write_frame(frames[index], generation):
+                return
+            if index == 0:
+                self._record_latency(requested)
+        _FADE_DURATION.observe(time.monotonic() - started)
+
+
+_FADE_ENGINE = FadeEngine()
+
+
+def fade_stats() -> dict[str, float | int | None]:
+    """
+    :return: Fade engine latency and backlight lock contention figures.
+    """
+    return {
+        'fades_requested': _FADE_ENGINE.fades_requested,
+        'last_fade_latency': _FADE_ENGINE.last_latency,
+        'max_fade_latency': _FADE_ENGINE.max_latency,
+        'last_fade_frames_rendered': _FADE_ENGINE.last_frame_stats.rendered,
+        'last_fade_frames_dropped': _FADE_ENGINE.last_frame_stats.dropped,
+        'last_fade_max_lateness': _FADE_ENGINE.last_frame_stats.max_lateness,
+        'lock_acquisitions': _BACKLIGHT_LOCK.acquisitions,
+        'lock_total_wait': _BACKLIGHT_LOCK.total_wait,
+        'lock_max_wait': _BACKLIGHT_LOCK.max_wait,
+    }
+
+
+_GPIO_LIGHTSENSOR: LightSensor | None = None
+
+
+def _get_light_sensor() -> LightSensor:
+    """
+    :return: The light sensor, created on first use. It is only ever created when auto brightness runs.
+    """
+    global _GPIO_LIGHTSENSOR
+    if _GPIO_LIGHTSENSOR is None:
+        with _INIT_LOCK:
+            if _GPIO_LIGHTSENSOR is None:
+                with timed('init light sensor'):
+                    _GPIO_LIGHTSENSOR = LightSensor(CONFIG['PIN_LIGHTSENSOR'], pin_factory=piosk.hardware.pin_factory())
+    return _GPIO_LIGHTSENSOR
 
 
 class AutoBrightnessThread(LedInstructionProvidingThread):
 
-    def __init__(self, polling_event: Event, screen_off_event: Event):
+    def __init__(self, polling_event: LoopEvent, screen_off_event: LoopEvent):
         super(AutoBrightnessThread, self).__init__()
         self._polling_event = polling_event
         self._screen_off_event = screen_off_event
         with _BACKLIGHT_LOCK:
-            self._brightness_value = _BACKLIGHT.brightness_value
-        self._sensor_reading = -1.0
-        self._smooth = CONFIG['brightness']['SMOOTH']
-        self._auto_range = CONFIG['brightness']['AUTO_MAXIMUM'] - CONFIG['brightness']['AUTO_MINIMUM']
-        self._auto_minimum = CONFIG['brightness']['AUTO_MINIMUM']
-        self._auto_step = self._auto_range / CONFIG['brightness']['AUTO_STEP_COUNT']
+            self._brightness_value = _get_backlight().brightness_value
+        settings = get_config().brightness
+        self._smooth = settings.smooth
+        self.controller = BrightnessController(self._brightness_value, settings, get_brightness_curve(settings))
+
+    def reconfigure(self, settings: BrightnessSettings):
+        """
+        Apply reloaded [brightness] settings without restarting the thread. The new poll interval takes effect from the
+        next reading.
+        """
+        self._smooth = settings.smooth
+        self.controller.configure(settings)
+        self.controller.set_curve(get_brightness_curve(settings))
 
     def _set_brightness(self, brightness_value: float):
         if brightness_value is not None and self._brightness_value != brightness_value:
-            with _BACKLIGHT_LOCK:
-                self._brightness_value = int(round(brightness_value))
-                if self._smooth is True:
-                    # TODO: Make the easing method configurable
-                    _BACKLIGHT.set_brightness_smoothed(self._brightness_value, LinearInOut)
-                else:
-                    _BACKLIGHT.brightness_value = brightness_value
-                self._brightness_value = brightness_value
-
-    def get_auto_brightness(self) -> float | None:
-        sensor_reading = GPIO_LIGHTSENSOR.value
-        if self._sensor_reading == sensor_reading:
-            return None
-        self._sensor_reading = sensor_reading
-        new_brightness = self._auto_range * sensor_reading
-        # Adjust value to the nearest multiple of `self._auto_step.`
-        new_brightness = self._auto_step * round(new_brightness / self._auto_step)
-        return round(new_brightness + self._auto_minimum)
+            self._brightness_value = int(round(brightness_value))
+            if self._smooth is True:
+                # TODO: Make the easing method configurable
+                _FADE_ENGINE.fade_to(self._brightness_value, LinearInOut)
+            else:
+                _FADE_ENGINE.cancel()
+                with _BACKLIGHT_LOCK:
+                    _get_backlight().brightness_value = self._brightness_value
+
+    def get_auto_brightness(self) -> int | None:
+        return self.controller.update(_get_light_sensor().value, time.monotonic())
 
     def run(self):
         while True:
@@ -143,19 +325,71 @@ class AutoBrightnessThread(LedInstructionProvidingThread):
                 self._screen_off_event.wait()
                 self._screen_off_event.clear()
             self._set_brightness(self.get_auto_brightness())
-            self._polling_event.wait(CONFIG['brightness']['POLL_TIME_SECONDS'])
+            self._polling_event.wait(self.controller.poll_interval)
             if self._polling_event.is_set() is True:
                 # Break the loop and finish the thread.
                 break
 
+    async def run_async(self):
+        """
+        Coroutine equivalent of run() for the asyncio runtime.
+        """
+        while True:
+            if not screen_is_on():
+                # Wait until the screen is turned back on.
+                await self._screen_off_event.wait_async()
+                self._screen_off_event.clear()
+            self._set_brightness(self.get_auto_brightness())
+            if await self._polling_event.wait_async(self.controller.poll_interval) is True:
+                # Break the loop and finish the task.
+                break
+
 
-_THREAD_POLLING_EVENT: Event = Event()
-_THREAD_SCREEN_OFF_EVENT: Event = Event()
-_THREAD_AUTO_BRIGHTNESS: AutoBrightnessThread = AutoBrightnessThread(_THREAD_POLLING_EVENT, _THREAD_SCREEN_OFF_EVENT)
+_THREAD_POLLING_EVENT: LoopEvent = LoopEvent()
+_THREAD_SCREEN_OFF_EVENT: LoopEvent = LoopEvent()
+_THREAD_AUTO_BRIGHTNESS: AutoBrightnessThread | None = None
+_AUTO_BRIGHTNESS_ASYNC_RUNNING: bool = False
+
+
+def auto_brightness_running() -> bool:
+    thread = _THREAD_AUTO_BRIGHTNESS
+    return _AUTO_BRIGHTNESS_ASYNC_RUNNING or (thread is not None and thread.is_alive())
+
+
+async def run_auto_brightness_async():
+    global _THREAD_AUTO_BRIGHTNESS, _AUTO_BRIGHTNESS_ASYNC_RUNNING
+    if _AUTO_BRIGHTNESS_ASYNC_RUNNING is True:
+        return
+    _AUTO_BRIGHTNESS_ASYNC_RUNNING = True
+    try:
+        _THREAD_POLLING_EVENT.clear()
+        _THREAD_SCREEN_OFF_EVENT.clear()
+        _THREAD_AUTO_BRIGHTNESS = AutoBrightnessThread(_THREAD_POLLING_EVENT, _THREAD_SCREEN_OFF_EVENT)
+        await _THREAD_AUTO_BRIGHTNESS.run_async()
+    finally:
+        _AUTO_BRIGHTNESS_ASYNC_RUNNING = False
+
+
+def auto_brightness_stats() -> dict[str, int | float]:
+    """
+    :return: Auto brightness controller counters, or an empty dict if auto brightness has not run.
+    """
+    if _THREAD_AUTO_BRIGHTNESS is None:
+        return {}
+    controller = _THREAD_AUTO_BRIGHTNESS.controller
+    return {
+        'readings': controller.readings,
+        'writes': controller.writes,
+        'writes_avoided': controller.writes_avoided,
+        'poll_interval': controller.poll_interval,
+    }
 
 
 def start_auto_brightness():
     global _THREAD_AUTO_BRIGHTNESS
+    if piosk.runtime.is_active():
+        piosk.runtime.submit(run_auto_brightness_async())
+        return
     if _THREAD_AUTO_BRIGHTNESS is None or not _THREAD_AUTO_BRIGHTNESS.is_alive():
         _THREAD_POLLING_EVENT.clear()
         _THREAD_SCREEN_OFF_EVENT.clear()
@@ -167,12 +401,18 @@ def stop_auto_brightness():
     _THREAD_POLLING_EVENT.set()
 
 
+def get_brightness() -> int:
+    with _BACKLIGHT_LOCK:
+        return _get_backlight().brightness_value
+
+
 def set_manual_brightness(val: int, smooth: bool = False, ease_cls: type[EasingBase] = LinearInOut):
+    if smooth is True:
+        _FADE_ENGINE.fade_to(val, ease_cls)
+        return
+    _FADE_ENGINE.cancel()
     with _BACKLIGHT_LOCK:
-        if smooth is True:
-            _BACKLIGHT.set_brightness_smoothed(val, ease_cls)
-        else:
-            _BACKLIGHT.brightness_value = val
+        _get_backlight().brightness_value = val
 
 
 def set_screen_power(state: Brightness):
@@ -182,7 +422,7 @@ def set_screen_power(state: Brightness):
         return
     with _BACKLIGHT_LOCK:
         __power_state = state
-        _BACKLIGHT.power_value = state.value
+        _get_backlight().power_value = state.value
 
 
 def turn_screen_on():
@@ -192,8 +432,8 @@ def turn_screen_on():
         return
     with _BACKLIGHT_LOCK:
         __power_state = Brightness.ON
-        _BACKLIGHT.power_value = Brightness.ON.value
-        if _THREAD_AUTO_BRIGHTNESS.is_alive() is True and _THREAD_SCREEN_OFF_EVENT.is_set() is False:
+        _get_backlight().power_value = Brightness.ON.value
+        if auto_brightness_running() is True and _THREAD_SCREEN_OFF_EVENT.is_set() is False:
             # Wake brightness thread if it is alive and waiting on the event.
             _THREAD_SCREEN_OFF_EVENT.set()
 
@@ -205,21 +445,77 @@ def turn_screen_off():
         return
     with _BACKLIGHT_LOCK:
         __power_state = Brightness.OFF
-        _BACKLIGHT.power_value = Brightness.OFF.value
+        _get_backlight().power_value = Brightness.OFF.value
     piosk.motion.wake_motion_sensor()
 
 
 __manual_step_index: int = 0
-__manual_steps: list[int] = CONFIG['brightness']['MANUAL_STEPS']
 
 
 def set_next_manual_step(smooth: bool = False):
     global __manual_step_index
+    settings = get_config().brightness
     with _BACKLIGHT_LOCK:
         __manual_step_index += 1
-        if __manual_step_index >= len(__manual_steps):
+        if __manual_step_index >= len(settings.manual_steps):
             __manual_step_index = 0
-        if smooth is True:
-            _BACKLIGHT.set_brightness_smoothed(__manual_steps[__manual_step_index], LinearInOut)
-        else:
-            _BACKLIGHT.brightness_value = __manual_steps[__manual_step_index]
+        value = settings.manual_steps[__manual_step_index]
+    piosk.state.update(manual_step_index=__manual_step_index)
+    set_manual_brightness(value, smooth)
+    if settings.auto_calibrate is True:
+        _calibrate(value)
+
+
+def restore_state():
+    """
+    Seed the cached brightness and power state from the backlight itself, so nothing is rewritten at startup, and
+    resume the manual step cycle where the last run left it. The saved step is only trusted if the backlight is still
+    at the brightness that was saved with it; otherwise the step nearest the current brightness is used.
+    """
+    global __power_state, __manual_step_index
+    saved = piosk.state.load()
+    with _BACKLIGHT_LOCK:
+        backlight = _get_backlight()
+        brightness = backlight.brightness_value
+        __power_state = backlight.power_value
+    steps = get_config().brightness.manual_steps
+    index = saved.get('manual_step_index')
+    if not isinstance(index, int) or not 0 <= index < len(steps) or saved.get('brightness') != brightness:
+        index = min(range(len(steps)), key=lambda i: abs(steps[i] - brightness))
+    __manual_step_index = index
+    power = 'on' if __power_state == Brightness.ON else 'off'
+    if 'power' in saved and saved['power'] != power:
+        log('Backlight power is %s, but was saved as %s.', power, saved['power'])
+    log('Restored backlight state: brightness %d, power %s, manual step %d.', brightness, power, index)
+    piosk.state.update(brightness=brightness, power=power, manual_step_index=index)
+
+
+def _calibrate(value: int):
+    """
+    Record the ambient light level the user chose `value` for, and refit the calibrated curve.
+    """
+    thread = _THREAD_AUTO_BRIGHTNESS if auto_brightness_running() else None
+    if thread is not None and thread.controller.last_reading is not None:
+        sensor_reading = thread.controller.last_reading
+    else:
+        sensor_reading = _get_light_sensor().value
+    record_calibration(sensor_reading, value)
+    if thread is not None:
+        thread.controller.override(value, time.monotonic())
+        if get_config().brightness.auto_curve == 'calibrated':
+            thread.controller.set_curve(get_brightness_curve())
+
+
+def _on_brightness_config(settings: BrightnessSettings):
+    thread = _THREAD_AUTO_BRIGHTNESS if auto_brightness_running() else None
+    if thread is not None:
+        thread.reconfigure(settings)
+    if settings.auto_enabled and thread is None:
+        log('Auto brightness enabled by config reload.')
+        start_auto_brightness()
+    elif not settings.auto_enabled and thread is not None:
+        log('Auto brightness disabled by config reload.')
+        stop_auto_brightness()
+
+
+subscribe('brightness', _on_brightness_config)
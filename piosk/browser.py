@@ -0,0 +1,610 @@
+import atexit
+import os
+import select
+import shlex
+import signal
+import subprocess
+import time
+from pathlib import Path
+from threading import Lock, Thread
+
+try:
+    from Xlib import X, display as xdisplay, error as xerror
+    from Xlib.ext import damage as xdamage
+except ImportError:
+    X = xdisplay = xerror = xdamage = None
+
+import piosk.metrics
+import piosk.runtime
+from piosk.config import CONFIG, BrowserSettings, get_config, subscribe
+from piosk.runtime import DeadlineTimer
+from piosk.util import debug, log, warning
+
+_PROC_ROOT = Path('/proc')
+_CGROUP_ROOT = Path('/sys/fs/cgroup')
+_PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+# How long the browser gets to exit after SIGTERM before it is killed.
+_EXIT_TIMEOUT = 5.0
+
+_FREEZES = piosk.metrics.counter('piosk_browser_freezes_total', 'Times the browser was frozen.', ('method',))
+_PAINT_LATENCY = piosk.metrics.histogram(
+    'piosk_browser_thaw_to_paint_seconds', "Time from thawing the browser to its first paint.",
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+_RESTARTS = piosk.metrics.counter('piosk_browser_restarts_total', 'Times the browser was restarted.')
+
+
+def _read_stat(pid: int) -> tuple[str, str, int, int, int] | None:
+    """
+    :return: The process's name, state, parent pid, CPU time and start time (both in clock ticks), or None if it has
+            exited. The pid and start time together identify a process even after its pid is reused.
+    """
+    try:
+        data = (_PROC_ROOT / str(pid) / 'stat').read_bytes()
+    except OSError:
+        return None
+    # The name may contain spaces and parentheses, so split around the last ')'.
+    end = data.rindex(b')')
+    name = data[data.index(b'(') + 1:end].decode(errors='replace')
+    fields = data[end + 2:].split()
+    return name, fields[0].decode(), int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[19])
+
+
+def read_memory(pid: int) -> tuple[int, int] | None:
+    """
+    :return: The process's proportional set size and resident set size in kB, or None if it has exited. When
+            smaps_rollup can't be read, both are the resident set size from statm.
+    """
+    process = _PROC_ROOT / str(pid)
+    try:
+        pss = rss = None
+        with (process / 'smaps_rollup').open('rb') as f:
+            for line in f:
+                if line.startswith(b'Rss:'):
+                    rss = int(line.split()[1])
+                elif line.startswith(b'Pss:'):
+                    pss = int(line.split()[1])
+                    break
+        if pss is not None and rss is not None:
+            return pss, rss
+    except (PermissionError, FileNotFoundError):
+        # Older kernels have no smaps_rollup, and it needs the same access as ptrace. statm is always readable.
+        pass
+    except OSError:
+        return None
+    try:
+        rss = int((process / 'statm').read_text().split()[1]) * _PAGE_KB
+    except (OSError, IndexError, ValueError):
+        return None
+    return rss, rss
+
+
+class ProcessTracker:
+    """
+    Keeps track of the browser's process tree. Each refresh lists /proc, but only reads the stat of processes that
+    appeared since the last one, so it stays cheap enough to poll. A pid can be reused between refreshes without ever
+    being seen to exit, so the processes in the returned tree are always checked against their recorded start times.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._processes: dict[int, tuple[str, int, int]] = {}
+        self._new: set[int] = set()
+        self.roots: list[int] = []
+
+    def refresh(self, process_name: str) -> list[int]:
+        """
+        :param process_name: Prefix of the browser's process name.
+        :return: The pids of the browser's process tree, with parents before their children.
+        """
+        with self._lock:
+            pids = {int(entry.name) for entry in os.scandir(_PROC_ROOT) if entry.name.isdigit()}
+            for pid in self._processes.keys() - pids:
+                del self._processes[pid]
+            appeared = pids - self._processes.keys()
+            # Processes first seen last time are read again, in case they were caught between fork and exec.
+            self._read(appeared | (self._new & pids))
+            self._new = appeared
+            checked: set[int] = set()
+            while True:
+                tree = self._build(process_name)
+                unchecked = [pid for pid in tree if pid not in checked]
+                if not unchecked:
+                    return tree
+                checked.update(unchecked)
+                reused = [pid for pid in unchecked if self.start_time(pid) != _start_time(pid)]
+                if not reused:
+                    return tree
+                self._read(reused)
+
+    def start_time(self, pid: int) -> int | None:
+        entry = self._processes.get(pid)
+        return entry[2] if entry is not None else None
+
+    def _read(self, pids):
+        # Must be called with _lock held.
+        for pid in pids:
+            stat = _read_stat(pid)
+            if stat is None:
+                self._processes.pop(pid, None)
+            else:
+                self._processes[pid] = (stat[0], stat[2], stat[4])
+
+    def _build(self, process_name: str) -> list[int]:
+        # Must be called with _lock held.
+        processes = self._processes
+        children: dict[int, list[int]] = {}
+        for pid, (_, ppid, _) in processes.items():
+            children.setdefault(ppid, []).append(pid)
+
+        def is_browser(pid: int) -> bool:
+            return pid in processes and processes[pid][0].startswith(process_name)
+
+        self.roots = sorted(pid for pid in processes if is_browser(pid) and not is_browser(processes[pid][1]))
+        tree = list(self.roots)
+        for pid in tree:
+            # The list grows as it is walked, so every descendant is visited.
+            tree.extend(sorted(children.get(pid, ())))
+        return tree
+
+
+def _start_time(pid: int) -> int | None:
+    stat = _read_stat(pid)
+    return stat[4] if stat is not None else None
+
+
+def _cpu_ticks(pids: list[int]) -> int:
+    return sum(stat[3] for stat in map(_read_stat, pids) if stat is not None)
+
+
+def _browser_cgroup(pids: list[int]) -> Path | None:
+    """
+    :return: The browser's cgroup v2 directory, if the browser has one to itself.
+    """
+    try:
+        lines = (_PROC_ROOT / str(pids[0]) / 'cgroup').read_text().splitlines()
+        relative = next(line[3:] for line in lines if line.startswith('0::')).strip('/')
+        if not relative:
+            return None
+        # Hybrid hierarchies mount cgroup v2 under `unified`.
+        root = _CGROUP_ROOT if (_CGROUP_ROOT / 'cgroup.controllers').exists() else _CGROUP_ROOT / 'unified'
+        path = root / relative
+        members = {int(pid) for pid in (path / 'cgroup.procs').read_text().split()}
+    except (OSError, StopIteration, ValueError):
+        return None
+    if not (path / 'cgroup.freeze').exists() or not members <= set(pids):
+        return None
+    return path
+
+
+def _signal(pids: list[int], signum: int):
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+class Freezer:
+    name = 'none'
+
+    def freeze(self, pids: list[int]):
+        raise NotImplementedError
+
+    def thaw(self, pids: list[int]):
+        raise NotImplementedError
+
+
+class SignalFreezer(Freezer):
+    """
+    Stops each process with SIGSTOP. Parents are stopped before their children, so they can't react to a stopped child,
+    and continued after them.
+    """
+    name = 'signal'
+
+    def freeze(self, pids: list[int]):
+        _signal(pids, signal.SIGSTOP)
+
+    def thaw(self, pids: list[int]):
+        _signal(pids[::-1], signal.SIGCONT)
+
+
+class CgroupFreezer(Freezer):
+    """
+    Freezes the browser's cgroup with the cgroup v2 freezer. Processes are frozen without being signalled, so nothing
+    in the browser can tell, and children forked while freezing are caught too.
+    """
+    name = 'cgroup'
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def _write(self, value: str):
+        (self._path / 'cgroup.freeze').write_text(value)
+
+    def freeze(self, pids: list[int]):
+        self._write('1')
+
+    def thaw(self, pids: list[int]):
+        self._write('0')
+
+
+class PaintProbe:
+    """
+    Times how long the browser takes to paint after being thawed. When python-xlib is installed, this is the first
+    damage to the browser's window, found through its _NET_WM_PID. Otherwise it falls back to the first CPU time the
+    process tree uses, which is when rendering could start at the earliest.
+
+    Create the probe just before thawing and call wait() from another thread. The X connection is only opened in
+    wait(), so a slow X server never holds up the thaw. A paint that lands before the connection is made is missed,
+    and the next one is timed instead.
+    """
+
+    def __init__(self, pids: list[int]):
+        self._pids = pids
+        self._ticks = _cpu_ticks(pids)
+        self._display = None
+        self.method = 'cpu'
+
+    def _watch_window(self, display_name: str):
+        disp = xdisplay.Display(display_name)
+        if disp.has_extension('DAMAGE'):
+            disp.damage_query_version()
+            root = disp.screen().root
+            clients = root.get_full_property(disp.intern_atom('_NET_CLIENT_LIST'), X.AnyPropertyType)
+            pid_atom = disp.intern_atom('_NET_WM_PID')
+            for window_id in clients.value if clients is not None else ():
+                window = disp.create_resource_object('window', window_id)
+                pid = window.get_full_property(pid_atom, X.AnyPropertyType)
+                if pid is not None and pid.value[0] in self._pids:
+                    window.damage_create(xdamage.DamageReportNonEmpty)
+                    disp.sync()
+                    return disp
+        disp.close()
+        return None
+
+    def wait(self, thawed_at: float, timeout: float, display_name: str) -> float | None:
+        """
+        :return: Seconds from `thawed_at` to the first paint, or None if there wasn't one within `timeout` seconds.
+        """
+        deadline = thawed_at + timeout
+        try:
+            if xdamage is not None:
+                try:
+                    self._display = self._watch_window(display_name)
+                except (xerror.DisplayError, xerror.XError, ConnectionError) as e:
+                    debug('Could not watch the browser window for paints: %s', e)
+            if self._display is not None:
+                self.method = 'paint'
+            while time.monotonic() < deadline:
+                if self._display is not None:
+                    while self._display.pending_events():
+                        if isinstance(self._display.next_event(), xdamage.DamageNotify):
+                            return time.monotonic() - thawed_at
+                    select.select([self._display], [], [], max(0.0, deadline - time.monotonic()))
+                else:
+                    if _cpu_ticks(self._pids) > self._ticks:
+                        return time.monotonic() - thawed_at
+                    time.sleep(0.005)
+            return None
+        finally:
+            self.close()
+
+    def close(self):
+        if self._display is not None:
+            self._display.close()
+            self._display = None
+
+
+class BrowserSupervisor:
+    """
+    Freezes the kiosk browser while the screen is blanked and thaws it when the screen wakes. Freezing waits out
+    FREEZE_DELAY_SECONDS on a DeadlineTimer, so a screen that wakes again quickly never touches the browser. Thawing
+    happens as soon as the screen starts to wake, and the time until the browser paints again is measured on a separate
+    thread.
+
+    Restarts requested by the memory watchdog are held until the backlight is off. The new browser then gets
+    RESTART_WARM_SECONDS to load the page before it is frozen, so it is ready by the time anyone looks at it. There is
+    at most one restart per screen-off period, so a limit set too low can't keep the browser restarting.
+    """
+
+    def __init__(self, settings: BrowserSettings):
+        self._settings = settings
+        self._lock = Lock()
+        self._timer = DeadlineTimer(self._on_deadline, 'piosk-browser')
+        self._tracker = ProcessTracker()
+        self._deadline: float | None = None
+        self._freezer: Freezer | None = None
+        self._pids: list[int] = []
+        self._screen_off: bool = False
+        self._restart_pending: bool = False
+        self._restarting: bool = False
+        self._restarted_while_off: bool = False
+        self._process: subprocess.Popen | None = None
+        self.freezes: int = 0
+        self.restarts: int = 0
+        self.last_paint_latency: float | None = None
+        self.max_paint_latency: float = 0.0
+        self.paint_method: str | None = None
+
+    @property
+    def frozen(self) -> bool:
+        return self._freezer is not None
+
+    @property
+    def restart_pending(self) -> bool:
+        return self._restart_pending or self._restarting
+
+    def browser_pids(self) -> list[int]:
+        """
+        :return: The pids of the browser's process tree, with parents before their children.
+        """
+        return self._tracker.refresh(self._settings.process_name)
+
+    def configure(self, settings: BrowserSettings):
+        with self._lock:
+            self._settings = settings
+            if not settings.freeze and self._deadline is not None:
+                self._deadline = None
+                self._timer.cancel()
+
+    def screen_blanked(self):
+        with self._lock:
+            if not self._settings.freeze or self._freezer is not None or self._deadline is not None:
+                return
+            self._schedule_freeze(self._settings.freeze_delay_seconds)
+
+    def screen_off(self):
+        """
+        Call once the backlight is off. Starts any restart that was waiting for it.
+        """
+        with self._lock:
+            self._screen_off = True
+            self._start_pending_restart()
+
+    def screen_unblanked(self):
+        with self._lock:
+            self._screen_off = False
+            self._restarted_while_off = False
+            self._deadline = None
+            self._timer.cancel()
+            self._thaw()
+
+    def request_restart(self, reason: str):
+        """
+        Restart the browser the next time the backlight is off, or now if it already is.
+
+        :param reason: Logged with the request.
+        """
+        with self._lock:
+            if self.restart_pending:
+                return
+            if not self._settings.restart_cmd:
+                warning('Not restarting the browser (%s): [browser] RESTART_CMD is not set.', reason)
+                return
+            log('Restarting the browser once the screen is off: %s', reason)
+            self._restart_pending = True
+            self._start_pending_restart()
+
+    def _schedule_freeze(self, delay: float):
+        # Must be called with _lock held.
+        self._deadline = time.monotonic() + delay
+        self._timer.schedule(self._deadline)
+
+    def _on_deadline(self, deadline: float):
+        if piosk.runtime.is_active():
+            # Finding the browser reads /proc, so keep it off the event loop.
+            piosk.runtime.get_loop().run_in_executor(None, self._freeze, deadline)
+        else:
+            self._freeze(deadline)
+
+    def _select_freezer(self, pids: list[int]) -> Freezer:
+        method = self._settings.freeze_method
+        if method != 'signal':
+            cgroup = _browser_cgroup(pids)
+            if cgroup is not None:
+                return CgroupFreezer(cgroup)
+            if method == 'cgroup':
+                warning('The browser does not have a cgroup of its own. Freezing it with signals instead.')
+        return SignalFreezer()
+
+    def _freeze(self, deadline: float):
+        with self._lock:
+            # The screen may have woken just as the timer fired.
+            if deadline != self._deadline or self._restarting:
+                return
+            self._deadline = None
+            pids = self.browser_pids()
+            if not pids:
+                debug('No browser processes to freeze.')
+                return
+            freezer = self._select_freezer(pids)
+            try:
+                freezer.freeze(pids)
+                # Catch any children forked while the tree was being stopped.
+                for _ in range(3):
+                    latest = self.browser_pids()
+                    forked = [pid for pid in latest if pid not in pids]
+                    pids = latest
+                    if not forked:
+                        break
+                    freezer.freeze(forked)
+            except OSError as e:
+                warning('Could not freeze the browser: %s', e)
+                freezer.thaw(pids)
+                return
+            self._freezer, self._pids = freezer, pids
+            self.freezes += 1
+            _FREEZES.inc(freezer.name)
+        log('Froze %d browser processes with %s.', len(pids), freezer.name)
+
+    def _thaw(self, measure: bool = True):
+        # Must be called with _lock held.
+        if self._freezer is None:
+            return
+        probe = PaintProbe(self._pids) if measure else None
+        thawed_at = time.monotonic()
+        try:
+            self._freezer.thaw(self._pids)
+        except OSError as e:
+            warning('Could not thaw the browser: %s', e)
+        self._freezer, self._pids = None, []
+        if probe is not None:
+            Thread(target=self._measure_paint, args=(probe, thawed_at), name='piosk-browser-paint', daemon=True).start()
+
+    def _measure_paint(self, probe: PaintProbe, thawed_at: float):
+        latency = probe.wait(thawed_at, self._settings.paint_timeout_seconds, CONFIG['screensaver']['DISPLAY'])
+        if latency is None:
+            debug('The browser did not paint within %.1f seconds of thawing.', self._settings.paint_timeout_seconds)
+            return
+        self.last_paint_latency = latency
+        self.max_paint_latency = max(self.max_paint_latency, latency)
+        self.paint_method = probe.method
+        _PAINT_LATENCY.observe(latency)
+        log('Browser %s %.1f ms after thawing.', 'painted' if probe.method == 'paint' else 'resumed', latency * 1000)
+
+    def _start_pending_restart(self):
+        # Must be called with _lock held.
+        if self._restart_pending and self._screen_off and not self._restarting and not self._restarted_while_off:
+            self._restart_pending = False
+            self._restarting = True
+            self._restarted_while_off = True
+            # Waiting for the old browser to exit can take seconds, so it never happens on the caller's thread.
+            Thread(target=self._restart, name='piosk-browser-restart', daemon=True).start()
+
+    def _restart(self):
+        with self._lock:
+            self._deadline = None
+            self._timer.cancel()
+            # Signals sent to a frozen process are only delivered once it is thawed.
+            self._thaw(measure=False)
+            identities = {pid: self._tracker.start_time(pid) for pid in self.browser_pids()}
+            roots = self._tracker.roots
+        process = None
+        try:
+            self._terminate(roots, identities)
+            process = self._launch()
+        finally:
+            with self._lock:
+                self._restarting = False
+                if process is not None:
+                    self._process = process
+                    self.restarts += 1
+                    _RESTARTS.inc()
+                    # A freeze that came due during the restart was skipped, so it is rescheduled here too.
+                    if self._settings.freeze and (self._screen_off or self._deadline is not None):
+                        self._schedule_freeze(self._settings.restart_warm_seconds)
+        if process is not None:
+            log('Restarted the browser.')
+
+    def _terminate(self, roots: list[int], identities: dict[int, int]):
+        """
+        :param roots: The browser's top processes.
+        :param identities: Start time of each process in the browser's tree, by pid. A pid whose process has a different
+                start time has been reused since, and is left alone.
+        """
+        # Only the top processes are asked to quit at first, so the browser can shut its own children down cleanly.
+        _signal(roots, signal.SIGTERM)
+        orphans_signalled = False
+        deadline = time.monotonic() + _EXIT_TIMEOUT
+        while True:
+            if self._process is not None:
+                # Reap a browser started by an earlier restart, so it doesn't linger as a zombie.
+                self._process.poll()
+            running = []
+            for pid, started in identities.items():
+                stat = _read_stat(pid)
+                if stat is not None and stat[1] != 'Z' and stat[4] == started:
+                    running.append(pid)
+            if not running:
+                return
+            if time.monotonic() >= deadline:
+                break
+            if not orphans_signalled and not set(roots) & set(running):
+                # Children that outlive the browser are asked directly.
+                _signal(running, signal.SIGTERM)
+                orphans_signalled = True
+            time.sleep(0.1)
+        warning('The browser did not exit within %.0f seconds. Killing %d processes.', _EXIT_TIMEOUT, len(running))
+        _signal(running, signal.SIGKILL)
+
+    def _launch(self) -> subprocess.Popen | None:
+        command = self._settings.restart_cmd
+        env = dict(os.environ)
+        env.setdefault('DISPLAY', CONFIG['screensaver']['DISPLAY'])
+        try:
+            # A session of its own keeps the browser running if piosk is restarted.
+            return subprocess.Popen(shlex.split(command), env=env, start_new_session=True,
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            warning('Could not start the browser with `%s`: %s', command, e)
+            return None
+
+    def recover(self):
+        """
+        Thaw a browser left frozen by a previous run that was killed before it could thaw it.
+        """
+        with self._lock:
+            if self._freezer is not None:
+                return
+            pids = self.browser_pids()
+            if not pids:
+                return
+            cgroup = _browser_cgroup(pids)
+            try:
+                if cgroup is not None and (cgroup / 'cgroup.freeze').read_text().strip() == '1':
+                    CgroupFreezer(cgroup).thaw(pids)
+                    log('Thawed a browser cgroup left frozen.')
+                states = {pid: _read_stat(pid) for pid in pids}
+                stopped = [pid for pid, stat in states.items() if stat is not None and stat[1] == 'T']
+                if stopped:
+                    SignalFreezer().thaw(stopped)
+                    log('Continued %d browser processes left stopped.', len(stopped))
+            except OSError as e:
+                warning('Could not thaw the browser: %s', e)
+
+
+_SUPERVISOR: BrowserSupervisor | None = None
+_SUPERVISOR_LOCK = Lock()
+
+
+def get_supervisor() -> BrowserSupervisor:
+    global _SUPERVISOR
+    with _SUPERVISOR_LOCK:
+        if _SUPERVISOR is None:
+            _SUPERVISOR = BrowserSupervisor(get_config().browser)
+        return _SUPERVISOR
+
+
+def _on_browser_config(settings: BrowserSettings):
+    if _SUPERVISOR is not None:
+        _SUPERVISOR.configure(settings)
+
+
+subscribe('browser', _on_browser_config)
+
+
+def _thaw_at_exit():
+    # A browser left frozen would leave the kiosk dead once the screen wakes.
+    if _SUPERVISOR is not None:
+        _SUPERVISOR.screen_unblanked()
+
+
+atexit.register(_thaw_at_exit)
+
+
+def browser_stats() -> dict[str, float | int | str | None]:
+    """
+    :return: Freeze and restart counts, and latency from thawing the browser to its first paint.
+    """
+    if _SUPERVISOR is None:
+        return {}
+    return {
+        'freezes': _SUPERVISOR.freezes,
+        'frozen': _SUPERVISOR.frozen,
+        'restarts': _SUPERVISOR.restarts,
+        'restart_pending': _SUPERVISOR.restart_pending,
+        'last_paint_latency': _SUPERVISOR.last_paint_latency,
+        'max_paint_latency': _SUPERVISOR.max_paint_latency,
+        'paint_method': _SUPERVISOR.paint_method,
+    }
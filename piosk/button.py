@@ -1,57 +1,107 @@
 import time
-from threading import Event
+from functools import lru_cache
+from typing import Callable
 
 from easing_functions import ExponentialEaseIn
 from gpiozero import Button
 
+import piosk.brightness
+import piosk.hardware
+import piosk.metrics
+import piosk.runtime
 import piosk.screensaver
-from piosk.brightness import set_next_manual_step
-from piosk.config import CONFIG
+import piosk.shutdown
+from piosk.config import CONFIG, ButtonSettings, get_config, subscribe
+from piosk.gestures import Gesture, GestureRecognizer
 from piosk.led import LedInstructionProvidingThread, BlinkSequenceEvent
+from piosk.runtime import LoopEvent
+from piosk.util import log, timed
+
+_GESTURES = piosk.metrics.counter('piosk_button_gestures_total', 'Button gestures recognized.', ('gesture',))
+_ACTION_LATENCY = piosk.metrics.histogram(
+    'piosk_button_action_latency_seconds', 'Time from a gesture being recognized to its action starting.',
+    (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.04, 0.1)
+)
+
+
+def _next_step():
+    piosk.brightness.set_next_manual_step(get_config().brightness.smooth)
+
+
+def _toggle_auto_brightness():
+    if piosk.brightness.auto_brightness_running():
+        log('Switching to manual brightness.')
+        piosk.brightness.stop_auto_brightness()
+    else:
+        log('Switching to auto brightness.')
+        piosk.brightness.start_auto_brightness()
+
+
+_ACTIONS: dict[str, Callable[[], object]] = {
+    'none': lambda: None,
+    'next_step': _next_step,
+    'toggle_auto_brightness': _toggle_auto_brightness,
+    'activate_screensaver': piosk.screensaver.activate_screensaver,
+    'shutdown_menu': piosk.shutdown.open_shutdown_menu,
+}
+
+
+@lru_cache(maxsize=4)
+def _hold_strobe(min_hold_time: float, strobe_count: int) -> tuple[BlinkSequenceEvent, ...]:
+    """
+    :return: The LED sequence shown while the button is held. It fades in until one second into the hold, then strobes
+            once per second.
+    """
+    events = (BlinkSequenceEvent(1, 0, max(0.0, 1.0 - min_hold_time), easing=ExponentialEaseIn),)
+    reset = BlinkSequenceEvent(0)
+    strobe = BlinkSequenceEvent(1, 0, 1, easing=ExponentialEaseIn)
+    return events + (reset, strobe) * strobe_count
 
 
 class ButtonThread(LedInstructionProvidingThread):
 
     def __init__(self):
         super(ButtonThread, self).__init__()
-        self._event = Event()
-        self._gpio_button = Button(CONFIG['PIN_BUTTON'])
-        self._gpio_button.hold_time = CONFIG['button']['MIN_HOLD_TIME_SECONDS']
-        self._hold_start: float | None = None
+        self._event = LoopEvent()
+        with timed('init button'):
+            self._gpio_button = Button(CONFIG['PIN_BUTTON'], pin_factory=piosk.hardware.pin_factory())
+        self._recognizer = GestureRecognizer(get_config().button, self._on_gesture, self._on_hold_start)
         self._woke_up: bool = False
+        self.last_action_latency: float | None = None
+        self.max_action_latency: float = 0.0
 
-        def when_pressed():
+        def when_pressed(pressed_at: float):
             self._led_on()
-            self._woke_up = piosk.screensaver.poke_screensaver()
-
-        self._gpio_button.when_pressed = when_pressed
-
-        def when_held():
-            self._hold_start = time.time()
-            # Begin LED strobe
-            events = (BlinkSequenceEvent(1, 0, (1.0 - self._gpio_button.held_time), easing=ExponentialEaseIn),)
-            reset = BlinkSequenceEvent(0)
-            strobe = BlinkSequenceEvent(1, 0, 1, easing=ExponentialEaseIn)
-            for i in range(0, int(round((CONFIG['button']['MAX_HOLD_TIME_SECONDS'] - 1)))):
-                events += (reset, strobe)
-            self._led_sequence(events, 0)
+            # Kept until the gesture this press belongs to is reported, however many presses that takes.
+            self._woke_up = piosk.screensaver.poke_screensaver() or self._woke_up
+            self._recognizer.press(pressed_at)
 
-        self._gpio_button.when_held = when_held
-
-        def when_released():
+        def when_released(released_at: float):
             self._led_off()
-            if self._hold_start is None:
-                if not self._woke_up:
-                    set_next_manual_step(CONFIG['brightness']['SMOOTH'])
-            else:
-                time_held = time.time() - self._hold_start
-                self._hold_start = None
-                if time_held < CONFIG['button']['MAX_HOLD_TIME_SECONDS']:
-                    print('TODO: Switch between auto and manual brightness modes.')
-                else:
-                    print(f"TODO: EXECUTE `{CONFIG['shutdown']['SCRIPT_CMD']}`")
-
-        self._gpio_button.when_released = when_released
+            self._recognizer.release(released_at)
+
+        # Edges are timestamped on gpiozero's thread, before any hop to the event loop.
+        self._gpio_button.when_pressed = lambda: piosk.runtime.call_soon(when_pressed, time.monotonic())
+        self._gpio_button.when_released = lambda: piosk.runtime.call_soon(when_released, time.monotonic())
+
+    def reconfigure(self, settings: ButtonSettings):
+        self._recognizer.configure(settings)
+
+    def _on_hold_start(self):
+        settings = get_config().button
+        self._led_sequence(_hold_strobe(settings.min_hold_time_seconds, settings.strobe_count), 0)
+
+    def _on_gesture(self, gesture: Gesture, recognized_at: float):
+        _GESTURES.inc(gesture.value)
+        woke_up, self._woke_up = self._woke_up, False
+        if woke_up:
+            # The gesture that woke the screen shouldn't also change it.
+            return
+        action = getattr(get_config().button, f'action_{gesture.value}')
+        self.last_action_latency = time.monotonic() - recognized_at
+        self.max_action_latency = max(self.max_action_latency, self.last_action_latency)
+        _ACTION_LATENCY.observe(self.last_action_latency)
+        _ACTIONS[action]()
 
     def stop(self):
         self._event.set()
@@ -60,14 +110,47 @@ class ButtonThread(LedInstructionProvidingThread):
         # Keep thread alive for button callbacks.
         self._event.wait()
 
+    async def run_async(self):
+        """
+        Coroutine equivalent of run() for the asyncio runtime. Button callbacks are dispatched onto the event loop.
+        """
+        await self._event.wait_async()
+
+
+_BUTTON_THREAD: ButtonThread | None = None
+
+
+def _on_button_config(settings: ButtonSettings):
+    if _BUTTON_THREAD is not None:
+        _BUTTON_THREAD.reconfigure(settings)
+
 
-_BUTTON_THREAD: ButtonThread
+subscribe('button', _on_button_config)
+
+
+def button_stats() -> dict[str, float | None]:
+    """
+    :return: Latency from a gesture being recognized to its action starting.
+    """
+    if _BUTTON_THREAD is None:
+        return {}
+    return {
+        'last_action_latency': _BUTTON_THREAD.last_action_latency,
+        'max_action_latency': _BUTTON_THREAD.max_action_latency,
+    }
 
 
 def start_button_thread():
+    global _BUTTON_THREAD
     _BUTTON_THREAD = ButtonThread()
     _BUTTON_THREAD.start()
 
 
+async def run_button_async():
+    global _BUTTON_THREAD
+    _BUTTON_THREAD = ButtonThread()
+    await _BUTTON_THREAD.run_async()
+
+
 def join_button_thread():
     _BUTTON_THREAD.join()
@@ -2,13 +2,268 @@
 # TODO: Generate default config values if it doesn't exist?
 # TODO: Combine with argparse?
 import sys
+from dataclasses import dataclass, field, fields
 from pathlib import Path
+from threading import Lock
+from typing import Callable
 
 import tomli
 
+CONFIG_PATH = Path(__file__).parent.parent / 'config.toml'
+
+
+def _read_config() -> dict:
+    with CONFIG_PATH.open('rb') as f:
+        return tomli.load(f)
+
+
 try:
-    with (Path(__file__).parent.parent / 'config.toml').open('rb') as f:
-        CONFIG = tomli.load(f)
+    CONFIG = _read_config()
 except tomli.TOMLDecodeError as e:
     sys.exit(f'Error importing config file: {e}')
 
+
+class ConfigError(ValueError):
+    pass
+
+
+def _coerce(section: str, key: str, value, kind):
+    if kind is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if kind is tuple and isinstance(value, list):
+        return tuple(tuple(item) if isinstance(item, list) else item for item in value)
+    if isinstance(value, kind) and (kind is bool or not isinstance(value, bool)):
+        return value
+    raise ConfigError(f'[{section}] {key} must be a {kind.__name__}, not {value!r}.')
+
+
+def _load_section(cls, raw: dict):
+    """
+    Build a settings object from a config section. Each init field is read from the key of the same name in upper
+    case, and derived fields are computed by the class.
+    """
+    section = raw.get(cls.SECTION, {})
+    values = {}
+    for f in fields(cls):
+        if not f.init:
+            continue
+        key = f.name.upper()
+        if key not in section:
+            raise ConfigError(f'[{cls.SECTION}] {key} is missing.')
+        values[f.name] = _coerce(cls.SECTION, key, section[key], f.type)
+    return cls(**values)
+
+
+def _check(condition: bool, message: str):
+    if not condition:
+        raise ConfigError(message)
+
+
+@dataclass(frozen=True, slots=True)
+class BrightnessSettings:
+    SECTION = 'brightness'
+    poll_time_seconds: float
+    poll_max_seconds: float
+    poll_backoff: float
+    smooth: bool
+    smooth_duration_seconds: float
+    smooth_fps: int
+    auto_enabled: bool
+    auto_minimum: int
+    auto_maximum: int
+    auto_step_count: int
+    auto_curve: str
+    auto_curve_gamma: float
+    auto_curve_log_scale: float
+    auto_curve_points: tuple
+    auto_curve_resolution: int
+    auto_calibrate: bool
+    auto_filter: str
+    auto_filter_alpha: float
+    auto_filter_window: int
+    auto_hysteresis_steps: float
+    auto_min_dwell_seconds: float
+    manual_steps: tuple
+    # Derived values.
+    smooth_delay: float = field(init=False)
+    smooth_frame_count: int = field(init=False)
+    auto_step: float = field(init=False)
+
+    def __post_init__(self):
+        _check(self.smooth_fps > 0, '[brightness] SMOOTH_FPS must be positive.')
+        _check(self.auto_step_count > 0, '[brightness] AUTO_STEP_COUNT must be positive.')
+        _check(0 <= self.auto_minimum <= self.auto_maximum <= 255,
+               '[brightness] AUTO_MINIMUM and AUTO_MAXIMUM must satisfy 0 <= minimum <= maximum <= 255.')
+        _check(len(self.manual_steps) > 0 and all(isinstance(s, int) and 0 <= s <= 255 for s in self.manual_steps),
+               '[brightness] MANUAL_STEPS must be a non-empty list of brightness values from 0 to 255.')
+        _check(self.auto_filter in ('ema', 'median'), "[brightness] AUTO_FILTER must be 'ema' or 'median'.")
+        _check(self.auto_curve in ('linear', 'gamma', 'log', 'points', 'calibrated'),
+               "[brightness] AUTO_CURVE must be 'linear', 'gamma', 'log', 'points' or 'calibrated'.")
+        object.__setattr__(self, 'smooth_delay', self.smooth_duration_seconds / self.smooth_fps)
+        object.__setattr__(self, 'smooth_frame_count', int(round(self.smooth_duration_seconds * self.smooth_fps)))
+        object.__setattr__(self, 'auto_step', (self.auto_maximum - self.auto_minimum) / self.auto_step_count)
+
+
+BUTTON_ACTIONS = ('none', 'next_step', 'toggle_auto_brightness', 'activate_screensaver', 'shutdown_menu')
+
+
+@dataclass(frozen=True, slots=True)
+class ButtonSettings:
+    SECTION = 'button'
+    min_hold_time_seconds: float
+    max_hold_time_seconds: float
+    click_window_seconds: float
+    action_single_click: str
+    action_double_click: str
+    action_triple_click: str
+    action_short_hold: str
+    action_long_hold: str
+    # Derived values.
+    strobe_count: int = field(init=False)
+    max_clicks: int = field(init=False)
+
+    def __post_init__(self):
+        _check(0 < self.min_hold_time_seconds <= self.max_hold_time_seconds,
+               '[button] MIN_HOLD_TIME_SECONDS must be positive and no more than MAX_HOLD_TIME_SECONDS.')
+        _check(self.click_window_seconds > 0, '[button] CLICK_WINDOW_SECONDS must be positive.')
+        for name in ('single_click', 'double_click', 'triple_click', 'short_hold', 'long_hold'):
+            _check(getattr(self, f'action_{name}') in BUTTON_ACTIONS,
+                   f"[button] ACTION_{name.upper()} must be one of {', '.join(map(repr, BUTTON_ACTIONS))}.")
+        # The hold strobe fades in over the first second, then strobes once per second until the maximum hold time.
+        object.__setattr__(self, 'strobe_count', max(0, int(round(self.max_hold_time_seconds - 1))))
+        # A click only has to wait out the click window if more clicks could still change its meaning.
+        object.__setattr__(self, 'max_clicks', 3 if self.action_triple_click != 'none'
+                           else 2 if self.action_double_click != 'none' else 1)
+
+
+@dataclass(frozen=True, slots=True)
+class LedSettings:
+    SECTION = 'led'
+    led_max: float
+    led_min: float
+
+    def __post_init__(self):
+        _check(0 <= self.led_min <= self.led_max <= 1, '[led] LED_MIN and LED_MAX must satisfy 0 <= min <= max <= 1.')
+
+
+@dataclass(frozen=True, slots=True)
+class MotionSettings:
+    SECTION = 'motion'
+    wake_delay_seconds: float
+    sensor: str
+    queue_len: int
+    sample_rate: float
+
+    def __post_init__(self):
+        _check(self.sensor in ('edge', 'queue'), "[motion] SENSOR must be 'edge' or 'queue'.")
+
+
+@dataclass(frozen=True, slots=True)
+class ScreensaverSettings:
+    SECTION = 'screensaver'
+    poke_debounce_seconds: float
+    xscreensaver_file: str
+    power_off_margin_seconds: float
+
+    def __post_init__(self):
+        _check(self.power_off_margin_seconds >= 0, '[screensaver] POWER_OFF_MARGIN_SECONDS must not be negative.')
+
+
+@dataclass(frozen=True, slots=True)
+class ShutdownSettings:
+    SECTION = 'shutdown'
+    script_cmd: str
+    timeout: float
+
+
+@dataclass(frozen=True, slots=True)
+class BrowserSettings:
+    SECTION = 'browser'
+    process_name: str
+    freeze: bool
+    freeze_method: str
+    freeze_delay_seconds: float
+    paint_timeout_seconds: float
+    memory_limit_mb: float
+    memory_poll_seconds: float
+    restart_cmd: str
+    restart_warm_seconds: float
+
+    def __post_init__(self):
+        _check(len(self.process_name) > 0, '[browser] PROCESS_NAME must not be empty.')
+        _check(self.freeze_method in ('auto', 'cgroup', 'signal'),
+               "[browser] FREEZE_METHOD must be 'auto', 'cgroup' or 'signal'.")
+        _check(self.freeze_delay_seconds >= 0, '[browser] FREEZE_DELAY_SECONDS must not be negative.')
+        _check(self.memory_limit_mb >= 0, '[browser] MEMORY_LIMIT_MB must not be negative.')
+        _check(self.memory_poll_seconds > 0, '[browser] MEMORY_POLL_SECONDS must be positive.')
+        _check(self.restart_warm_seconds >= 0, '[browser] RESTART_WARM_SECONDS must not be negative.')
+
+
+@dataclass(frozen=True, slots=True)
+class ConfigSnapshot:
+    """
+    The settings that can change while piosk is running, validated and with derived values computed once. A snapshot is
+    never modified; reloading swaps in a new one.
+    """
+    brightness: BrightnessSettings
+    button: ButtonSettings
+    led: LedSettings
+    motion: MotionSettings
+    screensaver: ScreensaverSettings
+    shutdown: ShutdownSettings
+    browser: BrowserSettings
+
+
+def _compile(raw: dict) -> ConfigSnapshot:
+    return ConfigSnapshot(**{f.name: _load_section(f.type, raw) for f in fields(ConfigSnapshot)})
+
+
+try:
+    _SNAPSHOT = _compile(CONFIG)
+except ConfigError as e:
+    sys.exit(f'Error in config file: {e}')
+
+_SUBSCRIBERS: dict[str, list[Callable]] = {}
+_RELOAD_LOCK = Lock()
+
+
+def get_config() -> ConfigSnapshot:
+    """
+    :return: The current config snapshot. Hold on to the returned object to read a consistent set of values.
+    """
+    return _SNAPSHOT
+
+
+def subscribe(section: str, callback: Callable):
+    """
+    Call `callback` with the section's new settings object whenever a reload changes that section.
+    """
+    _SUBSCRIBERS.setdefault(section, []).append(callback)
+
+
+def reload() -> tuple[list[str], list[tuple[Callable, Exception]]]:
+    """
+    Re-read config.toml and swap in a new snapshot. Only the sections in ConfigSnapshot are reloaded; other settings,
+    such as pins and backends, still need a restart. If the file can't be parsed or fails validation, the current
+    snapshot is kept and the error is raised.
+
+    :return: The names of the sections that changed, and any (subscriber, exception) pairs from notifying subscribers.
+    """
+    global _SNAPSHOT
+    with _RELOAD_LOCK:
+        raw = _read_config()
+        snapshot = _compile(raw)
+        previous = _SNAPSHOT
+        changed = [f.name for f in fields(ConfigSnapshot) if getattr(snapshot, f.name) != getattr(previous, f.name)]
+        for name in changed:
+            # Replace whole section dicts, so readers of CONFIG never see a half-updated section.
+            CONFIG[name] = raw[name]
+        _SNAPSHOT = snapshot
+        errors = []
+        for name in changed:
+            for callback in _SUBSCRIBERS.get(name, ()):
+                try:
+                    callback(getattr(snapshot, name))
+                except Exception as e:
+                    errors.append((callback, e))
+    return changed, errors
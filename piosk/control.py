@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import time
+from threading import Thread
+from typing import Any, Callable
+
+import piosk.brightness
+import piosk.metrics
+import piosk.screensaver
+from piosk.config import CONFIG
+from piosk.util import log, warning
+
+_DISPATCH_TIME = piosk.metrics.histogram(
+    'piosk_control_dispatch_seconds', 'Time to run one control command.',
+    (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1)
+)
+_COMMANDS = piosk.metrics.counter('piosk_control_commands_total', 'Control commands received.', ('cmd', 'result'))
+
+
+class ControlError(Exception):
+    pass
+
+
+_TYPE_NAMES = {int: 'an integer', bool: 'true or false'}
+
+
+def _require(request: dict, key: str, kind: type):
+    value = request.get(key)
+    if not isinstance(value, kind) or (isinstance(value, bool) and kind is not bool):
+        raise ControlError(f'"{key}" must be {_TYPE_NAMES[kind]}.')
+    return value
+
+
+def _get_state(request: dict) -> dict:
+    return {
+        'brightness': piosk.brightness.get_brightness(),
+        'power': 'on' if piosk.brightness.screen_is_on() else 'off',
+        'screensaver': 'active' if piosk.screensaver.get_status() is piosk.screensaver.ScreensaverEvent.ACTIVATED
+        else 'inactive',
+        'display': piosk.screensaver.get_display_state().value,
+        'auto_brightness': piosk.brightness.auto_brightness_running(),
+    }
+
+
+def _set_brightness(request: dict):
+    value = _require(request, 'value', int)
+    if not 0 <= value <= 255:
+        raise ControlError('"value" must be between 0 and 255.')
+    piosk.brightness.set_manual_brightness(value, bool(request.get('smooth', False)))
+
+
+def _next_step(request: dict):
+    piosk.brightness.set_next_manual_step(bool(request.get('smooth', False)))
+
+
+def _set_power(request: dict):
+    if _require(request, 'on', bool):
+        piosk.brightness.turn_screen_on()
+    else:
+        piosk.brightness.turn_screen_off()
+
+
+def _set_auto_brightness(request: dict):
+    if _require(request, 'enabled', bool):
+        piosk.brightness.start_auto_brightness()
+    else:
+        piosk.brightness.stop_auto_brightness()
+
+
+def _activate_screensaver(request: dict):
+    piosk.screensaver.activate_screensaver()
+
+
+def _deactivate_screensaver(request: dict):
+    piosk.screensaver.poke_screensaver()
+
+
+_HANDLERS: dict[str, Callable[[dict], Any]] = {
+    'get_state': _get_state,
+    'set_brightness': _set_brightness,
+    'next_step': _next_step,
+    'set_power': _set_power,
+    'set_auto_brightness': _set_auto_brightness,
+    'activate_screensaver': _activate_screensaver,
+    'deactivate_screensaver': _deactivate_screensaver,
+}
+
+# Within one batch, only the last of these is applied; the earlier ones would be overwritten immediately.
+_COALESCED = ('set_brightness', 'set_power')
+
+
+def dispatch(request: dict) -> dict:
+    """
+    Run a single control command.
+
+    :param request: A decoded request object with a "cmd" key and the command's arguments.
+    :return: The response object.
+    """
+    start = time.perf_counter()
+    cmd = request.get('cmd')
+    response: dict[str, Any] = {'id': request['id']} if 'id' in request else {}
+    try:
+        handler = _HANDLERS.get(cmd)
+        if handler is None:
+            raise ControlError(f'Unknown command {cmd!r}.')
+        result = handler(request)
+        response['ok'] = True
+        if result is not None:
+            response['result'] = result
+    except ControlError as e:
+        response.update(ok=False, error=str(e))
+    except Exception as e:
+        warning('Control command %r failed: %s', cmd, e)
+        response.update(ok=False, error=f'{type(e).__name__}: {e}')
+    _DISPATCH_TIME.observe(time.perf_counter() - start)
+    _COMMANDS.inc(str(cmd), 'ok' if response['ok'] else 'error')
+    return response
+
+
+def dispatch_batch(lines: list[bytes]) -> list[dict]:
+    """
+    Run every command that arrived together, in order. Consecutive writes of the same setting are coalesced so only
+    the last one touches the hardware.
+    """
+    requests: list[dict | None] = []
+    responses: list[dict | None] = []
+    for line in lines:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Expected a JSON object.')
+            requests.append(request)
+            responses.append(None)
+        except ValueError as e:
+            requests.append(None)
+            responses.append({'ok': False, 'error': f'Invalid request: {e}'})
+    for i, request in enumerate(requests):
+        if request is None:
+            continue
+        following = requests[i + 1] if i + 1 < len(requests) else None
+        if request.get('cmd') in _COALESCED and following is not None and following.get('cmd') == request['cmd']:
+            response = {'id': request['id']} if 'id' in request else {}
+            responses[i] = dict(response, ok=True, superseded=True)
+            continue
+        responses[i] = dispatch(request)
+    return responses
+
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    buffer = b''
+    try:
+        while chunk := await reader.read(65536):
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            lines = [line for line in lines if line.strip()]
+            if len(lines) == 0:
+                continue
+            responses = dispatch_batch(lines)
+            writer.write(b''.join(json.dumps(response).encode() + b'\n' for response in responses))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = await asyncio.start_unix_server(_handle_connection, path)
+    os.chmod(path, 0o660)
+    async with server:
+        await server.serve_forever()
+
+
+class ControlServerThread(Thread):
+    """
+    Runs the control server on its own event loop when piosk is using the threaded runtime.
+    """
+
+    def __init__(self, path: str):
+        super(ControlServerThread, self).__init__(daemon=True)
+        self._path = path
+
+    def run(self):
+        asyncio.run(_serve(self._path))
+
+
+_CONTROL_THREAD: ControlServerThread
+
+
+def start_control_server():
+    log('Starting control server on %s.', CONFIG['control']['SOCKET'])
+    global _CONTROL_THREAD
+    _CONTROL_THREAD = ControlServerThread(CONFIG['control']['SOCKET'])
+    _CONTROL_THREAD.start()
+
+
+async def run_control_server_async():
+    log('Starting control server on %s.', CONFIG['control']['SOCKET'])
+    await _serve(CONFIG['control']['SOCKET'])
@@ -0,0 +1,28 @@
+from array import array
+from functools import lru_cache
+
+from easing_functions.easing import EasingBase
+
+from piosk.config import CONFIG
+
+
+@lru_cache(maxsize=CONFIG['curves']['CACHE_SIZE'])
+def get_curve(ease_cls: type[EasingBase], start: float, end: float, frame_count: int, typecode: str = 'f') -> array:
+    """
+    Get the precomputed values of an easing curve. Curves are cached, so repeated animations do no easing math after
+    the first run. The returned array is shared and must not be modified.
+
+    :param ease_cls: The easing function to use.
+    :param start: Value at the first frame.
+    :param end: Value the curve approaches at `frame_count`.
+    :param frame_count: Number of frames to compute. The end value itself is not included.
+    :param typecode: Array typecode. Integer typecodes truncate each value.
+    """
+    easing = ease_cls(start, end, frame_count)
+    if typecode in ('f', 'd'):
+        return array(typecode, (easing(i) for i in range(frame_count)))
+    return array(typecode, (int(easing(i)) for i in range(frame_count)))
+
+
+def cache_info():
+    return get_curve.cache_info()
@@ -0,0 +1,95 @@
+import math
+import time
+from dataclasses import dataclass
+from typing import Iterator, Sequence
+
+
+@dataclass
+class FrameStats:
+    rendered: int = 0
+    dropped: int = 0
+    max_lateness: float = 0.0
+
+
+class FrameScheduler:
+    """
+    Paces animation frames against absolute time.monotonic() deadlines, so write and scheduling jitter never
+    accumulates over the course of an animation. When rendering falls behind, frames that are already overdue are
+    dropped instead of stretching the animation.
+    """
+
+    def __init__(self, start: float | None = None):
+        # Deadline of the first frame of the next segment, or infinity if the previous segment holds indefinitely.
+        self._origin: float = time.monotonic() if start is None else start
+        self.stats = FrameStats()
+
+    def frames(self, interval: float | None, count: int) -> Iterator[tuple[int, float | None]]:
+        """
+        Schedule a segment of `count` frames spaced `interval` seconds apart, beginning where the previous segment
+        ended. For each frame to render, yields (frame index, seconds to wait until its deadline). The caller should
+        wait, render the frame and then continue iterating. A wait of None means the previous segment holds
+        indefinitely, and the caller should stop once that wait is interrupted. The last frame of a segment is never
+        dropped.
+
+        :param interval: Seconds between frames, or None to hold the last frame indefinitely.
+        :param count: Number of frames in the segment.
+        """
+        if count <= 0:
+            return
+        if math.isinf(self._origin):
+            # The previous segment holds indefinitely; the caller waits until it is cancelled.
+            yield 0, None
+            return
+        start = self._origin
+        step = interval if interval is not None else 0.0
+        index = 0
+        while index < count:
+            now = time.monotonic()
+            if step > 0:
+                due = min(int((now - start) / step), count - 1)
+                if due > index:
+                    self.stats.dropped += due - index
+                    index = due
+            deadline = start + index * step
+            yield index, max(0.0, deadline - now)
+            self.stats.rendered += 1
+            self.stats.max_lateness = max(self.stats.max_lateness, time.monotonic() - deadline)
+            index += 1
+        self._origin = start + count * step if interval is not None else math.inf
+
+    def timeline(self, offsets: Sequence[float], duration: float | None) -> Iterator[tuple[int, float | None]]:
+        """
+        Schedule a compiled timeline of entries at the given offsets from the end of the previous segment. Yields
+        (entry index, seconds to wait until its deadline) like frames(). An entry is dropped if the entry after it is
+        already due. The last entry is never dropped.
+
+        :param offsets: Non-decreasing offsets, in seconds, of each entry.
+        :param duration: Length of the timeline, or None if the last entry holds indefinitely.
+        """
+        count = len(offsets)
+        if count == 0:
+            return
+        if math.isinf(self._origin):
+            yield 0, None
+            return
+        start = self._origin
+        index = 0
+        while index < count:
+            now = time.monotonic()
+            while index + 1 < count and start + offsets[index + 1] <= now:
+                self.stats.dropped += 1
+                index += 1
+            deadline = start + offsets[index]
+            yield index, max(0.0, deadline - now)
+            self.stats.rendered += 1
+            self.stats.max_lateness = max(self.stats.max_lateness, time.monotonic() - deadline)
+            index += 1
+        self._origin = start + duration if duration is not None else math.inf
+
+    def time_until_end(self) -> float | None:
+        """
+        :return: Seconds until the end of the last scheduled segment, or None if it holds indefinitely.
+        """
+        if math.isinf(self._origin):
+            return None
+        return max(0.0, self._origin - time.monotonic())
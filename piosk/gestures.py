@@ -0,0 +1,120 @@
+from enum import StrEnum
+from threading import Lock
+from typing import Callable
+
+from piosk.config import ButtonSettings
+from piosk.runtime import DeadlineTimer
+
+
+class Gesture(StrEnum):
+    SINGLE_CLICK = 'single_click'
+    DOUBLE_CLICK = 'double_click'
+    TRIPLE_CLICK = 'triple_click'
+    SHORT_HOLD = 'short_hold'
+    LONG_HOLD = 'long_hold'
+
+
+_CLICKS = {1: Gesture.SINGLE_CLICK, 2: Gesture.DOUBLE_CLICK, 3: Gesture.TRIPLE_CLICK}
+
+
+class GestureRecognizer:
+    """
+    Turns button press and release edges into gestures. A press held for less than the minimum hold time is a click,
+    and clicks that follow each other within the click window are counted together. Longer presses are short or long
+    holds depending on whether they reached the maximum hold time.
+
+    Everything is driven by the edge timestamps and a single DeadlineTimer, which either marks the start of a hold
+    while the button is down or closes the click window after it is released. Once no more clicks could change the
+    meaning of a click, it is reported on release without waiting for the window.
+
+    Clicks followed by a hold within the click window are reported on their own, as soon as the hold starts, and the
+    hold is reported as usual once the button is released. A click and a hold are never combined into one gesture.
+    """
+
+    def __init__(self, settings: ButtonSettings, on_gesture: Callable[[Gesture, float], None],
+                 on_hold_start: Callable[[], None] | None = None):
+        """
+        :param settings: The [button] settings to recognize gestures with.
+        :param on_gesture: Called with each gesture and the time.monotonic() value at which it was recognized.
+        :param on_hold_start: Called once a press has lasted the minimum hold time.
+        """
+        self._settings = settings
+        self._on_gesture = on_gesture
+        self._on_hold_start = on_hold_start
+        self._lock = Lock()
+        self._timer = DeadlineTimer(self._on_deadline, 'piosk-gestures')
+        self._pressed_at: float | None = None
+        self._deadline: float | None = None
+        self._clicks: int = 0
+
+    def configure(self, settings: ButtonSettings):
+        with self._lock:
+            self._settings = settings
+
+    def press(self, now: float):
+        """
+        :param now: time.monotonic() value of the press edge.
+        """
+        with self._lock:
+            self._pressed_at = now
+            self._schedule(now + self._settings.min_hold_time_seconds)
+
+    def release(self, now: float):
+        """
+        :param now: time.monotonic() value of the release edge.
+        """
+        with self._lock:
+            if self._pressed_at is None:
+                # The button was already down when it was set up.
+                return
+            held = now - self._pressed_at
+            self._pressed_at = None
+            settings = self._settings
+            clicks = None
+            if held >= settings.min_hold_time_seconds:
+                gesture = Gesture.LONG_HOLD if held >= settings.max_hold_time_seconds else Gesture.SHORT_HOLD
+                if self._clicks > 0:
+                    # Released before the timer could report the clicks before the hold.
+                    clicks = self._take_clicks()
+            else:
+                self._clicks += 1
+                if self._clicks < settings.max_clicks:
+                    self._schedule(now + settings.click_window_seconds)
+                    return
+                gesture = self._take_clicks()
+            self._deadline = None
+            self._timer.cancel()
+        if clicks is not None:
+            self._on_gesture(clicks, now)
+        self._on_gesture(gesture, now)
+
+    def _schedule(self, deadline: float):
+        # Must be called with _lock held.
+        self._deadline = deadline
+        self._timer.schedule(deadline)
+
+    def _take_clicks(self) -> Gesture:
+        # Must be called with _lock held.
+        gesture = _CLICKS[min(self._clicks, 3)]
+        self._clicks = 0
+        return gesture
+
+    def _on_deadline(self, deadline: float):
+        hold_start = False
+        gesture = None
+        with self._lock:
+            # The timer may have fired just as an edge moved it, so check the deadline still applies. Deadlines are
+            # compared exactly, since `now + window - now` can round to just under the window.
+            if deadline != self._deadline:
+                return
+            self._deadline = None
+            if self._pressed_at is not None:
+                hold_start = True
+                if self._clicks > 0:
+                    gesture = self._take_clicks()
+            elif self._clicks > 0:
+                gesture = self._take_clicks()
+        if gesture is not None:
+            self._on_gesture(gesture, deadline)
+        if hold_start and self._on_hold_start is not None:
+            self._on_hold_start()
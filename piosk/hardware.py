@@ -0,0 +1,157 @@
+import re
+import subprocess
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+from piosk.config import CONFIG
+from piosk.util import warning
+
+SYSFS_BACKLIGHT_ROOT = Path('/sys/class/backlight/')
+SYSFS_PWM_ROOT = Path('/sys/class/pwm/')
+DEBUGFS_PINCTRL_ROOT = Path('/sys/kernel/debug/pinctrl/')
+
+# Commands that report a pin's function, and how to find it in their output.
+_PIN_FUNCTION_COMMANDS = (
+    # Current Raspberry Pi OS, e.g. " 18: a5    pd | lo // GPIO18 = PWM0_0".
+    (('pinctrl', 'get'), re.compile(r'=\s*(\S+)\s*$', re.MULTILINE)),
+    # Older releases, e.g. "GPIO 18: level=0 fsel=2 alt=5 func=PWM0 pull=DOWN".
+    (('raspi-gpio', 'get'), re.compile(r'\bfunc=(\S+)')),
+)
+
+
+def is_fake() -> bool:
+    """
+    :return: True if piosk is running against in-process fakes instead of real hardware.
+    """
+    return CONFIG['hardware']['BACKEND'] == 'fake'
+
+
+@lru_cache(maxsize=None)
+def pin_factory():
+    """
+    :return: The gpiozero pin factory every device should use, or None for gpiozero's default factory.
+    """
+    if not is_fake():
+        return None
+    from gpiozero.pins.mock import MockFactory, MockPWMPin
+    return MockFactory(pin_class=MockPWMPin)
+
+
+def _base_pin_factory():
+    factory = pin_factory()
+    if factory is None:
+        from gpiozero import Device
+        Device.ensure_pin_factory()
+        factory = Device.pin_factory
+    return factory
+
+
+def _pin_function(pin: int) -> str | None:
+    """
+    :return: What the pin is muxed to, such as 'PWM0_0', 'GPIO18' or the device that claimed it, or None if that can't
+            be found out.
+    """
+    for command, pattern in _PIN_FUNCTION_COMMANDS:
+        try:
+            output = subprocess.run([*command, str(pin)], capture_output=True, text=True, timeout=2, check=True).stdout
+        except (OSError, subprocess.SubprocessError):
+            continue
+        match = pattern.search(output)
+        if match is not None:
+            return match.group(1)
+    # debugfs names the device that claimed the pin, e.g. "pin 18 (gpio18): fe20c000.pwm (GPIO UNCLAIMED) ...".
+    pattern = re.compile(rf'^pin {pin} \(.*?\): (\S+)', re.MULTILINE)
+    for pinmux in sorted(DEBUGFS_PINCTRL_ROOT.glob('*/pinmux-pins')):
+        try:
+            match = pattern.search(pinmux.read_text())
+        except OSError:
+            continue
+        if match is not None:
+            return match.group(1)
+    return None
+
+
+@lru_cache(maxsize=None)
+def led_pin_factory() -> tuple[object, str]:
+    """
+    Pick the PWM backend for the status LED. 'auto' prefers the kernel's hardware PWM through /sys/class/pwm, then
+    pigpio's DMA-timed PWM, and falls back to gpiozero's default software PWM. A PWM chip can exist without the LED's
+    pin being routed to it, so 'auto' only picks hardware PWM once the pin is seen to be muxed to PWM.
+
+    :return: The gpiozero pin factory the status LED should use, and the name of its PWM backend.
+    """
+    config = CONFIG['led']
+    backend = config['PWM_BACKEND']
+    if backend == 'sysfs' or (backend == 'auto' and not is_fake()):
+        chip = pwm_root() / f"pwmchip{config['PWM_CHIP']}"
+        try:
+            from piosk.pwm import HardwarePWMFactory
+            if not chip.is_dir():
+                raise FileNotFoundError(f'{chip} does not exist. Is the pwm overlay enabled?')
+            if backend == 'auto':
+                pin = CONFIG['PIN_PWM_LED']
+                function = _pin_function(pin)
+                if function is None or 'pwm' not in function.lower():
+                    raise OSError(f"GPIO{pin} is not muxed to PWM ({function or 'function unknown'}). "
+                                  'Is the pwm overlay set up for this pin?')
+            return HardwarePWMFactory(_base_pin_factory(), CONFIG['PIN_PWM_LED'], chip, config['PWM_CHANNEL']), 'sysfs'
+        except OSError as e:
+            if backend == 'sysfs':
+                raise
+            warning('Hardware PWM is unavailable (%s).', e)
+    if backend == 'pigpio' or (backend == 'auto' and not is_fake()):
+        try:
+            from gpiozero.pins.pigpio import PiGPIOFactory
+            return PiGPIOFactory(), 'pigpio'
+        except (ImportError, OSError) as e:
+            if backend == 'pigpio':
+                raise
+            warning('pigpio is unavailable (%s).', e)
+    return pin_factory(), 'mock' if is_fake() else 'software'
+
+
+@lru_cache(maxsize=None)
+def pwm_root() -> Path:
+    """
+    :return: The directory containing PWM chips. For the fake backend this is a fake PWM chip created on tmpfs.
+    """
+    if not is_fake():
+        return SYSFS_PWM_ROOT
+    return _create_fake_pwm()
+
+
+@lru_cache(maxsize=None)
+def backlight_root() -> Path:
+    """
+    :return: The directory containing backlight devices. For the fake backend this is a fake backlight device created
+            on tmpfs.
+    """
+    if not is_fake():
+        return SYSFS_BACKLIGHT_ROOT
+    return _create_fake_backlight()
+
+
+def _create_fake_backlight() -> Path:
+    shm = Path('/dev/shm')
+    root = Path(tempfile.mkdtemp(prefix='piosk-backlight-', dir=shm if shm.is_dir() else None))
+    device = root / 'rpi_backlight'
+    device.mkdir()
+    (device / 'brightness').write_text('255\n')
+    (device / 'max_brightness').write_text('255\n')
+    (device / 'bl_power').write_text('0\n')
+    return root
+
+
+def _create_fake_pwm() -> Path:
+    shm = Path('/dev/shm')
+    root = Path(tempfile.mkdtemp(prefix='piosk-pwm-', dir=shm if shm.is_dir() else None))
+    chip = root / f"pwmchip{CONFIG['led']['PWM_CHIP']}"
+    chip.mkdir()
+    (chip / 'export').write_text('')
+    (chip / 'npwm').write_text('2\n')
+    channel = chip / f"pwm{CONFIG['led']['PWM_CHANNEL']}"
+    channel.mkdir()
+    for name in ('period', 'duty_cycle', 'enable'):
+        (channel / name).write_text('0\n')
+    return root
@@ -1,25 +1,210 @@
-from dataclasses import dataclass
-from itertools import cycle, chain, repeat
-from threading import Thread
+import asyncio
+import time
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import count, repeat
+from threading import Event, Lock, Thread
 
 from easing_functions.easing import EasingBase, LinearInOut
 from gpiozero import PWMLED
-from gpiozero.threads import GPIOThread
 
-from .config import CONFIG
+import piosk.hardware
+import piosk.metrics
+import piosk.runtime
+from .config import CONFIG, get_config
+from .curves import get_curve
+from .frames import FrameScheduler, FrameStats
+from .util import log, timed
 
 
-@dataclass
+@dataclass(frozen=True)
 class BlinkSequenceEvent:
     value: float
-    duration: float = 0.0
+    duration: float | None = 0.0
     fade_time: float = 0.0
     fps: int = 25
     easing: type[EasingBase] = LinearInOut
 
 
+@dataclass(frozen=True, eq=False)
+class Timeline:
+    """
+    A compiled LED sequence. Each entry writes `values[i]` at `offsets[i]` seconds from the start of the sequence.
+    """
+    offsets: array
+    values: array
+    # Length of one pass through the sequence, or None if the last value is held indefinitely.
+    duration: float | None
+
+
+@lru_cache(maxsize=CONFIG['curves']['CACHE_SIZE'])
+def compile_sequence(events: tuple[BlinkSequenceEvent, ...], initial_value: float) -> Timeline:
+    """
+    Flatten a sequence of events into a single timeline. Consecutive entries with the same value are merged, and an
+    entry that would be shown for no time at all is replaced by the one after it. Compiled timelines are cached.
+
+    :param events: A tuple of BlinkSequenceEvent objects representing the sequence of value changes.
+    :param initial_value: The LED value before the sequence begins.
+    """
+    offsets = array('d')
+    values = array('f')
+
+    def append(offset: float, value: float):
+        if len(values) > 0 and offsets[-1] == offset:
+            # The previous entry would be shown for no time at all.
+            values[-1] = value
+            if len(values) > 1 and values[-2] == value:
+                offsets.pop()
+                values.pop()
+        elif len(values) == 0 or values[-1] != value:
+            offsets.append(offset)
+            values.append(value)
+
+    offset = 0.0
+    prev_value = initial_value
+    for event in events:
+        if event.fade_time > 0 and prev_value != event.value:
+            frame_count = int(event.fps * event.fade_time)
+            delay = 1 / event.fps
+            for value in get_curve(event.easing, prev_value, event.value, frame_count):
+                append(offset, value)
+                offset += delay
+        append(offset, event.value)
+        if event.duration is None:
+            # The sequence never gets past this event.
+            return Timeline(offsets, values, None)
+        offset += event.duration
+        prev_value = event.value
+    return Timeline(offsets, values, offset)
+
+
+@dataclass
+class _SequenceRequest:
+    events: tuple[BlinkSequenceEvent, ...]
+    initial_value: float | None
+    n: int | None
+    requested: float
+    generation: int = 0
+    done: Event = field(default_factory=Event)
+
+
+class LedWorker(Thread):
+    """
+    The one thread that plays LED sequences. New sequences are handed over through a single-slot queue, so the latest
+    request always wins and callers never wait for the previous sequence's thread to be joined.
+    """
+
+    def __init__(self, led: 'SequencedPWMLED'):
+        super(LedWorker, self).__init__(daemon=True)
+        self._led = led
+        self._pending: deque[_SequenceRequest | None] = deque(maxlen=1)
+        self._wake = Event()
+        # Held only around a single PWM write, so a stopped sequence can never write after stop_sequence() returns.
+        self._write_lock = Lock()
+        self._generation = 0
+        self._latest: _SequenceRequest | None = None
+        self._closed = False
+
+    def claim(self, events: tuple[BlinkSequenceEvent, ...], initial_value: float | None, n: int | None,
+              requested: float) -> _SequenceRequest:
+        """
+        Make a new sequence the current one without playing it on this thread. Its writes through write() are refused
+        once stop_sequence() is called.
+        """
+        request = _SequenceRequest(events, initial_value, n, requested)
+        with self._write_lock:
+            request.generation = self._generation
+            self._latest = request
+        return request
+
+    def submit(self, events: tuple[BlinkSequenceEvent, ...], initial_value: float | None, n: int | None,
+               requested: float) -> _SequenceRequest:
+        request = self.claim(events, initial_value, n, requested)
+        self._pending.append(request)
+        self._wake.set()
+        return request
+
+    def stop_sequence(self):
+        """
+        Stop the current sequence. Once this returns, the worker will not write to the LED until given a new sequence.
+        """
+        with self._write_lock:
+            self._generation += 1
+            request, self._latest = self._latest, None
+        if request is not None:
+            self._pending.append(None)
+            self._wake.set()
+            # Release a caller blocked on the superseded sequence.
+            request.done.set()
+
+    def close(self):
+        self._closed = True
+        self.stop_sequence()
+        self._wake.set()
+
+    def run(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                request = self._pending.popleft()
+            except IndexError:
+                continue
+            if request is None:
+                continue
+            try:
+                self._play(request)
+            finally:
+                request.done.set()
+
+    def write(self, request: _SequenceRequest, value: float) -> bool:
+        """
+        :return: False, without writing, if the sequence was stopped or replaced.
+        """
+        with self._write_lock:
+            if request.generation != self._generation:
+                return False
+            self._led._write(value)
+            return True
+
+    def _play(self, request: _SequenceRequest):
+        """
+        Perform a sequence of LED value changes. Based on the logic found in PWMOutputDevice._blink_device().
+        """
+        if request.n is not None and request.n <= 0:
+            return
+        timeline = self._led._compile(request.events, request.initial_value)
+        scheduler = FrameScheduler()
+        self._led.last_frame_stats = scheduler.stats
+        first = True
+        for _ in (count() if request.n is None else repeat(None, request.n)):
+            for index, wait in scheduler.timeline(timeline.offsets, timeline.duration):
+                if wait != 0 and self._wake.wait(wait):
+                    # A new sequence arrived.
+                    return
+                if not self.write(request, timeline.values[index]):
+                    return
+                if first:
+                    self._led._record_switch(request.requested)
+                    first = False
+        self._wake.wait(scheduler.time_until_end())
+
+
 class SequencedPWMLED(PWMLED):
 
+    def __init__(self, *args, **kwargs):
+        # gpiozero devices reject attributes that weren't assigned during construction.
+        self._blink_task = None
+        self._worker = LedWorker(self)
+        self.last_frame_stats = FrameStats()
+        self.sequences_started: int = 0
+        self.last_switch_latency: float | None = None
+        self.max_switch_latency: float = 0.0
+        super(SequencedPWMLED, self).__init__(*args, **kwargs)
+        self._worker.start()
+
     def sequence(self, events: tuple[BlinkSequenceEvent, ...] | BlinkSequenceEvent,
                  initial_value: float | None = None, n: int | None = 1, background: bool = True):
         """
@@ -30,98 +215,159 @@ class SequencedPWMLED(PWMLED):
                 currently set value.
         :param n: Number of times to repeat the sequence, or None to perform indefinitely until another thread
                 sets a new value.
-        :param background: If true, the sequence will operate in a background thread. If False, the calling thread
-                will be blocked.
+        :param background: If true, the sequence will operate in the background. If False, the calling thread will be
+                blocked until the sequence finishes or is replaced.
         """
+        requested = time.monotonic()
         self._stop_blink()
         if isinstance(events, BlinkSequenceEvent):
             events = (events,)
-        self._blink_thread = GPIOThread(
-            self._sequenced_blink_device,
-            (events, initial_value, n)
-        )
-        self._blink_thread.start()
+        if background and piosk.runtime.is_active():
+            # Run the sequence as a coroutine on the runtime's event loop. It is claimed here rather than when the
+            # coroutine starts, so a stop in between is never missed.
+            request = self._worker.claim(events, initial_value, n, requested)
+            self._blink_task = piosk.runtime.submit(self._sequenced_blink_coroutine(request))
+            return
+        request = self._worker.submit(events, initial_value, n, requested)
         if not background:
-            self._blink_thread.join()
-            self._blink_thread = None
+            request.done.wait()
 
-    def _sequenced_blink_device(self, events: tuple[BlinkSequenceEvent, ...] | BlinkSequenceEvent,
-                                initial_value: float | None = None, n: int | None = 1):
-        """
-        Perform a sequence of LED value changes. Based on the logic found in PWMOutputDevice._blink_device().
+    def _stop_blink(self):
+        task = self._blink_task
+        if task is not None:
+            task.cancel()
+            self._blink_task = None
+        self._worker.stop_sequence()
+        super(SequencedPWMLED, self)._stop_blink()
 
-        :param events: A tuple of BlinkSequenceEvent objects representing the sequence of value changes.
-        :param initial_value: Initial value to set LED to before performing any fade actions, or None to use the
-                currently set value.
-        :param n: Number of times to repeat the sequence, or None to perform indefinitely until another thread
-                sets a new value.
+    def close(self):
+        super(SequencedPWMLED, self).close()
+        self._worker.close()
+
+    def _record_switch(self, requested: float):
+        self.sequences_started += 1
+        self.last_switch_latency = time.monotonic() - requested
+        self.max_switch_latency = max(self.max_switch_latency, self.last_switch_latency)
+
+    def _compile(self, events: tuple[BlinkSequenceEvent, ...] | BlinkSequenceEvent,
+                 initial_value: float | None = None) -> Timeline:
+        if isinstance(events, BlinkSequenceEvent):
+            events = (events,)
+        return compile_sequence(events, float(initial_value if initial_value is not None else self.value))
+
+    async def _sequenced_blink_coroutine(self, request: _SequenceRequest):
+        """
+        Coroutine equivalent of LedWorker._play() for the asyncio runtime. Cancelling the task stops the sequence, but
+        it is cancelled from other threads, so each write also checks the sequence is still current, as the worker does.
         """
+        n = request.n
         if n is not None and n <= 0:
             return
-        sequence = []
-        prev_value = initial_value if initial_value is not None else self.value
-        if isinstance(events, BlinkSequenceEvent):
-            events = (events,)
-        for event in events:
-            value_steps = []
-            delay = None
-            if event.fade_time > 0 and prev_value != event.value:
-                frame_count = int(event.fps * event.fade_time)
-                delay = 1 / event.fps
-                easing = event.easing(prev_value, event.value, frame_count)
-                for i in range(frame_count):
-                    value = easing(i)
-                    value_steps.append(value)
-            sequence.append((delay, value_steps))
-            sequence.append((event.duration, (event.value,)))
-            prev_value = event.value
-        sequence = (
-            cycle(sequence) if n is None else
-            chain.from_iterable(repeat(sequence, n))
-        )
-        breaking = False
-        for delay, values in sequence:
-            for value in values:
-                self._write(value)
-                if self._blink_thread.stopping.wait(delay):
-                    breaking = True
-                    break
-            if breaking is True:
-                break
+        timeline = self._compile(request.events, request.initial_value)
+        scheduler = FrameScheduler()
+        self.last_frame_stats = scheduler.stats
+        first = True
+        for _ in (count() if n is None else repeat(None, n)):
+            for index, wait in scheduler.timeline(timeline.offsets, timeline.duration):
+                await _wait_async(wait)
+                if not self._worker.write(request, timeline.values[index]):
+                    return
+                if first:
+                    self._record_switch(request.requested)
+                    first = False
+        await _wait_async(scheduler.time_until_end())
+
+
+async def _wait_async(timeout: float | None):
+    if timeout is None:
+        # Hold until the task is cancelled.
+        await asyncio.get_running_loop().create_future()
+    elif timeout > 0:
+        await asyncio.sleep(timeout)
+
+
+_GPIO_LED: SequencedPWMLED | None = None
+_GPIO_LED_LOCK = Lock()
+
+
+def get_led() -> SequencedPWMLED:
+    """
+    :return: The status LED, claiming its pin on first use.
+    """
+    global _GPIO_LED
+    if _GPIO_LED is None:
+        with _GPIO_LED_LOCK:
+            if _GPIO_LED is None:
+                with timed('init led'):
+                    factory, backend = piosk.hardware.led_pin_factory()
+                    _GPIO_LED = SequencedPWMLED(CONFIG['PIN_PWM_LED'], pin_factory=factory)
+                log('Status LED is using %s PWM.', backend)
+    return _GPIO_LED
+
+
+def led_stats() -> dict[str, float | int | None]:
+    """
+    :return: Sequence switch latency and frame timing figures for the status LED.
+    """
+    led = get_led()
+    return {
+        'pwm_backend': piosk.hardware.led_pin_factory()[1],
+        'sequences_started': led.sequences_started,
+        'last_switch_latency': led.last_switch_latency,
+        'max_switch_latency': led.max_switch_latency,
+        'last_sequence_frames_rendered': led.last_frame_stats.rendered,
+        'last_sequence_frames_dropped': led.last_frame_stats.dropped,
+        'last_sequence_max_lateness': led.last_frame_stats.max_lateness,
+    }
+
+
+piosk.metrics.callback(
+    'piosk_led_sequences_started_total', 'Status LED sequences that started playing.', 'counter',
+    lambda: {(): _GPIO_LED.sequences_started} if _GPIO_LED is not None else {}
+)
 
 
-GPIO_LED = SequencedPWMLED(CONFIG['PIN_PWM_LED'])
+def __getattr__(name: str):
+    # GPIO_LED is created lazily on first access.
+    if name == 'GPIO_LED':
+        return get_led()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 class LedInstructionProvidingThread(Thread):
 
     def _led_sequence(self, events: tuple[BlinkSequenceEvent, ...] | BlinkSequenceEvent,
                       initial_value: float | None = None, n: int | None = 1):
-        GPIO_LED.sequence(events, initial_value, n, background=True)
+        get_led().sequence(events, initial_value, n, background=True)
 
-    def _led_on(self, on_time: float | None = None, fade_time: float = 0, value: float = CONFIG['led']['LED_MAX']):
+    def _led_on(self, on_time: float | None = None, fade_time: float = 0, value: float | None = None):
+        value = value if value is not None else get_config().led.led_max
         n = 1 if on_time is not None and on_time > 0 else None
-        GPIO_LED.sequence(BlinkSequenceEvent(value, on_time, fade_time), n=n, background=True)
+        get_led().sequence(BlinkSequenceEvent(value, on_time, fade_time), n=n, background=True)
 
     def _led_off(self, off_time: float | None = None, fade_time: float = 0):
         n = 1 if off_time is not None and off_time > 0 else None
-        GPIO_LED.sequence(BlinkSequenceEvent(0, off_time, fade_time), n=n, background=True)
+        get_led().sequence(BlinkSequenceEvent(0, off_time, fade_time), n=n, background=True)
 
     def _led_blink(self, on_time: float | None = None, off_time: float | None = None,
-                   led_on_value: float = CONFIG['led']['LED_MAX'], led_off_value: float = 0.0,
+                   led_on_value: float | None = None, led_off_value: float = 0.0,
                    n: int = None):
+        led_on_value = led_on_value if led_on_value is not None else get_config().led.led_max
         events = (
             BlinkSequenceEvent(led_on_value, on_time),
             BlinkSequenceEvent(led_off_value, off_time)
         )
-        GPIO_LED.sequence(events, n=n, background=True)
+        get_led().sequence(events, n=n, background=True)
 
     def _led_pulse(self, on_time: float | None = None, off_time: float | None = None,
                    fade_time_on: float = 0, fade_time_off: float = 0,
-                   high_value: float = CONFIG['led']['LED_MAX'], low_value: float = CONFIG['led']['LED_MIN'],
+                   high_value: float | None = None, low_value: float | None = None,
                    n: int = None):  # TODO: stay_on: bool = False
+        settings = get_config().led
+        high_value = high_value if high_value is not None else settings.led_max
+        low_value = low_value if low_value is not None else settings.led_min
         events = (
             BlinkSequenceEvent(high_value, on_time, fade_time_on),
             BlinkSequenceEvent(low_value, off_time, fade_time_off)
         )
-        GPIO_LED.sequence(events, n=n, background=True)
+        get_led().sequence(events, n=n, background=True)
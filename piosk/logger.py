@@ -0,0 +1,245 @@
+import atexit
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from pathlib import Path
+from typing import TextIO
+
+from piosk.config import CONFIG
+
+
+class Level(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+
+_Record = tuple[float, Level, str, tuple]
+
+_CONFIG = CONFIG['logging']
+# Records at or above this level are written to the sink.
+_SINK_LEVEL = Level[_CONFIG['LEVEL'].upper()]
+# Records at or above this level are kept in the ring buffer, even if they are never written to the sink.
+_RING_LEVEL = Level[_CONFIG['RING_LEVEL'].upper()]
+_MIN_LEVEL = min(_SINK_LEVEL, _RING_LEVEL)
+_DEBUG_ENABLED = Level.DEBUG >= _MIN_LEVEL
+# Enum member lookups are slow, so the hot path uses these instead.
+_DEBUG, _WARNING, _ERROR = Level.DEBUG, Level.WARNING, Level.ERROR
+# Converts time.monotonic() values to wall clock timestamps for display.
+_WALL_OFFSET = time.time() - time.monotonic()
+
+_RING: deque[_Record] = deque(maxlen=_CONFIG['RING_SIZE'])
+_PENDING: deque[_Record] = deque()
+
+
+def _format_message(message: str, args: tuple) -> str:
+    if len(args) == 0:
+        return message
+    try:
+        return message % args
+    except (TypeError, ValueError):
+        return f'{message} {args!r}'
+
+
+def format_record(record: _Record) -> str:
+    timestamp, level, message, args = record
+    return f'{_WALL_OFFSET + timestamp:.6f} :: {level.name} :: {_format_message(message, args)}'
+
+
+class _StreamSink:
+
+    def __init__(self, stream: TextIO):
+        self._stream = stream
+
+    def write(self, records: list[_Record]):
+        self._stream.write(''.join(format_record(record) + '\n' for record in records))
+        self._stream.flush()
+
+
+class _JournaldSink:
+    """
+    Sends each record to journald over its native datagram protocol, with the level as the syslog priority.
+    """
+
+    _PRIORITIES = {Level.DEBUG: 7, Level.INFO: 6, Level.WARNING: 4, Level.ERROR: 3}
+
+    def __init__(self, path: str = '/run/systemd/journal/socket'):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.connect(path)
+
+    @staticmethod
+    def _field(name: str, value: str) -> bytes:
+        data = value.encode()
+        if b'\n' in data:
+            # Multi-line values are sent with an explicit length.
+            return name.encode() + b'\n' + struct.pack('<Q', len(data)) + data + b'\n'
+        return name.encode() + b'=' + data + b'\n'
+
+    def write(self, records: list[_Record]):
+        for timestamp, level, message, args in records:
+            self._socket.send(
+                self._field('PRIORITY', str(self._PRIORITIES[level]))
+                + self._field('SYSLOG_IDENTIFIER', 'piosk')
+                + self._field('MESSAGE', _format_message(message, args))
+            )
+
+
+def _create_sink():
+    kind = _CONFIG['SINK']
+    if kind == 'journald':
+        try:
+            return _JournaldSink()
+        except OSError as e:
+            sys.stderr.write(f'Could not connect to journald ({e}). Logging to stdout.\n')
+    elif kind == 'file':
+        path = Path(_CONFIG['FILE'])
+        if not path.is_absolute():
+            path = Path(__file__).parent.parent / path
+        return _StreamSink(path.open('a', buffering=1 << 16))
+    return _StreamSink(sys.stdout)
+
+
+class LogWriterThread(threading.Thread):
+    """
+    Writes pending records to the sink in batches, every FLUSH_INTERVAL_MS or as soon as an error is logged, so
+    callers never block on the sink.
+    """
+
+    def __init__(self):
+        super(LogWriterThread, self).__init__(name='piosk-log', daemon=True)
+        self._sink = _create_sink()
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._interval = _CONFIG['FLUSH_INTERVAL_MS'] / 1000
+
+    def wake(self):
+        self._wake.set()
+
+    def flush(self):
+        with self._write_lock:
+            records = []
+            while True:
+                try:
+                    records.append(_PENDING.popleft())
+                except IndexError:
+                    break
+            if len(records) > 0:
+                self._sink.write(records)
+
+    def run(self):
+        while True:
+            self._wake.wait(self._interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write(f'Log sink failed: {e}\n')
+
+
+_WRITER: LogWriterThread | None = None
+_WRITER_LOCK = threading.Lock()
+
+
+def _get_writer() -> LogWriterThread:
+    global _WRITER
+    if _WRITER is None:
+        with _WRITER_LOCK:
+            if _WRITER is None:
+                writer = LogWriterThread()
+                writer.start()
+                _WRITER = writer
+    return _WRITER
+
+
+def _emit(level: Level, message: str, args: tuple):
+    record = (time.monotonic(), level, message, args)
+    if level >= _RING_LEVEL:
+        _RING.append(record)
+    if level >= _SINK_LEVEL:
+        _PENDING.append(record)
+        writer = _WRITER if _WRITER is not None else _get_writer()
+        if level >= _ERROR:
+            writer.wake()
+
+
+def log(message: str, *args, level: Level = Level.INFO):
+    """
+    Record a log message. `message` is only %-formatted with `args` when it is written out, so pass values as
+    arguments rather than formatting them in hot paths.
+    """
+    if level >= _MIN_LEVEL:
+        _emit(level, message, args)
+
+
+def debug(message: str, *args):
+    if _DEBUG_ENABLED:
+        _emit(_DEBUG, message, args)
+
+
+def warning(message: str, *args):
+    if _WARNING >= _MIN_LEVEL:
+        _emit(_WARNING, message, args)
+
+
+def error(message: str, *args):
+    _emit(_ERROR, message, args)
+
+
+def is_enabled(level: Level) -> bool:
+    return level >= _MIN_LEVEL
+
+
+def flush():
+    """
+    Write out any pending records now.
+    """
+    if _WRITER is not None:
+        _WRITER.flush()
+
+
+def dump(stream: TextIO | None = None):
+    """
+    Write the ring buffer of recent records, including those below the sink level, to `stream` (stderr by default).
+    """
+    stream = stream if stream is not None else sys.stderr
+    records = list(_RING)
+    stream.write(f'--- Last {len(records)} log records ---\n')
+    stream.write(''.join(format_record(record) + '\n' for record in records))
+    stream.write('--- End of log records ---\n')
+    stream.flush()
+
+
+def install_crash_handlers():
+    """
+    Dump the ring buffer when any thread dies from an uncaught exception, and on SIGUSR1. Must be called from the main
+    thread.
+    """
+    previous_excepthook = sys.excepthook
+    previous_thread_excepthook = threading.excepthook
+
+    def excepthook(exc_type, exc_value, exc_tb):
+        error('Uncaught %s: %s', exc_type.__name__, exc_value)
+        flush()
+        dump()
+        previous_excepthook(exc_type, exc_value, exc_tb)
+
+    def thread_excepthook(args):
+        if args.exc_type is not SystemExit:
+            error('Uncaught %s in thread %s: %s', args.exc_type.__name__,
+                  args.thread.name if args.thread is not None else '?', args.exc_value)
+            flush()
+            dump()
+        previous_thread_excepthook(args)
+
+    sys.excepthook = excepthook
+    threading.excepthook = thread_excepthook
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
+
+
+atexit.register(flush)
@@ -0,0 +1,279 @@
+import asyncio
+import math
+import os
+import socket
+import sys
+from threading import Lock, Thread
+from typing import Callable, Iterable
+
+from piosk.config import CONFIG
+from piosk.util import TimedLock, log
+
+_Labels = tuple[str, ...]
+_Sample = tuple[str, dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(value)
+
+
+class Metric:
+    """
+    A named family of samples in the Prometheus text exposition format.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: _Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = Lock()
+
+    def _labels(self, label_values: _Labels) -> dict[str, str]:
+        return dict(zip(self.label_names, label_values))
+
+    def samples(self) -> Iterable[_Sample]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: _Labels = ()):
+        super(Counter, self).__init__(name, documentation, label_names)
+        self._values: dict[_Labels, float] = {} if label_names else {(): 0}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> Iterable[_Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        return ((self.name, self._labels(k), v) for k, v in values)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...]):
+        super(Histogram, self).__init__(name, documentation)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts = [0] * len(self._buckets)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        with self._lock:
+            self._sum += value
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def samples(self) -> Iterable[_Sample]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self._buckets, counts):
+            cumulative += count
+            yield f'{self.name}_bucket', {'le': _format_value(bound)}, cumulative
+        yield f'{self.name}_sum', {}, total
+        yield f'{self.name}_count', {}, cumulative
+
+
+class CallbackMetric(Metric):
+    """
+    A metric whose values are read from existing state when scraped, so the hot path pays nothing for it.
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, callback: Callable[[], dict[_Labels, float]],
+                 label_names: _Labels = ()):
+        super(CallbackMetric, self).__init__(name, documentation, label_names)
+        self.kind = kind
+        self._callback = callback
+
+    def samples(self) -> Iterable[_Sample]:
+        return ((self.name, self._labels(k), v) for k, v in self._callback().items() if v is not None)
+
+
+_REGISTRY: dict[str, Metric] = {}
+_REGISTRY_LOCK = Lock()
+
+
+def _register(metric: Metric) -> Metric:
+    with _REGISTRY_LOCK:
+        return _REGISTRY.setdefault(metric.name, metric)
+
+
+def counter(name: str, documentation: str, label_names: _Labels = ()) -> Counter:
+    return _register(Counter(name, documentation, label_names))
+
+
+def histogram(name: str, documentation: str, buckets: tuple[float, ...]) -> Histogram:
+    return _register(Histogram(name, documentation, buckets))
+
+
+def callback(name: str, documentation: str, kind: str, fn: Callable[[], dict[_Labels, float]],
+             label_names: _Labels = ()) -> CallbackMetric:
+    return _register(CallbackMetric(name, documentation, kind, fn, label_names))
+
+
+_LOCKS: dict[str, TimedLock] = {}
+
+
+def register_lock(name: str, lock: TimedLock):
+    """
+    Export a TimedLock's acquisition and wait figures, labelled with `name`.
+    """
+    _LOCKS[name] = lock
+
+
+callback('piosk_lock_acquisitions_total', 'Lock acquisitions.', 'counter',
+         lambda: {(name,): lock.acquisitions for name, lock in _LOCKS.items()}, ('lock',))
+callback('piosk_lock_wait_seconds_total', 'Time spent waiting to acquire a lock.', 'counter',
+         lambda: {(name,): lock.total_wait for name, lock in _LOCKS.items()}, ('lock',))
+callback('piosk_lock_wait_seconds_max', 'Longest wait to acquire a lock.', 'gauge',
+         lambda: {(name,): lock.max_wait for name, lock in _LOCKS.items()}, ('lock',))
+
+
+def render() -> str:
+    """
+    :return: Every registered metric in the Prometheus text exposition format.
+    """
+    with _REGISTRY_LOCK:
+        metrics = list(_REGISTRY.values())
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _response(path: str) -> tuple[int, bytes]:
+    if path.split('?', 1)[0] != '/metrics':
+        return 404, b'Not found\n'
+    return 200, render().encode()
+
+
+def _parse_listen(listen: str) -> tuple[str | None, str, int]:
+    """
+    :return: (unix socket path, host, port). The path is None for a TCP address.
+    """
+    if listen.startswith('unix:'):
+        return listen[len('unix:'):], '', 0
+    host, _, port = listen.rpartition(':')
+    return None, host or '127.0.0.1', int(port)
+
+
+def _remove_stale_socket(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _handle_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        # Skip the request headers.
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        status, body = _response(request_line[1]) if len(request_line) >= 2 else (400, b'Bad request\n')
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {_CONTENT_TYPE}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _serve(listen: str):
+    path, host, port = _parse_listen(listen)
+    if path is not None:
+        _remove_stale_socket(path)
+        server = await asyncio.start_unix_server(_handle_async, path)
+    else:
+        server = await asyncio.start_server(_handle_async, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+class MetricsServerThread(Thread):
+    """
+    Runs the metrics server on its own event loop when piosk is using the threaded runtime.
+    """
+
+    def __init__(self, listen: str):
+        super(MetricsServerThread, self).__init__(daemon=True)
+        self._listen = listen
+
+    def run(self):
+        asyncio.run(_serve(self._listen))
+
+
+_METRICS_THREAD: MetricsServerThread
+
+
+def start_metrics_server():
+    log('Serving metrics on %s.', CONFIG['metrics']['LISTEN'])
+    global _METRICS_THREAD
+    _METRICS_THREAD = MetricsServerThread(CONFIG['metrics']['LISTEN'])
+    _METRICS_THREAD.start()
+
+
+async def run_metrics_server_async():
+    log('Serving metrics on %s.', CONFIG['metrics']['LISTEN'])
+    await _serve(CONFIG['metrics']['LISTEN'])
+
+
+def scrape(listen: str | None = None, timeout: float = 5.0) -> str:
+    """
+    Fetch the metrics page the way a Prometheus scraper would.
+
+    :param listen: Address in the [metrics] LISTEN format, or None to use the configured one.
+    """
+    # Only the scraper needs http.client, so the daemon doesn't pay for importing it at startup.
+    import http.client
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(path)
+
+    path, host, port = _parse_listen(listen if listen is not None else CONFIG['metrics']['LISTEN'])
+    connection = UnixHTTPConnection('localhost', timeout=timeout) if path is not None \
+        else http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+        body = response.read().decode()
+        if response.status != 200:
+            raise RuntimeError(f'Metrics endpoint returned {response.status}: {body.strip()}')
+        return body
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    print(scrape(sys.argv[1] if len(sys.argv) > 1 else None), end='')
@@ -1,41 +1,113 @@
 import time
-from threading import Thread, Event
+from threading import Thread
 
-from gpiozero import MotionSensor
+from gpiozero import DigitalInputDevice, MotionSensor
 
-from piosk.config import CONFIG
+import piosk.hardware
+import piosk.metrics
+from piosk.config import CONFIG, get_config
+from piosk.runtime import LoopEvent
 from piosk.screensaver import poke_screensaver, get_status, ScreensaverEvent
-from piosk.util import log
+from piosk.util import debug, log
 
-_GPIO_MOTIONSENSOR = MotionSensor(CONFIG['PIN_MOTIONSENSOR'])
 _DISPLAY_SLEEPING: bool = False
-_MOTION_SLEEP_EVENT: Event = Event()
-_MOTION_CANCEL_EVENT: Event = Event()
+_MOTION_SLEEP_EVENT: LoopEvent = LoopEvent()
+_MOTION_CANCEL_EVENT: LoopEvent = LoopEvent()
+_MOTION_DETECTED_AT: float | None = None
+_LAST_WAKE_LATENCY: float | None = None
+_MAX_WAKE_LATENCY: float = 0.0
+_WAKE_LATENCY = piosk.metrics.histogram(
+    'piosk_motion_wake_latency_seconds', 'Time from detected motion to the screen turning back on.',
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+
+def _create_sensor() -> DigitalInputDevice:
+    """
+    Claim the PIR pin. In 'edge' mode the sensor is a plain digital input driven by the pin factory's edge detection,
+    with no sampling thread. In 'queue' mode it is a gpiozero MotionSensor using the configured queue sampling.
+    """
+    settings = get_config().motion
+    if settings.sensor == 'queue':
+        return MotionSensor(
+            CONFIG['PIN_MOTIONSENSOR'],
+            queue_len=settings.queue_len,
+            sample_rate=settings.sample_rate,
+            pin_factory=piosk.hardware.pin_factory()
+        )
+    return DigitalInputDevice(CONFIG['PIN_MOTIONSENSOR'], pull_up=False, pin_factory=piosk.hardware.pin_factory())
 
 
 class MotionSensorThread(Thread):
+    """
+    Watches for motion while the screen is off. The sensor is only armed after the screen has been off for
+    WAKE_DELAY_SECONDS and is released again as soon as motion is seen or monitoring is cancelled, so it costs nothing
+    while the display is on.
+    """
 
-    def __init__(self, sleep_event: Event, cancel_event: Event):
+    def __init__(self, sleep_event: LoopEvent, cancel_event: LoopEvent):
         super(MotionSensorThread, self).__init__()
         self._sleep_event = sleep_event
         self._cancel_event = cancel_event
+        self._sensor: DigitalInputDevice | None = None
+
+    def _on_motion(self):
+        global _MOTION_DETECTED_AT
+        if _MOTION_DETECTED_AT is None:
+            _MOTION_DETECTED_AT = time.monotonic()
+        self._cancel_event.set()
+
+    def _arm(self):
+        global _MOTION_DETECTED_AT
+        debug('Motion sensor waking up.')
+        _MOTION_DETECTED_AT = None
+        self._sensor = _create_sensor()
+        self._sensor.when_activated = self._on_motion
+        if self._sensor.is_active:
+            self._on_motion()
+
+    def _disarm(self):
+        if self._sensor is not None:
+            self._sensor.close()
+            self._sensor = None
+
+    def _finish(self):
+        self._disarm()
+        if _MOTION_DETECTED_AT is not None:
+            log('Motion sensor detected movement. Waking screen.')
+            poke_screensaver()
+        else:
+            log('Screensaver was woken up. Stopping motion monitoring.')
+        self._sleep_event.clear()
+        self._cancel_event.clear()
 
     def run(self):
         while True:
             # This thread will be awoken when the screen has been turned off.
-            log('Motion sensor sleeping.')
+            debug('Motion sensor sleeping.')
             self._sleep_event.wait()
-            log(f"Motion sensor will wake up in {CONFIG['motion']['WAKE_DELAY_SECONDS']} seconds.")
-            self._cancel_event.wait(CONFIG['motion']['WAKE_DELAY_SECONDS'])  # wait a short period before activating the motion sensor.
-            if not self._cancel_event.is_set():
-                log('Motion sensor waking up.')
-                _GPIO_MOTIONSENSOR.wait_for_active()
-                log('Motion sensor detected movement. Waking screen.')
-                poke_screensaver()
-            else:
-                log('Screensaver was woken up. Skipping motion monitoring.')
-            self._sleep_event.clear()
-            self._cancel_event.clear()
+            wake_delay = get_config().motion.wake_delay_seconds
+            debug('Motion sensor will wake up in %s seconds.', wake_delay)
+            # Wait a short period before activating the motion sensor.
+            if not self._cancel_event.wait(wake_delay):
+                self._arm()
+                # Set by either the motion callback or cancel_motion_monitoring().
+                self._cancel_event.wait()
+            self._finish()
+
+    async def run_async(self):
+        """
+        Coroutine equivalent of run() for the asyncio runtime.
+        """
+        while True:
+            debug('Motion sensor sleeping.')
+            await self._sleep_event.wait_async()
+            wake_delay = get_config().motion.wake_delay_seconds
+            debug('Motion sensor will wake up in %s seconds.', wake_delay)
+            if not await self._cancel_event.wait_async(wake_delay):
+                self._arm()
+                await self._cancel_event.wait_async()
+            self._finish()
 
 
 _MOTION_THREAD: MotionSensorThread
@@ -48,6 +120,13 @@ def start_motion_sensor_thread():
     _MOTION_THREAD.start()
 
 
+async def run_motion_sensor_async():
+    log('Starting Motion task.')
+    global _MOTION_THREAD
+    _MOTION_THREAD = MotionSensorThread(_MOTION_SLEEP_EVENT, _MOTION_CANCEL_EVENT)
+    await _MOTION_THREAD.run_async()
+
+
 def join_motion_sensor_thread():
     _MOTION_THREAD.join()
 
@@ -57,7 +136,23 @@ def wake_motion_sensor():
 
 
 def cancel_motion_monitoring():
+    """
+    Called once the screen is back on. Stops motion monitoring and records the wake latency if motion woke the screen.
+    """
+    global _MOTION_DETECTED_AT, _LAST_WAKE_LATENCY, _MAX_WAKE_LATENCY
+    if _MOTION_DETECTED_AT is not None:
+        _LAST_WAKE_LATENCY = time.monotonic() - _MOTION_DETECTED_AT
+        _MAX_WAKE_LATENCY = max(_MAX_WAKE_LATENCY, _LAST_WAKE_LATENCY)
+        _WAKE_LATENCY.observe(_LAST_WAKE_LATENCY)
+        _MOTION_DETECTED_AT = None
+        log('Motion wake to screen on took %.1f ms.', _LAST_WAKE_LATENCY * 1000)
     if _MOTION_SLEEP_EVENT.is_set() and not _MOTION_CANCEL_EVENT.is_set():
-        log('Flagging motion thread for cancellation.')
+        debug('Flagging motion thread for cancellation.')
         _MOTION_CANCEL_EVENT.set()
 
+
+def motion_stats() -> dict[str, float | None]:
+    return {
+        'last_wake_latency': _LAST_WAKE_LATENCY,
+        'max_wake_latency': _MAX_WAKE_LATENCY,
+    }
@@ -0,0 +1,115 @@
+import time
+from pathlib import Path
+
+from gpiozero.exc import PinInvalidFunction, PinInvalidState
+from gpiozero.pins import Factory, Pin
+
+from piosk.sysfs import SysfsAttribute
+
+
+class SysfsPWMPin(Pin):
+    """
+    A gpiozero pin whose PWM output is generated by the SoC's PWM peripheral through the kernel's `/sys/class/pwm`
+    interface. Once the duty cycle is written the hardware keeps the waveform going without any further CPU time.
+    The pin must already be routed to the PWM peripheral, e.g. with `dtoverlay=pwm` for GPIO18.
+    """
+
+    def __init__(self, factory: 'HardwarePWMFactory', info, chip: Path, channel: int):
+        super(SysfsPWMPin, self).__init__()
+        self._factory = factory
+        self._info = info
+        self._channel_path = chip / f'pwm{channel}'
+        if not self._channel_path.exists():
+            (chip / 'export').write_text(f'{channel}\n')
+            # udev may take a moment to make the new channel's files writable.
+            for _ in range(50):
+                if self._channel_path.exists():
+                    break
+                time.sleep(0.01)
+        self._period_file = SysfsAttribute(self._channel_path / 'period')
+        self._duty_file = SysfsAttribute(self._channel_path / 'duty_cycle')
+        self._enable_file = SysfsAttribute(self._channel_path / 'enable')
+        self._frequency: float | None = None
+        self._period_ns: int = 0
+        self._state: float = 0.0
+
+    def _get_info(self):
+        return self._info
+
+    def _get_function(self):
+        return 'output'
+
+    def _set_function(self, value):
+        if value != 'output':
+            raise PinInvalidFunction(f'{self._info.name} is driven by the PWM peripheral and can only be an output')
+
+    def _get_state(self):
+        return self._state
+
+    def _set_state(self, value):
+        if not 0 <= value <= 1:
+            raise PinInvalidState(f'invalid state "{value}" for pin {self._info.name}')
+        self._state = float(value)
+        if self._period_ns > 0:
+            self._duty_file.write(int(round(self._state * self._period_ns)))
+
+    def _get_frequency(self):
+        return self._frequency
+
+    def _set_frequency(self, value):
+        if value is None:
+            self._enable_file.write(0)
+            self._frequency = None
+            self._period_ns = 0
+            return
+        self._frequency = float(value)
+        self._period_ns = int(round(1e9 / self._frequency))
+        # The duty cycle may never exceed the period, so clear it before changing the period.
+        self._duty_file.write(0)
+        self._period_file.write(self._period_ns)
+        self._duty_file.write(int(round(self._state * self._period_ns)))
+        self._enable_file.write(1)
+
+    def close(self):
+        if self._period_ns > 0:
+            self._set_frequency(None)
+        for attribute in (self._period_file, self._duty_file, self._enable_file):
+            attribute.close()
+
+
+class HardwarePWMFactory(Factory):
+    """
+    Hands out a SysfsPWMPin for the one pin wired to the PWM peripheral and defers everything else, including board
+    information and pin reservations, to another pin factory.
+    """
+
+    def __init__(self, base: Factory, pin_name: int | str, chip: Path, channel: int):
+        super(HardwarePWMFactory, self).__init__()
+        self._base = base
+        self._chip = chip
+        self._channel = channel
+        self._pin_info = next(info for _, info in base.board_info.find_pin(pin_name))
+        self._pin: SysfsPWMPin | None = None
+
+    def _get_board_info(self):
+        return self._base.board_info
+
+    def ticks(self):
+        return self._base.ticks()
+
+    def ticks_diff(self, later, earlier):
+        return self._base.ticks_diff(later, earlier)
+
+    def pin(self, name):
+        for _, info in self.board_info.find_pin(name):
+            if info != self._pin_info:
+                return self._base.pin(name)
+            if self._pin is None:
+                self._pin = SysfsPWMPin(self, info, self._chip, self._channel)
+            return self._pin
+        return self._base.pin(name)
+
+    def close(self):
+        if self._pin is not None:
+            self._pin.close()
+            self._pin = None
@@ -0,0 +1,190 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import time
+from threading import Thread
+
+import tomli
+
+import piosk.config
+from piosk.config import CONFIG, ConfigError
+from piosk.util import error, log, warning
+
+# From <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+# Editors usually save with several writes or a write and a rename. Wait for them to settle before reloading.
+_SETTLE_SECONDS = 0.1
+# Used when inotify is unavailable.
+_POLL_SECONDS = 2.0
+
+
+def reload_config() -> bool:
+    """
+    Re-read config.toml and apply it. If it is invalid, the running config is kept.
+
+    :return: True if the new config was applied.
+    """
+    try:
+        changed, errors = piosk.config.reload()
+    except (ConfigError, tomli.TOMLDecodeError, OSError) as e:
+        warning('Config reload failed, keeping the current config: %s', e)
+        return False
+    if len(changed) > 0:
+        log('Reloaded config. Changed sections: %s.', ', '.join(changed))
+    else:
+        log('Reloaded config. Nothing changed.')
+    for callback, e in errors:
+        error('Applying reloaded config with %s failed: %s', getattr(callback, '__name__', callback), e)
+    return True
+
+
+def _open_inotify() -> int | None:
+    """
+    :return: A non-blocking inotify descriptor watching the config file's directory, or None if inotify is unavailable.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # Watch the directory rather than the file, so saves that replace the file are seen too.
+    directory = os.fsencode(piosk.config.CONFIG_PATH.parent)
+    if libc.inotify_add_watch(fd, directory, _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _config_changed(fd: int) -> bool:
+    """
+    Drain pending inotify events.
+
+    :return: True if any of them were for the config file.
+    """
+    name = os.fsencode(piosk.config.CONFIG_PATH.name)
+    changed = False
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            if data[offset:offset + length].rstrip(b'\0') == name:
+                changed = True
+            offset += length
+
+
+def _config_mtime() -> float | None:
+    try:
+        return piosk.config.CONFIG_PATH.stat().st_mtime
+    except OSError:
+        return None
+
+
+class ConfigWatcherThread(Thread):
+    """
+    Reloads the config when config.toml is saved or piosk receives SIGHUP. The thread sleeps in select() on an inotify
+    descriptor and a wake-up pipe, so it costs nothing between changes. Without inotify it polls the file's mtime.
+    """
+
+    def __init__(self, watch: bool):
+        """
+        :param watch: Watch config.toml for changes. If False, only SIGHUP triggers a reload.
+        """
+        super(ConfigWatcherThread, self).__init__(name='piosk-config', daemon=True)
+        self._watch = watch
+        self._inotify_fd = _open_inotify() if watch else None
+        self._wake_read, self._wake_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def request_reload(self):
+        """
+        Ask the thread to reload. Safe to call from a signal handler.
+        """
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            # A reload is already pending.
+            pass
+
+    def run(self):
+        readers = [self._wake_read] if self._inotify_fd is None else [self._wake_read, self._inotify_fd]
+        poll = self._watch and self._inotify_fd is None
+        timeout = _POLL_SECONDS if poll else None
+        mtime = _config_mtime()
+        while True:
+            ready, _, _ = select.select(readers, [], [], timeout)
+            reload = False
+            if self._wake_read in ready:
+                while True:
+                    try:
+                        os.read(self._wake_read, 64)
+                    except BlockingIOError:
+                        break
+                reload = True
+            if self._inotify_fd in ready and _config_changed(self._inotify_fd):
+                time.sleep(_SETTLE_SECONDS)
+                _config_changed(self._inotify_fd)
+                reload = True
+            if poll and _config_mtime() != mtime:
+                reload = True
+            if reload:
+                mtime = _config_mtime()
+                reload_config()
+
+
+_WATCHER_THREAD: ConfigWatcherThread
+
+
+def start_config_watcher():
+    """
+    Start watching the config. Must be called from the main thread so the SIGHUP handler can be installed.
+    """
+    global _WATCHER_THREAD
+    _WATCHER_THREAD = ConfigWatcherThread(CONFIG['runtime']['WATCH_CONFIG'])
+    if CONFIG['runtime']['WATCH_CONFIG'] is True:
+        log('Watching %s for changes.', piosk.config.CONFIG_PATH)
+    signal.signal(signal.SIGHUP, lambda signum, frame: _WATCHER_THREAD.request_reload())
+    _WATCHER_THREAD.start()
+
+
+async def run_config_watcher_async():
+    """
+    Coroutine equivalent of start_config_watcher() for the asyncio runtime. The inotify descriptor and SIGHUP are both
+    handled by the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    pending: asyncio.TimerHandle | None = None
+
+    def schedule_reload(delay: float = 0):
+        nonlocal pending
+        if pending is not None:
+            pending.cancel()
+        pending = loop.call_later(delay, reload_config)
+
+    loop.add_signal_handler(signal.SIGHUP, schedule_reload)
+    if CONFIG['runtime']['WATCH_CONFIG'] is not True:
+        return
+    fd = _open_inotify()
+    if fd is not None:
+        log('Watching %s for changes.', piosk.config.CONFIG_PATH)
+        loop.add_reader(fd, lambda: _config_changed(fd) and schedule_reload(_SETTLE_SECONDS))
+        return
+    mtime = _config_mtime()
+    while True:
+        await asyncio.sleep(_POLL_SECONDS)
+        if _config_mtime() != mtime:
+            mtime = _config_mtime()
+            reload_config()
@@ -0,0 +1,181 @@
+import asyncio
+import concurrent.futures
+import time
+from threading import Condition, Event, Thread
+from typing import Any, Callable, Coroutine
+
+from piosk.util import log
+
+_LOOP: asyncio.AbstractEventLoop | None = None
+
+
+def is_active() -> bool:
+    """
+    :return: True if the asyncio runtime's event loop is currently running.
+    """
+    return _LOOP is not None and _LOOP.is_running()
+
+
+def get_loop() -> asyncio.AbstractEventLoop | None:
+    return _LOOP
+
+
+def call_soon(callback: Callable[..., Any], *args):
+    """
+    Run a callback on the event loop thread. This is safe to call from gpiozero's callback threads. If the runtime is
+    not active, the callback is executed immediately on the calling thread.
+    """
+    if is_active():
+        _LOOP.call_soon_threadsafe(callback, *args)
+    else:
+        callback(*args)
+
+
+def submit(coro: Coroutine) -> concurrent.futures.Future:
+    """
+    Schedule a coroutine on the event loop from any thread.
+
+    :return: A future that can be cancelled from any thread to cancel the coroutine.
+    """
+    if not is_active():
+        coro.close()
+        raise RuntimeError('The asyncio runtime is not running.')
+    return asyncio.run_coroutine_threadsafe(coro, _LOOP)
+
+
+class LoopEvent(Event):
+    """
+    A threading.Event that can also be awaited by coroutines running on the asyncio runtime. Setting the event from
+    any thread wakes both blocked threads and awaiting coroutines.
+    """
+
+    def __init__(self):
+        super(LoopEvent, self).__init__()
+        self._waiters: set[asyncio.Future] = set()
+
+    def set(self):
+        super(LoopEvent, self).set()
+        if is_active():
+            _LOOP.call_soon_threadsafe(self._wake_waiters)
+
+    def _wake_waiters(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+        self._waiters.clear()
+
+    async def wait_async(self, timeout: float | None = None) -> bool:
+        """
+        Coroutine equivalent of Event.wait(). Must be awaited on the runtime's event loop.
+
+        :param timeout: Number of seconds to wait, or None to wait until the event is set.
+        :return: True if the event is set, False if the timeout elapsed first.
+        """
+        if self.is_set():
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiters.discard(waiter)
+        return self.is_set()
+
+
+class DeadlineTimer:
+    """
+    Calls `callback(deadline)` once a deadline passes. The deadline can be moved or cleared at any time from any thread,
+    and only the latest one fires. On the asyncio runtime this is an event loop timer; otherwise one thread per timer
+    sleeps until the next deadline, so rescheduling never starts a new thread.
+    """
+
+    def __init__(self, callback: Callable[[float], Any], name: str = 'piosk-timer'):
+        self._callback = callback
+        self._name = name
+        self._condition = Condition()
+        self._deadline: float | None = None
+        self._handle: asyncio.TimerHandle | None = None
+        self._thread: Thread | None = None
+
+    def schedule(self, deadline: float):
+        """
+        :param deadline: A time.monotonic() value.
+        """
+        with self._condition:
+            self._deadline = deadline
+            if not is_active():
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name=self._name, daemon=True)
+                    self._thread.start()
+                self._condition.notify()
+                return
+        self._rearm_soon()
+
+    def cancel(self):
+        with self._condition:
+            self._deadline = None
+            if not is_active():
+                self._condition.notify()
+                return
+        self._rearm_soon()
+
+    def _rearm_soon(self):
+        try:
+            on_loop = asyncio.get_running_loop() is _LOOP
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._rearm()
+        else:
+            _LOOP.call_soon_threadsafe(self._rearm)
+
+    def _rearm(self):
+        # Runs on the event loop. The loop's clock is time.monotonic(), so deadlines can be used as they are.
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        with self._condition:
+            deadline = self._deadline
+        if deadline is not None:
+            self._handle = _LOOP.call_at(deadline, self._fire_async, deadline)
+
+    def _fire_async(self, deadline: float):
+        self._handle = None
+        with self._condition:
+            if self._deadline != deadline:
+                return
+            self._deadline = None
+        self._callback(deadline)
+
+    def _has_expired(self) -> bool:
+        return self._deadline is not None and self._deadline <= time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._has_expired():
+                    self._condition.wait(None if self._deadline is None else self._deadline - time.monotonic())
+                deadline = self._deadline
+                self._deadline = None
+            self._callback(deadline)
+
+
+async def _gather(coroutines: tuple[Coroutine, ...]):
+    await asyncio.gather(*coroutines)
+
+
+def run(*coroutines: Coroutine):
+    """
+    Run every subsystem coroutine on a single event loop owned by the calling thread. Blocks until all of them finish.
+    """
+    global _LOOP
+    _LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(_LOOP)
+    log(f'Starting asyncio runtime with {len(coroutines)} tasks.')
+    try:
+        _LOOP.run_until_complete(_gather(coroutines))
+    finally:
+        _LOOP.close()
+        _LOOP = None
@@ -1,66 +1,278 @@
-import subprocess
+import asyncio
 import time
 from enum import Enum
 from threading import Lock
 
 import piosk.brightness
+import piosk.browser
+import piosk.hardware
+import piosk.metrics
 import piosk.motion
-from piosk.config import CONFIG
+import piosk.state
+from piosk.config import CONFIG, ScreensaverSettings, get_config, subscribe
 from piosk.led import LedInstructionProvidingThread
-from piosk.util import log
+from piosk.runtime import DeadlineTimer
+from piosk.util import TimedLock, debug, log
+from piosk.xscreensaver import (ScreensaverBackend, ScreensaverEvent, create_backend, parse_watch_line,
+                                read_fade_settings)
 
+_BACKEND: ScreensaverBackend | None = None
+_BACKEND_LOCK = Lock()
 
-class ScreensaverEvent(Enum):
-    NONE = 0
-    ACTIVATED = 1
-    DEACTIVATED = 2
+
+def get_backend() -> ScreensaverBackend:
+    """
+    :return: The screensaver backend, connecting to it on first use.
+    """
+    global _BACKEND
+    with _BACKEND_LOCK:
+        if _BACKEND is None:
+            name = 'scripted' if piosk.hardware.is_fake() else CONFIG['screensaver']['BACKEND']
+            _BACKEND = create_backend(name, CONFIG['screensaver']['DISPLAY'])
+            log('Using %s screensaver backend.', _BACKEND.name)
+        return _BACKEND
 
 
 _CURRENT_STATUS: ScreensaverEvent = ScreensaverEvent.DEACTIVATED
-_STATUS_LOCK = Lock()
+_STATUS_LOCK = TimedLock()
+_TRANSITIONS = piosk.metrics.counter('piosk_screensaver_transitions_total', 'Screensaver state changes.', ('state',))
+piosk.metrics.register_lock('screensaver_status', _STATUS_LOCK)
+_CANCELLED_POWER_OFFS = piosk.metrics.counter(
+    'piosk_screensaver_cancelled_power_offs_total', 'Backlight power-offs skipped because the screen woke mid-fade.'
+)
+
+
+class DisplayState(Enum):
+    ACTIVE = 'active'        # Screensaver off, backlight on.
+    BLANKING = 'blanking'    # xscreensaver is fading out. The backlight goes off once it finishes.
+    OFF = 'off'              # Screensaver on, backlight off.
+    WAKING = 'waking'        # Backlight back on while xscreensaver fades back in.
+
+
+class PokeDispatcher:
+    """
+    Coalesces screensaver pokes from the button and motion sensor. Pokes arriving within the debounce window of the
+    last issued poke only reset an idle timer that was just reset, so they are suppressed, as are pokes arriving while
+    another is in flight. A poke that would wake the screen is never dropped: while another is in flight, it is queued
+    and sent by that poke's caller once its command is done.
+    """
+
+    def __init__(self, window: float):
+        self._window = window
+        self._lock = Lock()
+        self._last_issued: float = float('-inf')
+        self._in_flight: bool = False
+        self._wake_queued: bool = False
+        self.received: int = 0
+        self.issued: int = 0
+        self.suppressed: int = 0
+
+    def set_window(self, window: float):
+        with self._lock:
+            self._window = window
+
+    def poke(self, waking: bool) -> bool:
+        """
+        :param waking: True if the screensaver is currently active.
+        :return: True if this poke wakes the screen: it was waking, and its deactivate command was issued or queued.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.received += 1
+            if self._in_flight:
+                if waking and not self._wake_queued:
+                    self._wake_queued = True
+                else:
+                    self.suppressed += 1
+                return waking
+            if not waking and now - self._last_issued < self._window:
+                self.suppressed += 1
+                return False
+            self._in_flight = True
+        woke = False
+        while True:
+            try:
+                issued = get_backend().deactivate()
+            except BaseException:
+                with self._lock:
+                    # Neither this poke nor a wake queued behind it is sent.
+                    self.suppressed += 2 if self._wake_queued else 1
+                    self._in_flight = self._wake_queued = False
+                raise
+            with self._lock:
+                if issued:
+                    self._last_issued = time.monotonic()
+                    self.issued += 1
+                else:
+                    self.suppressed += 1
+                queued, self._wake_queued = self._wake_queued, False
+                self._in_flight = queued
+            woke = woke or (waking and issued)
+            if not queued:
+                return woke
+
+
+_POKE_DISPATCHER = PokeDispatcher(get_config().screensaver.poke_debounce_seconds)
+
+
+def _on_screensaver_config(settings: ScreensaverSettings):
+    _POKE_DISPATCHER.set_window(settings.poke_debounce_seconds)
+
+
+subscribe('screensaver', _on_screensaver_config)
+
+
+def poke_stats() -> dict[str, int]:
+    return {
+        'pokes_received': _POKE_DISPATCHER.received,
+        'pokes_issued': _POKE_DISPATCHER.issued,
+        'pokes_suppressed': _POKE_DISPATCHER.suppressed,
+    }
+
+
+piosk.metrics.callback(
+    'piosk_screensaver_pokes_total', 'Screensaver pokes from the button and motion sensor, by outcome.', 'counter',
+    lambda: {('issued',): _POKE_DISPATCHER.issued, ('suppressed',): _POKE_DISPATCHER.suppressed}, ('result',)
+)
 
 
 def update_status(status: ScreensaverEvent):
     global _CURRENT_STATUS
     with _STATUS_LOCK:
         _CURRENT_STATUS = status
+    _TRANSITIONS.inc(status.name.lower())
+    piosk.state.update(screensaver='active' if status is ScreensaverEvent.ACTIVATED else 'inactive')
 
 
 class ScreensaverThread(LedInstructionProvidingThread):
+    """
+    Follows the screensaver through the DisplayState states. The backlight is only powered off once xscreensaver has
+    finished fading out, which is timed by a DeadlineTimer rather than a sleep, so a wake-up in the middle of the fade
+    is handled straight away and the pending power-off is dropped.
+    """
 
-    def run(self):
-        process = subprocess.Popen(
-            ["xscreensaver-command", "--display", CONFIG['screensaver']['DISPLAY'], "--watch"],
-            stdout=subprocess.PIPE
-        )
-        while process.poll() is None:
-            line = process.stdout.readline()
-            result = self.process_event(line.decode("utf-8"))
-            if result is ScreensaverEvent.ACTIVATED:
-                log("Screensaver activated. Turn LED on.")
-                self._led_on()
-                update_status(result)
-                # TODO: Parse screen fade value from .xscreensaver config file. Use for power-off delay for fade.
-                #  (Add 0.5 seconds to delay so fade animation can complete.)
-                time.sleep(1.5)
-                piosk.brightness.turn_screen_off()
-                piosk.motion.wake_motion_sensor()
-            elif result is ScreensaverEvent.DEACTIVATED:
-                log("Screensaver deactivated. Turn LED off.")
-                self._led_off()
-                update_status(result)
-                piosk.brightness.turn_screen_on()
-                piosk.motion.cancel_motion_monitoring()
+    def __init__(self):
+        super(ScreensaverThread, self).__init__()
+        self._state_lock = Lock()
+        self._state: DisplayState = DisplayState.ACTIVE
+        self._deadline: float | None = None
+        self._timer = DeadlineTimer(self._on_deadline, 'piosk-screensaver')
+
+    @property
+    def state(self) -> DisplayState:
+        return self._state
+
+    def _set_state(self, state: DisplayState, deadline: float | None = None):
+        # Must be called with _state_lock held.
+        debug('Display state %s -> %s.', self._state.value, state.value)
+        self._state = state
+        self._deadline = deadline
+        if deadline is None:
+            self._timer.cancel()
+        else:
+            self._timer.schedule(deadline)
+
+    def _restore(self, status: ScreensaverEvent | None):
+        """
+        Bring the LED, backlight and motion sensor in line with the screensaver's actual state, which may have changed
+        while piosk was not running.
+
+        :param status: The queried screensaver status, or None to fall back to the saved state.
+        """
+        if status is None:
+            saved = piosk.state.load().get('screensaver')
+            status = ScreensaverEvent.ACTIVATED if saved == 'active' else ScreensaverEvent.DEACTIVATED
+        with self._state_lock:
+            if status is ScreensaverEvent.ACTIVATED:
+                # Any fade finished long ago.
+                self._on_activated()
+                self._on_blanked()
+                self._set_state(DisplayState.OFF)
+                piosk.browser.get_supervisor().screen_blanked()
+                piosk.browser.get_supervisor().screen_off()
             else:
-                pass  # Nothing to do here.
+                piosk.browser.get_supervisor().recover()
+                if not piosk.brightness.screen_is_on():
+                    self._on_deactivated()
+                else:
+                    update_status(status)
+                self._set_state(DisplayState.ACTIVE)
+
+    def handle_event(self, event: ScreensaverEvent):
+        """
+        Advance the state machine for a screensaver event. Never blocks on the fade.
+        """
+        with self._state_lock:
+            if event is ScreensaverEvent.ACTIVATED:
+                if self._state in (DisplayState.BLANKING, DisplayState.OFF):
+                    return
+                self._on_activated()
+                piosk.browser.get_supervisor().screen_blanked()
+                settings = get_config().screensaver
+                fade = read_fade_settings(settings.xscreensaver_file).blank_duration
+                self._set_state(DisplayState.BLANKING, time.monotonic() + fade + settings.power_off_margin_seconds)
+            elif event is ScreensaverEvent.DEACTIVATED:
+                if self._state in (DisplayState.BLANKING, DisplayState.OFF):
+                    # Thaw first, so the browser is already repainting while the backlight comes on.
+                    piosk.browser.get_supervisor().screen_unblanked()
+                if self._state is DisplayState.BLANKING:
+                    # Woken mid-fade. The backlight never went off, so there's nothing to power back on.
+                    _CANCELLED_POWER_OFFS.inc()
+                    self._on_deactivated()
+                    self._set_state(DisplayState.ACTIVE)
+                elif self._state is DisplayState.OFF:
+                    self._on_deactivated()
+                    settings = get_config().screensaver
+                    unfade = read_fade_settings(settings.xscreensaver_file).unblank_duration
+                    self._set_state(DisplayState.WAKING, time.monotonic() + unfade)
+
+    def _on_deadline(self, deadline: float):
+        with self._state_lock:
+            # The timer may have fired just as an event moved it, so check the deadline still applies.
+            if deadline != self._deadline:
+                return
+            if self._state is DisplayState.BLANKING:
+                self._on_blanked()
+                self._set_state(DisplayState.OFF)
+                piosk.browser.get_supervisor().screen_off()
+            elif self._state is DisplayState.WAKING:
+                self._set_state(DisplayState.ACTIVE)
+
+    def run(self):
+        self._restore(get_backend().status())
+        for result in get_backend().watch():
+            self.handle_event(result)
+
+    async def run_async(self):
+        """
+        Coroutine equivalent of run() for the asyncio runtime.
+        """
+        # The status query may run xscreensaver-command, so keep it off the event loop.
+        self._restore(await asyncio.to_thread(get_backend().status))
+        async for result in get_backend().watch_async():
+            self.handle_event(result)
+
+    def _on_activated(self):
+        log("Screensaver activated. Turn LED on.")
+        self._led_on()
+        update_status(ScreensaverEvent.ACTIVATED)
+
+    def _on_blanked(self):
+        piosk.brightness.turn_screen_off()
+        piosk.motion.wake_motion_sensor()
+
+    def _on_deactivated(self):
+        log("Screensaver deactivated. Turn LED off.")
+        self._led_off()
+        update_status(ScreensaverEvent.DEACTIVATED)
+        piosk.brightness.turn_screen_on()
+        piosk.motion.cancel_motion_monitoring()
 
     def process_event(self, text: str) -> ScreensaverEvent:
-        return ScreensaverEvent.DEACTIVATED if text.find("UNBLANK") > -1 \
-            else ScreensaverEvent.ACTIVATED if text.find("BLANK") > -1 \
-            else ScreensaverEvent.NONE
+        return parse_watch_line(text)
 
 
-_SCREENSAVER_THREAD: ScreensaverThread
+_SCREENSAVER_THREAD: ScreensaverThread | None = None
 
 
 def start_screensaver_thread():
@@ -69,6 +281,12 @@ def start_screensaver_thread():
     _SCREENSAVER_THREAD.start()
 
 
+async def run_screensaver_async():
+    global _SCREENSAVER_THREAD
+    _SCREENSAVER_THREAD = ScreensaverThread()
+    await _SCREENSAVER_THREAD.run_async()
+
+
 def join_screensaver_thread():
     global _SCREENSAVER_THREAD
     _SCREENSAVER_THREAD.join()
@@ -79,16 +297,18 @@ def get_status() -> ScreensaverEvent:
         return _CURRENT_STATUS
 
 
+def get_display_state() -> DisplayState:
+    if _SCREENSAVER_THREAD is None:
+        return DisplayState.ACTIVE
+    return _SCREENSAVER_THREAD.state
+
+
 def activate_screensaver():
     """
     Engage the screensaver and put the display to sleep.
     """
     if get_status() != ScreensaverEvent.ACTIVATED:
-        subprocess.Popen(
-            ["xscreensaver-command", "--display", CONFIG['screensaver']['DISPLAY'], "--activate"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+        get_backend().activate()
 
 
 def poke_screensaver():
@@ -98,10 +318,4 @@ def poke_screensaver():
 
     :return: True if the screensaver was woken up by this action.
     """
-    status = get_status()
-    subprocess.Popen(
-        ["xscreensaver-command", "--display", CONFIG['screensaver']['DISPLAY'], "--deactivate"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    return status == ScreensaverEvent.ACTIVATED
+    return _POKE_DISPATCHER.poke(get_status() == ScreensaverEvent.ACTIVATED)
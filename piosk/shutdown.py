@@ -0,0 +1,121 @@
+import concurrent.futures
+import ctypes
+import os
+import queue
+import shlex
+import signal
+import socket
+import subprocess
+from pathlib import Path
+from threading import Lock, Thread
+
+import piosk.hardware
+from piosk.config import CONFIG, get_config
+from piosk.util import log, warning
+
+_PROJECT_PATH = Path(__file__).parent.parent
+_PROCESS: subprocess.Popen | None = None
+_PROCESS_LOCK = Lock()
+# From <sys/prctl.h>.
+_PR_SET_PDEATHSIG = 1
+# Looked up here rather than in the child: after fork, a multithreaded process may only do async-signal-safe work. libc
+# is already loaded, so this only looks the symbol up in the running process.
+_PRCTL = ctypes.CDLL(None, use_errno=True).prctl
+# PR_SET_PDEATHSIG fires when the thread that forked the child exits, not the whole process. Gesture actions can run on
+# threads that exit, so the resident menu is only ever forked from the spawner thread, which lives as long as piosk.
+_SPAWN_QUEUE: queue.SimpleQueue = queue.SimpleQueue()
+_SPAWN_THREAD: Thread | None = None
+
+
+def _is_resident() -> bool:
+    return CONFIG['shutdown']['RESIDENT'] is True and not piosk.hardware.is_fake()
+
+
+def _exit_with_parent():
+    # Runs in the child before exec. The resident menu must not outlive piosk.
+    _PRCTL(_PR_SET_PDEATHSIG, signal.SIGTERM)
+
+
+def _spawn(*args: str) -> subprocess.Popen | None:
+    command = get_config().shutdown.script_cmd
+    env = dict(os.environ)
+    env.setdefault('DISPLAY', CONFIG['screensaver']['DISPLAY'])
+    try:
+        return subprocess.Popen([*shlex.split(command), *args], cwd=_PROJECT_PATH, env=env,
+                                preexec_fn=_exit_with_parent if _is_resident() else None)
+    except OSError as e:
+        warning('Could not start the shutdown menu with `%s`: %s', command, e)
+        return None
+
+
+def _spawner():
+    while True:
+        future, args = _SPAWN_QUEUE.get()
+        try:
+            future.set_result(_spawn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+
+def _spawn_resident(*args: str) -> subprocess.Popen | None:
+    """
+    Start the resident menu from the spawner thread, and wait for it to be started. Must be called with _PROCESS_LOCK
+    held.
+    """
+    global _SPAWN_THREAD
+    if _SPAWN_THREAD is None:
+        _SPAWN_THREAD = Thread(target=_spawner, name='piosk-shutdown-menu', daemon=True)
+        _SPAWN_THREAD.start()
+    future = concurrent.futures.Future()
+    _SPAWN_QUEUE.put((future, args))
+    return future.result()
+
+
+def _send_show() -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(b'show', CONFIG['shutdown']['SOCKET'])
+        except OSError:
+            return False
+    return True
+
+
+def start_shutdown_menu():
+    """
+    Start the shutdown menu in the background with its window built but hidden, so opening it later only has to map
+    the window. Does nothing unless [shutdown] RESIDENT is enabled.
+    """
+    global _PROCESS
+    if not _is_resident():
+        return
+    with _PROCESS_LOCK:
+        _PROCESS = _spawn_resident('--resident', CONFIG['shutdown']['SOCKET'])
+    log('Started the resident shutdown menu.')
+
+
+def open_shutdown_menu() -> bool:
+    """
+    Show the resident shutdown menu, or run [shutdown] SCRIPT_CMD from the project directory if there isn't one. A
+    resident menu that has exited is restarted and shown as soon as it is built.
+
+    :return: True if the menu was shown or started.
+    """
+    global _PROCESS
+    with _PROCESS_LOCK:
+        # poll() also reaps a menu that has already exited.
+        running = _PROCESS is not None and _PROCESS.poll() is None
+        if running and _is_resident() and _send_show():
+            log('Showing the shutdown menu.')
+            return True
+        if running:
+            # A one-shot menu is already open, or the resident menu is still being built.
+            return False
+        if _is_resident():
+            warning('The resident shutdown menu had exited. Restarting it.')
+            _PROCESS = _spawn_resident('--resident', CONFIG['shutdown']['SOCKET'], '--show')
+        else:
+            _PROCESS = _spawn()
+    if _PROCESS is None:
+        return False
+    log('Opened the shutdown menu.')
+    return True
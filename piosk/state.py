@@ -0,0 +1,119 @@
+import atexit
+import json
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock, Timer
+from typing import Any
+
+import piosk.hardware
+import piosk.metrics
+from piosk.config import CONFIG
+from piosk.util import warning
+
+_SAVE_DELAY = CONFIG['state']['SAVE_DELAY_SECONDS']
+
+_STATE: dict[str, Any] | None = None
+_LOCK = Lock()
+_WRITE_LOCK = Lock()
+_TIMER: Timer | None = None
+_DIRTY: bool = False
+_SAVES = piosk.metrics.counter('piosk_state_saves_total', 'Runtime state snapshots written to disk.')
+
+
+@lru_cache(maxsize=None)
+def state_path() -> Path:
+    """
+    :return: Where runtime state is saved. Runs against fake hardware use a throwaway file.
+    """
+    if piosk.hardware.is_fake():
+        return Path(tempfile.mkdtemp(prefix='piosk-state-')) / 'state.json'
+    return Path(__file__).parent.parent / CONFIG['state']['FILE']
+
+
+def _read() -> dict[str, Any]:
+    path = state_path()
+    try:
+        with path.open('r') as f:
+            state = json.load(f)
+        if isinstance(state, dict):
+            return state
+        warning('Ignoring malformed state file %s.', path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        warning('Ignoring unreadable state file %s: %s', path, e)
+    return {}
+
+
+def _loaded() -> dict[str, Any]:
+    # Must be called with _LOCK held.
+    global _STATE
+    if _STATE is None:
+        _STATE = _read()
+    return _STATE
+
+
+def load() -> dict[str, Any]:
+    """
+    :return: A copy of the runtime state saved by the last run, including any updates made since.
+    """
+    with _LOCK:
+        return dict(_loaded())
+
+
+def update(**values):
+    """
+    Record changed runtime state. Changes are coalesced and written SAVE_DELAY_SECONDS after the first one, so a
+    fade's frames only cost a single write. Values equal to the recorded ones are ignored.
+    """
+    global _TIMER, _DIRTY
+    with _LOCK:
+        state = _loaded()
+        for key, value in values.items():
+            if state.get(key) != value:
+                state[key] = value
+                _DIRTY = True
+        if not _DIRTY or _TIMER is not None:
+            return
+        _TIMER = Timer(_SAVE_DELAY, _save)
+        _TIMER.daemon = True
+        _TIMER.start()
+
+
+def _save():
+    global _TIMER, _DIRTY
+    with _WRITE_LOCK:
+        with _LOCK:
+            _TIMER = None
+            if not _DIRTY:
+                return
+            _DIRTY = False
+            data = json.dumps(_STATE)
+        # Write then rename, so a crash or power cut never leaves a truncated file behind.
+        path = state_path()
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            with tmp_path.open('w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            _SAVES.inc()
+        except OSError as e:
+            warning('Could not save runtime state to %s: %s', path, e)
+
+
+def flush():
+    """
+    Write any pending changes now.
+    """
+    with _LOCK:
+        timer = _TIMER
+    if timer is not None:
+        timer.cancel()
+    _save()
+
+
+atexit.register(flush)
@@ -0,0 +1,129 @@
+import os
+import time
+from pathlib import Path
+from threading import Lock
+
+import piosk.metrics
+from piosk.runtime import DeadlineTimer
+from piosk.util import warning
+
+
+class SysfsAttribute:
+    """
+    A sysfs attribute file that is opened once and kept open. Values are read with pread() and written with pwrite() at
+    offset 0, so each access costs a single syscall.
+
+    Writes that come less than `min_interval` seconds after the last one are merged: the value waits in a pending slot,
+    and a DeadlineTimer writes the latest one once the interval has passed. At most one value goes out per interval,
+    and the deferred write happens on the timer, outside whatever lock the caller holds.
+    """
+
+    def __init__(self, path: Path, min_interval: float = 0.0):
+        """
+        :param path: The attribute file.
+        :param min_interval: Shortest time between two writes, in seconds. Zero writes every value straight away.
+        """
+        self.path = path
+        self._min_interval = min_interval
+        self._fd: int | None = None
+        self._lock = Lock()
+        self._pending: bytes | None = None
+        self._next_write_at: float = float('-inf')
+        self._timer = DeadlineTimer(self._flush, 'piosk-sysfs') if min_interval > 0 else None
+        # A sysfs attribute takes each write as its whole new value. Anything else, such as the fake hardware backend's
+        # tmpfs files, has to be truncated after a shorter value is written.
+        self._truncate = not Path(os.path.realpath(path)).is_relative_to('/sys')
+        self.writes_issued: int = 0
+        self.writes_merged: int = 0
+
+    def _get_fd(self) -> int:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR)
+        return self._fd
+
+    def read(self) -> str:
+        with self._lock:
+            if self._pending is not None:
+                # Callers expect to read back the value they last wrote.
+                return self._pending.decode()
+        return os.pread(self._get_fd(), 64, 0).decode().strip()
+
+    def write(self, value):
+        data = str(value).encode()
+        with self._lock:
+            now = time.monotonic()
+            if self._pending is None and now >= self._next_write_at:
+                self._write(data, now)
+                return
+            if self._pending is not None:
+                self.writes_merged += 1
+            else:
+                self._timer.schedule(self._next_write_at)
+            self._pending = data
+
+    def _write(self, data: bytes, now: float):
+        # Must be called with _lock held.
+        os.pwrite(self._get_fd(), data, 0)
+        if self._truncate:
+            os.ftruncate(self._fd, len(data))
+        self.writes_issued += 1
+        self._next_write_at = now + self._min_interval
+
+    def flush(self):
+        """
+        Write the pending value, if there is one, without waiting for the interval to pass.
+        """
+        with self._lock:
+            if self._pending is not None:
+                data, self._pending = self._pending, None
+                self._write(data, time.monotonic())
+
+    def _flush(self, deadline: float):
+        try:
+            self.flush()
+        except OSError as e:
+            warning('Could not write %s: %s', self.path, e)
+
+    def close(self):
+        self.flush()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+_ATTRIBUTES: dict[Path, SysfsAttribute] = {}
+_ATTRIBUTES_LOCK = Lock()
+
+
+def attribute(path: Path, min_interval: float = 0.0) -> SysfsAttribute:
+    """
+    :param min_interval: Shortest time between two writes, used when the attribute is first created.
+    :return: The shared SysfsAttribute for the given path, creating it on first use.
+    """
+    with _ATTRIBUTES_LOCK:
+        attr = _ATTRIBUTES.get(path)
+        if attr is None:
+            attr = _ATTRIBUTES[path] = SysfsAttribute(path, min_interval)
+        return attr
+
+
+def write_stats() -> dict[str, tuple[int, int]]:
+    """
+    :return: A mapping of sysfs path to the number of (issued, merged) writes.
+    """
+    with _ATTRIBUTES_LOCK:
+        return {str(path): (attr.writes_issued, attr.writes_merged) for path, attr in _ATTRIBUTES.items()}
+
+
+def _write_samples() -> dict[tuple[str, ...], float]:
+    samples = {}
+    for path, (issued, merged) in write_stats().items():
+        samples[(path, 'issued')] = issued
+        samples[(path, 'merged')] = merged
+    return samples
+
+
+piosk.metrics.callback(
+    'piosk_sysfs_writes_total', 'Writes to sysfs attributes, by whether they were issued or merged into a later one.',
+    'counter', _write_samples, ('path', 'result')
+)
@@ -1,5 +1,76 @@
-from datetime import datetime
+import importlib
+import sys
+import time
+from contextlib import contextmanager
+from threading import Lock
 
+from piosk.logger import Level, debug, error, log, warning  # noqa: F401
 
-def log(message: str):
-    print(f'{datetime.timestamp(datetime.now())} :: {message}')
+
+_STARTUP_TIMINGS: list[tuple[str, float]] = []
+
+
+@contextmanager
+def timed(name: str):
+    """
+    Record how long the body takes in the startup timing report.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _STARTUP_TIMINGS.append((name, time.perf_counter() - start))
+
+
+def import_timed(*module_names: str):
+    """
+    Import each module in order, recording its import time. List leaf modules first so that each figure mostly
+    covers the module itself rather than its dependencies.
+    """
+    for name in module_names:
+        if name not in sys.modules:
+            with timed(f'import {name}'):
+                importlib.import_module(name)
+
+
+def log_startup_report():
+    total = sum(seconds for _, seconds in _STARTUP_TIMINGS)
+    log(f'Startup timing ({total * 1000:.1f} ms):')
+    for name, seconds in _STARTUP_TIMINGS:
+        log(f'  {name:<32}{seconds * 1000:>8.1f} ms')
+
+
+class TimedLock:
+    """
+    A Lock that records how long callers waited to acquire it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.acquisitions: int = 0
+        self.total_wait: float = 0.0
+        self.max_wait: float = 0.0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        start = time.monotonic()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            # Stats are only updated while the lock is held.
+            wait = time.monotonic() - start
+            self.acquisitions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
@@ -0,0 +1,107 @@
+import asyncio
+from threading import Thread
+
+import piosk.metrics
+from piosk.browser import get_supervisor, read_memory
+from piosk.config import BrowserSettings, get_config, subscribe
+from piosk.runtime import LoopEvent
+from piosk.util import debug
+
+
+class MemoryWatchdogThread(Thread):
+    """
+    Samples the browser's memory every MEMORY_POLL_SECONDS and asks for a restart once it passes MEMORY_LIMIT_MB. Each
+    sample reads smaps_rollup for the browser's processes only, using the supervisor's process tracker to follow them.
+    Nothing is sampled while the browser is frozen, since it can't grow then.
+    """
+
+    def __init__(self):
+        super(MemoryWatchdogThread, self).__init__(name='piosk-watchdog', daemon=True)
+        self._event = LoopEvent()
+        self.pss_kb: int | None = None
+        self.rss_kb: int | None = None
+        self.processes: int = 0
+
+    def reconfigure(self, settings: BrowserSettings):
+        # Start waiting again with the new interval.
+        self._event.set()
+
+    def check(self):
+        settings = get_config().browser
+        supervisor = get_supervisor()
+        if settings.memory_limit_mb <= 0 or supervisor.frozen or supervisor.restart_pending:
+            return
+        samples = [sample for sample in map(read_memory, supervisor.browser_pids()) if sample is not None]
+        self.processes = len(samples)
+        if not samples:
+            self.pss_kb = self.rss_kb = None
+            return
+        self.pss_kb = sum(pss for pss, _ in samples)
+        self.rss_kb = sum(rss for _, rss in samples)
+        debug('Browser memory: %d processes, PSS %d kB, RSS %d kB.', self.processes, self.pss_kb, self.rss_kb)
+        limit = settings.memory_limit_mb
+        if self.pss_kb > limit * 1024:
+            supervisor.request_restart(f'{self.pss_kb / 1024:.0f} MB in use, over the {limit:g} MB limit.')
+
+    def run(self):
+        while True:
+            self._event.wait(get_config().browser.memory_poll_seconds)
+            self._event.clear()
+            self.check()
+
+    async def run_async(self):
+        """
+        Coroutine equivalent of run() for the asyncio runtime. Samples are read in a worker thread.
+        """
+        while True:
+            await self._event.wait_async(get_config().browser.memory_poll_seconds)
+            self._event.clear()
+            await asyncio.to_thread(self.check)
+
+
+_WATCHDOG_THREAD: MemoryWatchdogThread | None = None
+
+
+def _on_browser_config(settings: BrowserSettings):
+    if _WATCHDOG_THREAD is not None:
+        _WATCHDOG_THREAD.reconfigure(settings)
+
+
+subscribe('browser', _on_browser_config)
+
+
+def _memory_samples() -> dict[tuple[str, ...], float]:
+    if _WATCHDOG_THREAD is None or _WATCHDOG_THREAD.pss_kb is None:
+        return {}
+    return {('pss',): _WATCHDOG_THREAD.pss_kb * 1024, ('rss',): _WATCHDOG_THREAD.rss_kb * 1024}
+
+
+piosk.metrics.callback(
+    'piosk_browser_memory_bytes', "Memory used by the browser's processes at the last sample.", 'gauge',
+    _memory_samples, ('kind',)
+)
+
+
+def memory_stats() -> dict[str, int | None]:
+    """
+    :return: The browser's memory use in kB and process count at the last sample.
+    """
+    if _WATCHDOG_THREAD is None:
+        return {}
+    return {
+        'pss_kb': _WATCHDOG_THREAD.pss_kb,
+        'rss_kb': _WATCHDOG_THREAD.rss_kb,
+        'processes': _WATCHDOG_THREAD.processes,
+    }
+
+
+def start_memory_watchdog():
+    global _WATCHDOG_THREAD
+    _WATCHDOG_THREAD = MemoryWatchdogThread()
+    _WATCHDOG_THREAD.start()
+
+
+async def run_memory_watchdog_async():
+    global _WATCHDOG_THREAD
+    _WATCHDOG_THREAD = MemoryWatchdogThread()
+    await _WATCHDOG_THREAD.run_async()
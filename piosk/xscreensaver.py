@@ -0,0 +1,439 @@
+import asyncio
+import os
+import queue
+import subprocess
+import time
+from dataclasses import dataclass
+from enum import Enum
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock, Thread
+from typing import AsyncIterator, Iterable, Iterator
+
+try:
+    from Xlib import X, display as xdisplay, error as xerror
+    from Xlib.protocol import event as xevent
+except ImportError:
+    X = xdisplay = xerror = xevent = None
+
+import piosk.metrics
+from piosk.util import warning
+
+
+class ScreensaverEvent(Enum):
+    NONE = 0
+    ACTIVATED = 1
+    DEACTIVATED = 2
+
+
+def parse_watch_line(text: str) -> ScreensaverEvent:
+    """
+    Parse a line of `xscreensaver-command --watch` output. A locked screen is blanked too, as in status().
+    """
+    return ScreensaverEvent.DEACTIVATED if text.startswith("UNBLANK") \
+        else ScreensaverEvent.ACTIVATED if text.startswith(("BLANK", "LOCK")) \
+        else ScreensaverEvent.NONE
+
+
+@dataclass(frozen=True)
+class FadeSettings:
+    # Whether xscreensaver fades the screen out when blanking, and back in when unblanking.
+    fade: bool = True
+    unfade: bool = False
+    fade_seconds: float = 3.0
+
+    @property
+    def blank_duration(self) -> float:
+        return self.fade_seconds if self.fade else 0.0
+
+    @property
+    def unblank_duration(self) -> float:
+        return self.fade_seconds if self.unfade else 0.0
+
+
+def _parse_duration(value: str) -> float:
+    # xscreensaver writes durations as H:MM:SS, but also accepts MM:SS and plain seconds.
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def _parse_bool(value: str) -> bool:
+    return value.strip().lower() in ('true', 'yes', 'on', '1')
+
+
+@lru_cache(maxsize=4)
+def _read_fade_settings(path: Path, mtime_ns: int) -> FadeSettings:
+    values = {}
+    with path.open('r', errors='replace') as f:
+        for line in f:
+            key, sep, value = line.partition(':')
+            if sep and key.strip() in ('fade', 'unfade', 'fadeSeconds'):
+                values[key.strip()] = value.strip()
+    defaults = FadeSettings()
+    try:
+        return FadeSettings(
+            fade=_parse_bool(values['fade']) if 'fade' in values else defaults.fade,
+            unfade=_parse_bool(values['unfade']) if 'unfade' in values else defaults.unfade,
+            fade_seconds=_parse_duration(values['fadeSeconds']) if 'fadeSeconds' in values else defaults.fade_seconds,
+        )
+    except ValueError as e:
+        warning('Could not parse fade settings in %s (%s). Using the defaults.', path, e)
+        return defaults
+
+
+def read_fade_settings(path: str) -> FadeSettings:
+    """
+    Read xscreensaver's fade settings from its config file. Results are cached until the file changes, so this is
+    cheap enough to call on every blank.
+
+    :param path: Path to the .xscreensaver file. `~` is expanded.
+    """
+    resolved = Path(os.path.expanduser(path))
+    try:
+        mtime_ns = resolved.stat().st_mtime_ns
+    except OSError:
+        return FadeSettings()
+    try:
+        return _read_fade_settings(resolved, mtime_ns)
+    except OSError as e:
+        warning('Could not read %s (%s). Using the default fade settings.', resolved, e)
+        return FadeSettings()
+
+
+class ScreensaverBackend:
+    """
+    Source of screensaver events and sink for screensaver commands.
+    """
+
+    name = 'base'
+
+    def watch(self) -> Iterator[ScreensaverEvent]:
+        """
+        Block and yield each screensaver state change.
+        """
+        raise NotImplementedError
+
+    async def watch_async(self) -> AsyncIterator[ScreensaverEvent]:
+        """
+        Asynchronously yield each screensaver state change on the running event loop.
+        """
+        raise NotImplementedError
+        yield
+
+    def status(self) -> ScreensaverEvent | None:
+        """
+        :return: ACTIVATED if the screen is currently blanked, DEACTIVATED if not, or None if it can't be determined.
+        """
+        return None
+
+    def activate(self) -> bool:
+        """
+        :return: True if the command was issued.
+        """
+        raise NotImplementedError
+
+    def deactivate(self) -> bool:
+        """
+        :return: True if the command was issued.
+        """
+        raise NotImplementedError
+
+
+_SPAWNS = piosk.metrics.counter('piosk_subprocesses_spawned_total', 'xscreensaver-command processes started.',
+                                ('command',))
+
+
+class SubprocessBackend(ScreensaverBackend):
+    """
+    Drives xscreensaver through the `xscreensaver-command` executable.
+    """
+
+    name = 'subprocess'
+
+    def __init__(self, display_name: str):
+        self._display_name = display_name
+        self._process: subprocess.Popen | None = None
+        self._queued: str | None = None
+        self._process_lock = Lock()
+
+    def _command(self, flag: str) -> list[str]:
+        return ["xscreensaver-command", "--display", self._display_name, flag]
+
+    def watch(self) -> Iterator[ScreensaverEvent]:
+        process = subprocess.Popen(self._command("--watch"), stdout=subprocess.PIPE)
+        _SPAWNS.inc('watch')
+        try:
+            for line in process.stdout:
+                result = parse_watch_line(line.decode("utf-8"))
+                if result is not ScreensaverEvent.NONE:
+                    yield result
+        finally:
+            process.kill()
+            process.wait()
+
+    async def watch_async(self) -> AsyncIterator[ScreensaverEvent]:
+        process = await asyncio.create_subprocess_exec(*self._command("--watch"), stdout=asyncio.subprocess.PIPE)
+        _SPAWNS.inc('watch')
+        try:
+            while line := await process.stdout.readline():
+                result = parse_watch_line(line.decode("utf-8"))
+                if result is not ScreensaverEvent.NONE:
+                    yield result
+        finally:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+
+    def status(self) -> ScreensaverEvent | None:
+        # Prints e.g. "XScreenSaver 6.06: screen blanked since ..." or "screen non-blanked since ...".
+        try:
+            output = subprocess.run(self._command("--time"), capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        _SPAWNS.inc('time')
+        if 'non-blanked' in output:
+            return ScreensaverEvent.DEACTIVATED
+        if 'blanked' in output or 'locked' in output:
+            return ScreensaverEvent.ACTIVATED
+        return None
+
+    def _spawn(self, flag: str) -> subprocess.Popen:
+        # Must be called with _process_lock held.
+        process = self._process = subprocess.Popen(
+            self._command(flag),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        _SPAWNS.inc(flag.lstrip('-'))
+        return process
+
+    def _run(self, flag: str) -> bool:
+        with self._process_lock:
+            if self._process is not None:
+                # Only one command may be in flight at a time. The latest one waits for it, since that is the state
+                # the caller wants xscreensaver in.
+                self._queued = flag
+                return True
+            process = self._spawn(flag)
+        # Reap the command as soon as it exits, so it never lingers as a zombie.
+        Thread(target=self._reap, args=(process,), name='piosk-xscreensaver-command', daemon=True).start()
+        return True
+
+    def _reap(self, process: subprocess.Popen):
+        while True:
+            process.wait()
+            with self._process_lock:
+                flag, self._queued = self._queued, None
+                if flag is None:
+                    self._process = None
+                    return
+                try:
+                    process = self._spawn(flag)
+                except OSError as e:
+                    self._process = None
+                    warning('Could not run xscreensaver-command %s: %s', flag, e)
+                    return
+
+    def activate(self) -> bool:
+        return self._run("--activate")
+
+    def deactivate(self) -> bool:
+        return self._run("--deactivate")
+
+
+class X11Backend(ScreensaverBackend):
+    """
+    Talks to xscreensaver directly over the X connection. State changes are read from the root window's
+    `_SCREENSAVER_STATUS` property, and commands are sent to xscreensaver's window as `SCREENSAVER` client messages,
+    the same way `xscreensaver-command` does it.
+    """
+
+    name = 'x11'
+
+    def __init__(self, display_name: str):
+        self._display_name = display_name
+        self._display = xdisplay.Display(display_name)
+        self._lock = Lock()
+        self._window = None
+        self._atom_screensaver = self._display.intern_atom('SCREENSAVER')
+        self._atom_version = self._display.intern_atom('_SCREENSAVER_VERSION')
+        self._atom_status = self._display.intern_atom('_SCREENSAVER_STATUS')
+        self._atom_activate = self._display.intern_atom('ACTIVATE')
+        self._atom_deactivate = self._display.intern_atom('DEACTIVATE')
+        self._blanked_atoms = (self._display.intern_atom('BLANK'), self._display.intern_atom('LOCK'))
+
+    def _find_window(self):
+        for child in self._display.screen().root.query_tree().children:
+            if child.get_full_property(self._atom_version, X.AnyPropertyType) is not None:
+                return child
+        return None
+
+    def _send(self, command_atom: int) -> bool:
+        with self._lock:
+            for attempt in range(2):
+                if self._window is None:
+                    self._window = self._find_window()
+                    if self._window is None:
+                        warning('xscreensaver is not running on the display.')
+                        return False
+                message = xevent.ClientMessage(
+                    window=self._window,
+                    client_type=self._atom_screensaver,
+                    data=(32, [command_atom, 0, 0, 0, 0])
+                )
+                catch = xerror.CatchError(xerror.BadWindow)
+                self._window.send_event(message, onerror=catch)
+                self._display.sync()
+                if catch.get_error() is None:
+                    return True
+                # xscreensaver was restarted. Look up its new window and try again.
+                self._window = None
+            return False
+
+    def activate(self) -> bool:
+        return self._send(self._atom_activate)
+
+    def deactivate(self) -> bool:
+        return self._send(self._atom_deactivate)
+
+    def status(self) -> ScreensaverEvent | None:
+        with self._lock:
+            return self._read_status(self._display.screen().root)
+
+    def _read_status(self, root) -> ScreensaverEvent:
+        prop = root.get_full_property(self._atom_status, X.AnyPropertyType)
+        if prop is not None and len(prop.value) > 0 and prop.value[0] in self._blanked_atoms:
+            return ScreensaverEvent.ACTIVATED
+        return ScreensaverEvent.DEACTIVATED
+
+    def _open_watch_display(self):
+        # A separate connection, so commands from other threads never interleave with the event stream.
+        watch_display = xdisplay.Display(self._display_name)
+        root = watch_display.screen().root
+        root.change_attributes(event_mask=X.PropertyChangeMask)
+        watch_display.flush()
+        return watch_display, root
+
+    def _status_changes(self, watch_display, root, state: ScreensaverEvent) -> tuple[ScreensaverEvent, list]:
+        changes = []
+        while watch_display.pending_events():
+            ev = watch_display.next_event()
+            if ev.type == X.PropertyNotify and ev.atom == self._atom_status:
+                new_state = self._read_status(root)
+                if new_state != state:
+                    state = new_state
+                    changes.append(state)
+        return state, changes
+
+    def watch(self) -> Iterator[ScreensaverEvent]:
+        watch_display, root = self._open_watch_display()
+        state = self._read_status(root)
+        try:
+            while True:
+                ev = watch_display.next_event()
+                if ev.type == X.PropertyNotify and ev.atom == self._atom_status:
+                    new_state = self._read_status(root)
+                    if new_state != state:
+                        state = new_state
+                        yield state
+        finally:
+            watch_display.close()
+
+    async def watch_async(self) -> AsyncIterator[ScreensaverEvent]:
+        watch_display, root = self._open_watch_display()
+        state = self._read_status(root)
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(watch_display.fileno(), readable.set)
+        try:
+            while True:
+                state, changes = self._status_changes(watch_display, root, state)
+                for change in changes:
+                    yield change
+                await readable.wait()
+                readable.clear()
+        finally:
+            loop.remove_reader(watch_display.fileno())
+            watch_display.close()
+
+
+class ScriptedBackend(ScreensaverBackend):
+    """
+    An in-process stand-in for xscreensaver, for running piosk off-device. Replays a script of (delay, event) pairs,
+    records every command it receives, and reacts to commands the way xscreensaver would.
+    """
+
+    name = 'scripted'
+
+    def __init__(self, script: Iterable[tuple[float, ScreensaverEvent]] = ()):
+        self._script = list(script)
+        self._events: queue.SimpleQueue[ScreensaverEvent] = queue.SimpleQueue()
+        self._state = ScreensaverEvent.DEACTIVATED
+        self._lock = Lock()
+        self.commands: list[str] = []
+
+    def push(self, event: ScreensaverEvent):
+        """
+        Emit a screensaver event, as if xscreensaver changed state on its own.
+        """
+        with self._lock:
+            if event == self._state:
+                return
+            self._state = event
+        self._events.put(event)
+
+    def watch(self) -> Iterator[ScreensaverEvent]:
+        for delay, event in self._script:
+            time.sleep(delay)
+            self.push(event)
+        while True:
+            yield self._events.get()
+
+    async def watch_async(self) -> AsyncIterator[ScreensaverEvent]:
+        for delay, event in self._script:
+            await asyncio.sleep(delay)
+            self.push(event)
+        while True:
+            while not self._events.empty():
+                yield self._events.get_nowait()
+            await asyncio.sleep(0.01)
+
+    def status(self) -> ScreensaverEvent | None:
+        with self._lock:
+            return self._state
+
+    def activate(self) -> bool:
+        self.commands.append('activate')
+        self.push(ScreensaverEvent.ACTIVATED)
+        return True
+
+    def deactivate(self) -> bool:
+        self.commands.append('deactivate')
+        self.push(ScreensaverEvent.DEACTIVATED)
+        return True
+
+
+def create_backend(name: str, display_name: str) -> ScreensaverBackend:
+    """
+    Create the configured screensaver backend.
+
+    :param name: One of 'auto', 'x11', 'subprocess' or 'scripted'. 'auto' uses the X11 backend when python-xlib is
+            installed and the display can be opened, and falls back to 'subprocess' otherwise.
+    :param display_name: The X display to connect to.
+    """
+    if name == 'scripted':
+        return ScriptedBackend()
+    if name in ('auto', 'x11'):
+        if xdisplay is None:
+            if name == 'x11':
+                raise RuntimeError('The x11 screensaver backend requires python-xlib.')
+        else:
+            try:
+                return X11Backend(display_name)
+            except (xerror.DisplayError, ConnectionError) as e:
+                if name == 'x11':
+                    raise
+                warning('Could not connect to X display %s (%s). Using xscreensaver-command.', display_name, e)
+    return SubprocessBackend(display_name)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Control a running piosk daemon over its control socket.
+"""
+import argparse
+import json
+import socket
+import sys
+
+from piosk.config import CONFIG
+
+
+class ControlClient:
+    """
+    A blocking client for the control socket.
+    """
+
+    def __init__(self, path: str | None = None, timeout: float = 5.0):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path if path is not None else CONFIG['control']['SOCKET'])
+        self._file = self._socket.makefile('rb')
+
+    def send(self, *requests: dict) -> list[dict]:
+        """
+        Send one or more commands in a single write and wait for all of their responses.
+        """
+        self._socket.sendall(b''.join(json.dumps(request).encode() + b'\n' for request in requests))
+        return [json.loads(self._file.readline()) for _ in requests]
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _brightness_value(text: str) -> int | str:
+    if text == 'next':
+        return text
+    try:
+        value = int(text)
+    except ValueError:
+        value = -1
+    if not 0 <= value <= 255:
+        raise argparse.ArgumentTypeError(f"expected 0-255 or 'next', not {text!r}")
+    return value
+
+
+def _request(args: argparse.Namespace) -> dict:
+    if args.command == 'state':
+        return {'cmd': 'get_state'}
+    if args.command == 'brightness':
+        if args.value == 'next':
+            return {'cmd': 'next_step', 'smooth': args.smooth}
+        return {'cmd': 'set_brightness', 'value': args.value, 'smooth': args.smooth}
+    if args.command == 'power':
+        return {'cmd': 'set_power', 'on': args.state == 'on'}
+    if args.command == 'auto':
+        return {'cmd': 'set_auto_brightness', 'enabled': args.state == 'on'}
+    if args.command == 'screensaver':
+        return {'cmd': f'{args.action}_screensaver'}
+    return json.loads(args.json)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--socket', default=CONFIG['control']['SOCKET'])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('state', help='Print the current brightness, power and screensaver state.')
+    brightness = commands.add_parser('brightness', help='Set the backlight brightness.')
+    brightness.add_argument('value', type=_brightness_value, help="0-255, or 'next' for the next manual step.")
+    brightness.add_argument('--smooth', action='store_true', help='Fade to the new brightness.')
+    power = commands.add_parser('power', help='Turn the backlight on or off.')
+    power.add_argument('state', choices=('on', 'off'))
+    auto = commands.add_parser('auto', help='Turn auto brightness on or off.')
+    auto.add_argument('state', choices=('on', 'off'))
+    screensaver = commands.add_parser('screensaver', help='Activate or deactivate the screensaver.')
+    screensaver.add_argument('action', choices=('activate', 'deactivate'))
+    raw = commands.add_parser('raw', help='Send a raw JSON request.')
+    raw.add_argument('json')
+    args = parser.parse_args()
+
+    with ControlClient(args.socket) as client:
+        response, = client.send(_request(args))
+    if not response.get('ok'):
+        sys.exit(f"Error: {response.get('error')}")
+    if 'result' in response:
+        print(json.dumps(response['result'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
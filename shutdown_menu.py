@@ -1,32 +1,23 @@
 #!/usr/bin/python3
+import argparse
+import math
+import os
 import pathlib
+import shlex
+import socket
+import subprocess
+import time
 import tkinter as tk
-from threading import Thread, Event
 
 import pygubu
 
-from piosk.config import CONFIG
+from piosk.config import get_config
 
 
 PROJECT_PATH = pathlib.Path(__file__).parent
 PROJECT_UI = PROJECT_PATH / "shutdown_menu.ui"
 
 
-class CounterThread(Thread):
-
-    def __init__(self, group=..., target=..., name=..., args=..., kwargs=..., *, daemon=..., event: Event=None):
-        super().__init__(group, target, name, args, kwargs, daemon=daemon)
-        self._event = event
-
-    def run(self):
-        super().run()
-        # TODO: set counter variable starting at CONFIG['shutdown']['TIMEOUT'], reducing by 1 every second.
-        self._event.wait(1)
-        if self._event.is_set() is True:
-            # TODO: Cancel timeout, close the window
-            pass
-
-
 class ShutdownMenuApp:
     def __init__(self, master=None):
         self.builder = builder = pygubu.Builder()
@@ -38,6 +29,11 @@ class ShutdownMenuApp:
         self.dialog = builder.get_object("dialog1", self.mainwindow)
         self.dialog_header = builder.get_variable("operation_value")
         self.dialog_countdown = builder.get_variable("countdown_value")
+        self._resident = False
+        self._listener: socket.socket | None = None
+        self._command: str | None = None
+        self._countdown_job: str | None = None
+        self._countdown_end: float = 0.0
 
         builder.connect_callbacks(self)
 
@@ -69,11 +65,78 @@ class ShutdownMenuApp:
 
         self.mainwindow.mainloop()
 
+    def run_resident(self, path: str, show: bool = False):
+        """
+        Keep the menu built but hidden, and show it whenever "show" is sent to the datagram socket at `path`. The
+        socket is watched by Tk's own event loop, so no thread is needed and showing the menu takes a single redraw.
+        """
+        self._resident = True
+        self.mainwindow.withdraw()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._listener.bind(path)
+        self._listener.setblocking(False)
+        self.mainwindow.tk.createfilehandler(self._listener, tk.READABLE, self._on_message)
+        if show:
+            self.show()
+        self.run()
+
+    def _on_message(self, fileobj, mask):
+        while True:
+            try:
+                message = self._listener.recv(64)
+            except BlockingIOError:
+                break
+            if message.strip() == b'show':
+                self.show()
+
+    def show(self):
+        self.mainwindow.deiconify()
+        self.mainwindow.lift()
+        self.mainwindow.focus_force()
+
+    def hide(self):
+        self._cancel_countdown()
+        self.dialog.close()
+        if self._resident:
+            self.mainwindow.withdraw()
+        else:
+            self.mainwindow.destroy()
+
     def display_dialog(self, title: str, cmd: str):
         self.dialog_header.set(title)
+        self._command = cmd
+        timeout = get_config().shutdown.timeout
+        self._countdown_end = time.monotonic() + timeout
+        self.dialog_countdown.set(str(math.ceil(timeout)))
+        # Start the countdown first: run() doesn't return until the dialog closes if the dialog is ever made modal.
+        self._schedule_tick()
         self.dialog.run()
-        print(f'TODO: Start countdown of {CONFIG['shutdown']['TIMEOUT']}')
-        print(f'TODO: Call shell command: {cmd}')
+
+    def _schedule_tick(self):
+        # Tick on whole seconds before the deadline, so the countdown doesn't drift as callbacks run late.
+        remaining = self._countdown_end - time.monotonic()
+        delay = remaining - math.floor(remaining) if remaining > 1 else remaining
+        self._countdown_job = self.mainwindow.after(max(0, int(delay * 1000)), self._tick)
+
+    def _tick(self):
+        self._countdown_job = None
+        remaining = self._countdown_end - time.monotonic()
+        if remaining > 0.001:
+            self.dialog_countdown.set(str(math.ceil(remaining)))
+            self._schedule_tick()
+            return
+        self.dialog_countdown.set('0')
+        subprocess.Popen(shlex.split(self._command))
+        self.hide()
+
+    def _cancel_countdown(self):
+        if self._countdown_job is not None:
+            self.mainwindow.after_cancel(self._countdown_job)
+            self._countdown_job = None
 
     def on_reboot(self):
         self.display_dialog('Rebooting', 'sudo reboot')
@@ -82,12 +145,21 @@ class ShutdownMenuApp:
         self.display_dialog('Shutting Down', 'sudo halt')
 
     def on_cancel(self):
-        self.mainwindow.destroy()
+        self.hide()
 
     def on_cancel_operation(self):
+        self._cancel_countdown()
         self.dialog.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Menu for rebooting or shutting down the kiosk.')
+    parser.add_argument('--resident', metavar='SOCKET',
+                        help='Keep running with the menu hidden, and show it whenever "show" is sent to SOCKET.')
+    parser.add_argument('--show', action='store_true', help='With --resident, show the menu as soon as it is built.')
+    args = parser.parse_args()
     app = ShutdownMenuApp()
-    app.run()
+    if args.resident is not None:
+        app.run_resident(args.resident, args.show)
+    else:
+        app.run()
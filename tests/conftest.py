@@ -0,0 +1,43 @@
+import dataclasses
+
+import pytest
+
+from piosk.config import CONFIG
+
+# Tests always run against the in-process fakes, never real hardware.
+CONFIG['hardware']['BACKEND'] = 'fake'
+
+import piosk.brightness  # noqa: E402,F401
+import piosk.config  # noqa: E402
+import piosk.logger  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def state_file(tmp_path_factory):
+    """
+    Keep state saved by the tests out of the project directory.
+    """
+    CONFIG['state']['FILE'] = str(tmp_path_factory.mktemp('state') / 'state.json')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def flush_log():
+    """
+    Write out buffered log records while pytest still holds the output they go to, rather than at exit.
+    """
+    yield
+    piosk.logger.flush()
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    """
+    :return: A function that swaps in a config snapshot with changes to one section, for the length of the test.
+    """
+    def configure(section: str, **changes):
+        snapshot = piosk.config.get_config()
+        settings = dataclasses.replace(getattr(snapshot, section), **changes)
+        monkeypatch.setattr(piosk.config, '_SNAPSHOT', dataclasses.replace(snapshot, **{section: settings}))
+        return settings
+
+    return configure
@@ -0,0 +1,141 @@
+import time
+
+import pytest
+
+import piosk.config
+
+import piosk.button
+import piosk.hardware
+import piosk.screensaver
+from piosk.config import CONFIG
+from piosk.gestures import Gesture
+
+MIN_HOLD = 0.2
+MAX_HOLD = 0.5
+CLICK_WINDOW = 0.15
+# Each gesture runs a different action, so the action shows which gesture it was.
+ACTIONS = {
+    'single_click': 'next_step',
+    'double_click': 'toggle_auto_brightness',
+    'triple_click': 'activate_screensaver',
+    'short_hold': 'shutdown_menu',
+    'long_hold': 'none',
+}
+
+
+class FakeButton:
+    def __init__(self, thread: piosk.button.ButtonThread):
+        self.thread = thread
+        self.pin = piosk.hardware.pin_factory().pin(CONFIG['PIN_BUTTON'])
+        self.gestures: list[Gesture] = []
+        self.actions: list[str] = []
+
+    def press(self, seconds: float):
+        # The button pulls the pin up, so pressing it drives the pin low.
+        self.pin.drive_low()
+        time.sleep(seconds)
+        self.pin.drive_high()
+
+    def click(self):
+        self.press(0.02)
+        time.sleep(0.03)
+
+    def settle(self):
+        time.sleep(CLICK_WINDOW + 0.1)
+
+
+@pytest.fixture
+def button(configure, monkeypatch):
+    configure('button', min_hold_time_seconds=MIN_HOLD, max_hold_time_seconds=MAX_HOLD,
+              click_window_seconds=CLICK_WINDOW, **{f'action_{gesture}': action for gesture, action in ACTIONS.items()})
+    monkeypatch.setattr(piosk.screensaver, 'poke_screensaver', lambda: False)
+    fake = FakeButton(piosk.button.ButtonThread())
+    for action in ACTIONS.values():
+        monkeypatch.setitem(piosk.button._ACTIONS, action, lambda action=action: fake.actions.append(action))
+    on_gesture = fake.thread._on_gesture
+
+    def record(gesture: Gesture, recognized_at: float):
+        fake.gestures.append(gesture)
+        on_gesture(gesture, recognized_at)
+
+    fake.thread._recognizer._on_gesture = record
+    yield fake
+    fake.thread._gpio_button.close()
+
+
+def test_single_click(button):
+    button.click()
+    assert button.gestures == []  # A second click could still follow.
+    button.settle()
+    assert button.gestures == [Gesture.SINGLE_CLICK]
+    assert button.actions == ['next_step']
+
+
+def test_double_click(button):
+    button.click()
+    button.click()
+    button.settle()
+    assert button.gestures == [Gesture.DOUBLE_CLICK]
+    assert button.actions == ['toggle_auto_brightness']
+
+
+def test_triple_click_does_not_wait_for_the_window(button):
+    button.click()
+    button.click()
+    button.press(0.02)
+    assert button.gestures == [Gesture.TRIPLE_CLICK]
+    assert button.actions == ['activate_screensaver']
+
+
+def test_clicks_outside_the_window_are_separate(button):
+    button.click()
+    button.settle()
+    button.click()
+    button.settle()
+    assert button.gestures == [Gesture.SINGLE_CLICK, Gesture.SINGLE_CLICK]
+
+
+def test_short_hold(button):
+    button.press((MIN_HOLD + MAX_HOLD) / 2)
+    assert button.gestures == [Gesture.SHORT_HOLD]
+    assert button.actions == ['shutdown_menu']
+
+
+def test_long_hold(button):
+    button.press(MAX_HOLD + 0.1)
+    assert button.gestures == [Gesture.LONG_HOLD]
+    assert button.actions == ['none']
+
+
+def test_click_before_hold_is_reported_when_the_hold_starts(button):
+    button.click()
+    button.pin.drive_low()
+    time.sleep(MIN_HOLD + 0.1)
+    assert button.gestures == [Gesture.SINGLE_CLICK]
+    button.pin.drive_high()
+    assert button.gestures == [Gesture.SINGLE_CLICK, Gesture.SHORT_HOLD]
+    assert button.actions == ['next_step', 'shutdown_menu']
+
+
+def test_single_click_is_reported_on_release_without_multi_click_actions(button, configure):
+    configure('button', action_double_click='none', action_triple_click='none')
+    button.thread.reconfigure(piosk.config.get_config().button)
+    button.press(0.02)
+    assert button.gestures == [Gesture.SINGLE_CLICK]
+
+
+@pytest.mark.parametrize('presses, gesture', [
+    (lambda b: b.click(), Gesture.SINGLE_CLICK),
+    (lambda b: (b.click(), b.click()), Gesture.DOUBLE_CLICK),
+    (lambda b: b.press(MIN_HOLD + 0.1), Gesture.SHORT_HOLD),
+])
+def test_gesture_that_wakes_the_screen_runs_no_action(button, monkeypatch, presses, gesture):
+    woken = iter((True,))
+    monkeypatch.setattr(piosk.screensaver, 'poke_screensaver', lambda: next(woken, False))
+    presses(button)
+    button.settle()
+    assert button.gestures == [gesture]
+    assert button.actions == []
+    button.click()
+    button.settle()
+    assert button.actions == ['next_step']
@@ -0,0 +1,89 @@
+import argparse
+import os
+import time
+
+import pytest
+
+import piosk.brightness
+import piosk.control
+from pioskctl import ControlClient, _brightness_value
+
+
+@pytest.fixture(scope='module')
+def socket_path(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp('control') / 'control.sock')
+    piosk.control.ControlServerThread(path).start()
+    deadline = time.monotonic() + 5
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return path
+
+
+@pytest.fixture
+def client(socket_path):
+    with ControlClient(socket_path) as client:
+        yield client
+
+
+def send(client: ControlClient, **request) -> dict:
+    return client.send(request)[0]
+
+
+def test_set_brightness_changes_the_backlight(client):
+    assert send(client, cmd='set_brightness', value=100) == {'ok': True}
+    assert piosk.brightness.get_brightness() == 100
+    assert send(client, cmd='get_state')['result']['brightness'] == 100
+
+
+@pytest.mark.parametrize('value', [256, -1, '100', 1.5, True, None])
+def test_out_of_range_or_mistyped_brightness_is_rejected(client, value):
+    send(client, cmd='set_brightness', value=50)
+    response = send(client, cmd='set_brightness', value=value)
+    assert response['ok'] is False
+    assert '"value"' in response['error']
+    assert piosk.brightness.get_brightness() == 50
+
+
+def test_malformed_requests_are_rejected(client):
+    client._socket.sendall(b'{"cmd": \n[1, 2]\n{"cmd": "set_brightness", "value": 60}\n')
+    responses = [client._file.readline() for _ in range(3)]
+    assert [b'"ok": false' in response for response in responses] == [True, True, False]
+    assert b'Invalid request' in responses[0] and b'Expected a JSON object' in responses[1]
+    assert piosk.brightness.get_brightness() == 60
+
+
+def test_unknown_command_is_rejected(client):
+    assert send(client, cmd='reboot', id=7) == {'id': 7, 'ok': False, 'error': "Unknown command 'reboot'."}
+
+
+def test_state_reports_power_and_screensaver(client):
+    send(client, cmd='set_brightness', value=120)
+    assert send(client, cmd='set_power', on=False) == {'ok': True}
+    assert send(client, cmd='get_state')['result'] == {
+        'brightness': 120,
+        'power': 'off',
+        'screensaver': 'inactive',
+        'display': 'active',
+        'auto_brightness': False,
+    }
+    send(client, cmd='set_power', on=True)
+    assert send(client, cmd='get_state')['result']['power'] == 'on'
+
+
+def test_consecutive_writes_in_one_batch_are_coalesced(client):
+    responses = client.send({'cmd': 'set_brightness', 'value': 10, 'id': 1},
+                            {'cmd': 'set_brightness', 'value': 20, 'id': 2})
+    assert responses == [{'id': 1, 'ok': True, 'superseded': True}, {'id': 2, 'ok': True}]
+    assert piosk.brightness.get_brightness() == 20
+
+
+@pytest.mark.parametrize('text', ['256', '-1', 'bright', ''])
+def test_pioskctl_rejects_brightness_outside_the_range(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        _brightness_value(text)
+
+
+def test_pioskctl_accepts_brightness_in_the_range():
+    assert _brightness_value('0') == 0
+    assert _brightness_value('255') == 255
+    assert _brightness_value('next') == 'next'
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from piosk.hardware import pin_factory
+from piosk.led import BlinkSequenceEvent, SequencedPWMLED
+
+# Not wired to anything, so these tests don't share a pin with the status LED.
+PIN = 22
+STEPS = (BlinkSequenceEvent(0.5, 0.01), BlinkSequenceEvent(1.0, 0.01))
+
+
+@pytest.fixture
+def led():
+    led = SequencedPWMLED(PIN, pin_factory=pin_factory())
+    yield led
+    led.close()
+
+
+def test_sequence_plays_on_the_event_loop(led):
+    request = led._worker.claim(STEPS, 0.0, 1, 0.0)
+    asyncio.run(led._sequenced_blink_coroutine(request))
+    assert led.value == 1.0
+
+
+def test_stopped_sequence_does_not_write_on_the_event_loop(led):
+    request = led._worker.claim(STEPS, 0.0, 1, 0.0)
+    # As if stopped from another thread, before the cancellation reaches the task.
+    led._stop_blink()
+    asyncio.run(led._sequenced_blink_coroutine(request))
+    assert led.value == 0.0
+
+
+def test_stopped_sequence_does_not_write_on_the_worker(led):
+    request = led._worker.claim(STEPS, 0.0, 1, 0.0)
+    led._worker.stop_sequence()
+    assert not led._worker.write(request, 1.0)
+    assert led.value == 0.0
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+import piosk.screensaver
+from piosk.screensaver import PokeDispatcher
+from piosk.xscreensaver import ScreensaverBackend, ScreensaverEvent
+
+
+class SlowBackend(ScreensaverBackend):
+    """
+    Holds each deactivate command in flight until it is released.
+    """
+
+    def __init__(self):
+        self.commands: list[str] = []
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+
+    def deactivate(self) -> bool:
+        self.commands.append('deactivate')
+        self.started.release()
+        self.release.wait(5)
+        return True
+
+
+@pytest.fixture
+def backend(monkeypatch) -> SlowBackend:
+    backend = SlowBackend()
+    monkeypatch.setattr(piosk.screensaver, '_BACKEND', backend)
+    return backend
+
+
+def poke_in_background(dispatcher: PokeDispatcher, waking: bool) -> list[bool]:
+    results = []
+    threading.Thread(target=lambda: results.append(dispatcher.poke(waking)), daemon=True).start()
+    return results
+
+
+def test_waking_poke_is_queued_behind_the_one_in_flight(backend):
+    dispatcher = PokeDispatcher(window=10.0)
+    first = poke_in_background(dispatcher, waking=False)
+    assert backend.started.acquire(timeout=5)
+    assert dispatcher.poke(waking=True)
+    assert dispatcher.poke(waking=True)
+    assert not dispatcher.poke(waking=False)
+    assert backend.commands == ['deactivate']
+    backend.release.set()
+    assert backend.started.acquire(timeout=5)
+    assert backend.commands == ['deactivate', 'deactivate']
+    assert first == [False]
+    assert (dispatcher.received, dispatcher.issued, dispatcher.suppressed) == (4, 2, 2)
+
+
+def test_pokes_within_the_window_are_suppressed_unless_waking(backend):
+    backend.release.set()
+    dispatcher = PokeDispatcher(window=10.0)
+    assert not dispatcher.poke(waking=False)
+    assert not dispatcher.poke(waking=False)
+    assert dispatcher.poke(waking=True)
+    assert backend.commands == ['deactivate', 'deactivate']
+
+
+@pytest.fixture
+def poke(backend, monkeypatch):
+    backend.release.set()
+    monkeypatch.setattr(piosk.screensaver, '_POKE_DISPATCHER', PokeDispatcher(window=0.0))
+
+    def poke(status: ScreensaverEvent) -> bool:
+        monkeypatch.setattr(piosk.screensaver, 'get_status', lambda: status)
+        return piosk.screensaver.poke_screensaver()
+
+    return poke
+
+
+def test_poke_screensaver_reports_whether_it_woke_the_screen(poke):
+    assert poke(ScreensaverEvent.ACTIVATED)
+    assert not poke(ScreensaverEvent.DEACTIVATED)
+
+
+def test_poke_screensaver_does_not_report_a_wake_that_was_not_sent(poke, backend, monkeypatch):
+    monkeypatch.setattr(backend, 'deactivate', lambda: False)
+    assert not poke(ScreensaverEvent.ACTIVATED)
@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+import piosk.brightness
+
+from piosk.sysfs import SysfsAttribute
+
+
+@pytest.fixture
+def pwrites(monkeypatch) -> list[bytes]:
+    written = []
+    pwrite = os.pwrite
+
+    def record(fd: int, data: bytes, offset: int) -> int:
+        written.append(data)
+        return pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, 'pwrite', record)
+    return written
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'brightness'
+    path.write_text('0\n')
+    return path
+
+
+def test_writes_within_the_interval_collapse_into_one(path, pwrites):
+    attr = SysfsAttribute(path, min_interval=0.1)
+    attr.write(10)
+    attr.write(20)
+    attr.write(30)
+    assert pwrites == [b'10']
+    assert attr.read() == '30'
+    time.sleep(0.2)
+    assert pwrites == [b'10', b'30']
+    assert path.read_text() == '30'
+    assert (attr.writes_issued, attr.writes_merged) == (2, 1)
+
+
+def test_writes_further_apart_than_the_interval_all_go_out(path, pwrites):
+    attr = SysfsAttribute(path, min_interval=0.05)
+    for value in (1, 2, 3):
+        attr.write(value)
+        time.sleep(0.1)
+    assert pwrites == [b'1', b'2', b'3']
+    assert attr.writes_merged == 0
+
+
+def test_without_an_interval_every_write_goes_out(path, pwrites):
+    attr = SysfsAttribute(path)
+    attr.write(255)
+    attr.write(7)
+    assert pwrites == [b'255', b'7']
+    # The fake backend's tmpfs files are truncated after a shorter value.
+    assert path.read_text() == '7'
+
+
+def test_close_flushes_the_pending_value(path, pwrites):
+    attr = SysfsAttribute(path, min_interval=10.0)
+    attr.write(1)
+    attr.write(2)
+    attr.close()
+    assert pwrites == [b'1', b'2']
+
+
+def test_backlight_merges_brightness_writes_within_a_panel_frame(pwrites):
+    backlight = piosk.brightness._get_backlight()
+    time.sleep(2 * piosk.brightness._PANEL_FRAME_SECONDS)
+    backlight.brightness_value = 11
+    backlight.brightness_value = 12
+    assert pwrites == [b'11']
+    time.sleep(2 * piosk.brightness._PANEL_FRAME_SECONDS)
+    assert pwrites == [b'11', b'12']
+    assert backlight.brightness_value == 12
@@ -0,0 +1,208 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from Xlib import error as xerror
+
+import piosk.xscreensaver
+from piosk.xscreensaver import ScreensaverEvent, SubprocessBackend, X11Backend, parse_watch_line
+
+# Stands in for xscreensaver-command: logs its arguments, prints $STUB_OUTPUT, and takes a while over --activate.
+STUB_COMMAND = '''#!/bin/sh
+echo "$*" >> "$STUB_LOG"
+for flag; do :; done
+[ "$flag" = --activate ] && sleep 0.3
+printf '%s' "$STUB_OUTPUT"
+exit 0
+'''
+
+# Lines as printed by `xscreensaver-command --watch`.
+WATCH_OUTPUT = '''BLANK Sun Oct 18 15:17:46 2026
+RUN 12
+LOCK Sun Oct 18 15:18:46 2026
+UNBLANK Sun Oct 18 15:20:02 2026
+'''
+
+
+@pytest.mark.parametrize('line, event', [
+    ('BLANK Sun Oct 18 15:17:46 2026\n', ScreensaverEvent.ACTIVATED),
+    ('LOCK Sun Oct 18 15:18:46 2026\n', ScreensaverEvent.ACTIVATED),
+    ('UNBLANK Sun Oct 18 15:20:02 2026\n', ScreensaverEvent.DEACTIVATED),
+    ('RUN 12\n', ScreensaverEvent.NONE),
+    ('RUN 0\n', ScreensaverEvent.NONE),
+    ('', ScreensaverEvent.NONE),
+])
+def test_parse_watch_line(line, event):
+    assert parse_watch_line(line) is event
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    command = tmp_path / 'xscreensaver-command'
+    command.write_text(STUB_COMMAND)
+    command.chmod(0o755)
+    log = tmp_path / 'log'
+    log.touch()
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('STUB_LOG', str(log))
+    monkeypatch.setenv('STUB_OUTPUT', '')
+
+    def output(text: str):
+        monkeypatch.setenv('STUB_OUTPUT', text)
+
+    return SimpleNamespace(log=log, output=output)
+
+
+def wait_for_lines(log, count: int) -> list[str]:
+    deadline = time.monotonic() + 5
+    while len(lines := log.read_text().splitlines()) < count and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return lines
+
+
+def test_subprocess_commands(stub):
+    backend = SubprocessBackend(':1')
+    assert backend.deactivate()
+    assert wait_for_lines(stub.log, 1) == ['--display :1 --deactivate']
+
+
+def test_subprocess_command_issued_while_another_is_in_flight_runs_after_it(stub):
+    backend = SubprocessBackend(':0')
+    assert backend.activate()
+    assert backend.deactivate()
+    assert wait_for_lines(stub.log, 2) == ['--display :0 --activate', '--display :0 --deactivate']
+
+
+def test_subprocess_only_the_latest_queued_command_runs(stub):
+    backend = SubprocessBackend(':0')
+    assert backend.activate()
+    assert backend.deactivate()
+    assert backend.activate()
+    assert backend.deactivate()
+    time.sleep(0.5)
+    assert wait_for_lines(stub.log, 2) == ['--display :0 --activate', '--display :0 --deactivate']
+
+
+@pytest.mark.parametrize('output, status', [
+    ('XScreenSaver 6.06: screen non-blanked since Sun Oct 18 15:17:46 2026\n', ScreensaverEvent.DEACTIVATED),
+    ('XScreenSaver 6.06: screen blanked since Sun Oct 18 15:17:46 2026\n', ScreensaverEvent.ACTIVATED),
+    ('XScreenSaver 6.06: screen locked since Sun Oct 18 15:17:46 2026\n', ScreensaverEvent.ACTIVATED),
+    ('', None),
+])
+def test_subprocess_status(stub, output, status):
+    stub.output(output)
+    assert SubprocessBackend(':0').status() is status
+    assert stub.log.read_text() == '--display :0 --time\n'
+
+
+def test_subprocess_status_without_xscreensaver_command(tmp_path, monkeypatch):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    assert SubprocessBackend(':0').status() is None
+
+
+def test_subprocess_watch(stub):
+    stub.output(WATCH_OUTPUT)
+    assert list(SubprocessBackend(':0').watch()) == [
+        ScreensaverEvent.ACTIVATED, ScreensaverEvent.ACTIVATED, ScreensaverEvent.DEACTIVATED
+    ]
+
+
+class FakeBadWindow(xerror.BadWindow):
+    def __init__(self):
+        pass
+
+
+class FakeWindow:
+    def __init__(self, wid: int, properties: dict[int, list[int]] | None = None):
+        self.id = wid
+        self.properties = properties or {}
+        self.children: list[FakeWindow] = []
+        self.received: list[int] = []
+        self.destroyed = False
+
+    def __window__(self) -> int:
+        return self.id
+
+    def get_full_property(self, atom: int, property_type: int):
+        value = self.properties.get(atom)
+        return None if value is None else SimpleNamespace(value=value)
+
+    def query_tree(self):
+        return SimpleNamespace(children=self.children)
+
+    def send_event(self, event, onerror):
+        if self.destroyed:
+            onerror(FakeBadWindow(), None)
+        else:
+            self.received.append(event.data[1][0])
+
+
+class FakeDisplay:
+    """
+    Just enough of an Xlib display for X11Backend's commands and status queries.
+    """
+
+    atoms: dict[str, int] = {}
+    root = FakeWindow(1)
+
+    def __init__(self, display_name: str):
+        pass
+
+    @classmethod
+    def intern_atom(cls, name: str) -> int:
+        return cls.atoms.setdefault(name, 100 + len(cls.atoms))
+
+    def screen(self):
+        return SimpleNamespace(root=self.root)
+
+    def sync(self):
+        pass
+
+
+def xscreensaver_window(wid: int) -> FakeWindow:
+    return FakeWindow(wid, {FakeDisplay.intern_atom('_SCREENSAVER_VERSION'): [ord(c) for c in '6.06']})
+
+
+@pytest.fixture
+def root(monkeypatch) -> FakeWindow:
+    monkeypatch.setattr(FakeDisplay, 'root', FakeWindow(1))
+    monkeypatch.setattr(piosk.xscreensaver, 'xdisplay', SimpleNamespace(Display=FakeDisplay))
+    return FakeDisplay.root
+
+
+def test_x11_commands_go_to_the_xscreensaver_window(root):
+    window = xscreensaver_window(2)
+    root.children = [FakeWindow(3), window]
+    backend = X11Backend(':0')
+    assert backend.activate()
+    assert backend.deactivate()
+    assert window.received == [FakeDisplay.intern_atom('ACTIVATE'), FakeDisplay.intern_atom('DEACTIVATE')]
+
+
+def test_x11_commands_follow_a_restarted_xscreensaver(root):
+    old, new = xscreensaver_window(2), xscreensaver_window(3)
+    root.children = [old]
+    backend = X11Backend(':0')
+    assert backend.deactivate()
+    old.destroyed = True
+    root.children = [new]
+    assert backend.deactivate()
+    assert (len(old.received), new.received) == (1, [FakeDisplay.intern_atom('DEACTIVATE')])
+
+
+def test_x11_commands_without_xscreensaver(root):
+    root.children = [FakeWindow(2)]
+    assert not X11Backend(':0').activate()
+
+
+@pytest.mark.parametrize('status, event', [
+    ('BLANK', ScreensaverEvent.ACTIVATED),
+    ('LOCK', ScreensaverEvent.ACTIVATED),
+    ('UNBLANK', ScreensaverEvent.DEACTIVATED),
+    (None, ScreensaverEvent.DEACTIVATED),
+])
+def test_x11_status(root, status, event):
+    if status is not None:
+        root.properties[FakeDisplay.intern_atom('_SCREENSAVER_STATUS')] = [FakeDisplay.intern_atom(status), 0, 0]
+    assert X11Backend(':0').status() is event